@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from mm.models import MeshModel
-from mm.utils.opengl import Render
-from mm.optimize.camera import estimateCamMat, splitCamMat
+from mm.utils.opengl import getRender
+from mm.optimize.camera import estimateCamMatBatch, splitCamMatBatch
+from mm.optimize.convergence import ConvergenceControl
+from mm.optimize.derivative import checkJacobian
 import mm.optimize.image as opt
 from mm.utils.mesh import calcNormals, generateFace, generateTexture, barycentricReconstruction
 from mm.utils.transform import sh9
+from mm.utils.io import FrameSource, LandmarkStore, loadImage
 
-import os, json
+import os
 import numpy as np
-from scipy.optimize import minimize, check_grad, least_squares, nnls, lsq_linear
+from scipy.optimize import check_grad
 from mpl_toolkits.mplot3d import Axes3D
-from skimage import io, img_as_float
 import matplotlib.pyplot as plt
 from pylab import savefig
 
@@ -29,33 +31,40 @@ if __name__ == "__main__":
     # Set an orthographic projection for the camera matrix
     cam = 'orthographic'
     
+    # Render with OpenGL, or set this to 'software' to render with the NumPy rasterizer on machines without a GPU or a display
+    renderBackend = 'opengl'
+    
     # Set weights for the 3DMM RGB color shape, landmark shape, and regularization terms
     wCol = 1000
     wLan = 10
     wReg = 1
     
-    for frame in np.arange(1, numFrames + 1):
+    """
+    Set filenames, read landmarks, load source video frames
+    """
+    # Stopping criteria for the texture and lighting fit on mini-batches of pixels. The number of evaluations that each frame used is printed.
+    texLightControl = ConvergenceControl(ftol = 1e-4, gtol = 1e-6, xtol = 1e-6, maxIter = 100, name = 'texture and lighting', verbose = True)
+    
+    # The OpenPose landmarks for all frames in the source video, which are ingested from the per-frame .json files with bin/landmark2store.py
+    landmarks = LandmarkStore('landmark')
+    
+    # Estimate the orthographic camera of every frame at once from the landmarks of the mean 3DMM shape, and factor the camera projection matrices into the scales and the rotation/translation similarity transform parameters
+    lm3D = generateFace(np.r_[np.zeros(m.numId + m.numExp + 6), 1], m, ind = m.sourceLMInd).T
+    camMat = estimateCamMatBatch(landmarks.take(np.arange(1, numFrames + 1))[:, m.targetLMInd, :2], lm3D)
+    camScale, camAngles, camTrans = splitCamMatBatch(camMat)
+    
+    # The frames from the source video are loaded in background threads while the current frame is fitted. The frames are kept as 8-bit images, and only the pixels that are used in the fitting are converted to floats.
+    frameSource = FrameSource(np.arange(1, numFrames + 1), {'img': ('orig/{:0>5}.png', loadImage)})
+    
+    for frame, frameData in frameSource:
         print(frame)
         fName = '{:0>5}'.format(frame)
         
-        """
-        Set filenames, read landmarks, load source video frames
-        """
-        # Frames from the source video
-        fNameImgOrig = 'orig/' + fName + '.png'
-        
-        # OpenPose landmarks for each frame in the source video
-        fNameLandmarks = 'landmark/' + fName + '.json'
-        
-        with open(fNameLandmarks, 'r') as fd:
-            lm = json.load(fd)
-        lm = np.array([l[0] for l in lm], dtype = int).squeeze()[:, :3]
+        lm = landmarks[frame]
         lmConf = lm[m.targetLMInd, -1]  # This is the confidence value of the landmarks
         lm = lm[m.targetLMInd, :2]
         
-        # Load the source video frame and convert to 64-bit float
-        img = io.imread(fNameImgOrig)
-        img = img_as_float(img)
+        img = frameData['img']
         
         # You can plot the landmarks over the frames if you want
 #        plt.figure()
@@ -87,21 +96,14 @@ if __name__ == "__main__":
             texCoef = np.zeros(m.numTex)
             param = np.r_[np.zeros(m.numId + m.numExp + 6), 1]
         
-        # Get the vertex values of the 3DMM landmarks
-        lm3D = generateFace(param, m, ind = m.sourceLMInd).T
-        
-        # Estimate the camera projection matrix from the landmark correspondences
-        camMat = estimateCamMat(lm, lm3D, 'orthographic')
-        
-        # Factor the camera projection matrix into the intrinsic camera parameters and the rotation/translation similarity transform parameters
-        s, angles, t = splitCamMat(camMat, 'orthographic')
+        # The camera parameters for this frame were estimated before the loop
+        s, angles, t = camScale[frame - 1], camAngles[frame - 1], camTrans[frame - 1]
         
         # Concatenate parameters for input into optimization routine. Note that the translation vector here is only (2,) for x and y (no z)
         param = np.r_[idCoef, expCoef, angles, t, s]
         
-        # Initial optimization of shape parameters with similarity transform parameters
-        initFit = minimize(opt.initialShapeCost, param, args = (lm, m, (wLan, wReg)), jac = opt.initialShapeGrad)
-        param = initFit.x
+        # Initial fit of shape parameters with similarity transform parameters, alternating between the shape coefficients and the camera
+        param = opt.initialShapeFit(lm, m, (wLan, wReg), param)
         idCoef = param[:m.numId]
         expCoef = param[m.numId: m.numId+m.numExp]
         
@@ -119,10 +121,11 @@ if __name__ == "__main__":
 #        plt.scatter(vertexCoords[0, m.sourceLMInd], vertexCoords[1, m.sourceLMInd], s = 3, c = 'b')
 #        plt.scatter(lm[:, 0], lm[:, 1], s = 2, c = 'r')
         
-        # Rendering of initial 3DMM shape with mean texture model
+        # Rendering of initial 3DMM shape with mean texture model. Only a box around the face landmarks is rendered, which is much smaller than the frame.
         texture = m.texMean
         meshData = np.r_[vertexCoords.T, texture.T]
-        renderObj = Render(img.shape[1], img.shape[0], meshData, m.face)
+        roi = opt.faceBoundingBox(lm, img.shape[1], img.shape[0])
+        renderObj = getRender(img.shape[1], img.shape[0], meshData, m.face, indexed = True, roi = roi, backend = renderBackend)
         renderObj.render()
         
         # Grab the OpenGL rendering from the video card
@@ -135,71 +138,34 @@ if __name__ == "__main__":
         # Using the barycentric parameters from the rendering, we can reconstruct the image with the 3DMM texture model by taking barycentric combinations of the 3DMM RGB values defined at the vertices
         imgReconstruction = barycentricReconstruction(texture, pixelFaces, pixelBarycentricCoords, m.face)
         
-        # Put values from the reconstruction into a (height, width, 3) array for plotting
+        # Put values from the reconstruction into a (height, width, 3) array of the rendered region for plotting
         reconstruction = np.zeros(rendering.shape)
-        reconstruction[pixelCoord[:, 0], pixelCoord[:, 1], :] = imgReconstruction
+        reconstruction[pixelCoord[:, 0] - renderObj.yOffset, pixelCoord[:, 1] - renderObj.xOffset, :] = imgReconstruction
         
         # Plot the difference of the reconstruction with the rendering to see that they are very close-- the output values should be close to 0
         plt.figure()
         plt.imshow(np.fabs(reconstruction - rendering))
         
         """
-        Get initial texture parameter guess
+        Get initial texture and spherical harmonic lighting parameter guess
         """
         
         # Set the number of faces for stochastic optimization
         numRandomFaces = 10000
         
-        # Do some cycles of nonlinear least squares iterations, using a new set of random faces each time for the optimization objective
-        cost = np.zeros(20)
-        for i in range(20):
-            randomFaces = np.random.randint(0, pixelFaces.size, numRandomFaces)
-            initTex = least_squares(opt.textureResiduals, texCoef, jac = opt.textureJacobian, args = (img, vertexCoords, m, renderObj, (wCol, wReg), randomFaces), loss = 'soft_l1')
-            texCoef = initTex['x']
-            cost[i] = initTex.cost
-        
-        # Generate the texture at the 3DMM vertices from the learned texture coefficients
-        texture = m.texMean + np.tensordot(m.texEvec, texCoef, axes = 1)
-        
-        # Update the rendering and plot
-        renderObj.updateVertexBuffer(np.r_[vertexCoords.T, texture.T])
-        renderObj.resetFramebufferObject()
-        renderObj.render()
-        rendering, pixelCoord, pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True)
-        
-        plt.figure()
-        plt.imshow(rendering)
-        
-        """
-        Get initial spherical harmonic lighting parameter guess
-        """
-        
         # Calculate normals at each vertex in the 3DMM
         vertexNorms = calcNormals(vertexCoords, m)
         
-        # Evaluate spherical harmonics at face shape normals. The result is a (numVertices, 9) array where each column is a spherical harmonic basis for the 3DMM.
+        # Evaluate spherical harmonics at face shape normals. The result is a (9, numVertices) array where each row is a spherical harmonic basis for the 3DMM.
         B = sh9(vertexNorms[:, 0], vertexNorms[:, 1], vertexNorms[:, 2])
         
-        # Get the pixel RGB values of the original image where the 3DMM face is rendered
-        imgMasked = img[pixelCoord[:, 0], pixelCoord[:, 1]]
-        
-        # Initialize an array to store the barycentric reconstruction of the nine spherical harmonics. The first dimension indicates the color (RGB).
-        I = np.empty((3, pixelFaces.size, 9))
-        
-        # Initialize an array to store the spherical harmonic lighting coefficients. There are nine coefficients per color channel.
-        shCoef = np.empty((9, 3))
-        
-        # Loop through each color channel
-        for c in range(3):
-            # 
-            I[c, ...] = barycentricReconstruction(B * texture[c, :], pixelFaces, pixelBarycentricCoords, m.face)
-            
-            # Make an initial guess of the spherical harmonic lighting coefficients with least squares. We are solving Ax = b, where A is the (numFaces, 9) array of the barycentric reconstruction of the spherical harmonic bases, x is the (9,) vector of coefficients, and b is the (numFaces,) vector of the pixels from the original image where the 3DMM is defined.
-#            shCoef[:, c] = nnls(I[c, ...], imgMasked[:, c])[0]
-            shCoef[:, c] = lsq_linear(I[c, ...], imgMasked[:, c]).x
+        # With the geometry fixed, the rendering is linear in the texture coefficients given the lighting and vice versa, so we alternate between the two closed-form solves from a single rendering of the 3DMM. The solves only use a sample of the pixels that are stratified over the triangular faces, which is drawn from the rendering above since it has the same geometry.
+        randomFaces, pixelWeights = opt.PixelSampler(numRandomFaces, 'face').sample(pixelFaces)
+        texParam = opt.textureLightingAlternating(img, vertexCoords, B, m, renderObj, texCoef, (wCol, wReg), randomFaces = randomFaces, pixelWeights = pixelWeights)
+        texCoef = texParam[:m.numTex]
+        shCoef = texParam[m.numTex:].reshape(9, 3)
         
-        # Concatenate the texture coefficients with the spherical harmonic coefficients and use a helper function to generate the RGB values at each vertex on the 3DMM
-        texParam = np.r_[texCoef, shCoef.flatten()]
+        # Use a helper function to generate the RGB values at each vertex on the 3DMM with the texture and lighting coefficients
         textureWithLighting = generateTexture(vertexCoords, texParam, m)
         
         # Render the 3DMM with the initial guesses for texture and lighting
@@ -210,7 +176,6 @@ if __name__ == "__main__":
         
         plt.figure()
         plt.imshow(rendering)
-        break
         
         """
         Optimization simultaneously over the texture and lighting parameters
@@ -218,14 +183,23 @@ if __name__ == "__main__":
         texParam2 = texParam.copy()
         
 #        check_grad(opt.textureLightingCost, opt.textureLightingGrad, texParam, img, vertexCoords, B, m, renderObj)
+#        checkJacobian(opt.textureLightingResiduals, opt.textureLightingJacobian, texParam, img, vertexCoords, B, m, renderObj)
         
-        # Jointly optimize the texture and spherical harmonic lighting coefficients
+        # Jointly optimize the texture and spherical harmonic lighting coefficients on mini-batches of pixels that are stratified over the triangular faces and sampled without replacement. The mini-batches grow as the cost stops decreasing.
+        sampler = opt.PixelSampler(numRandomFaces, 'face', maxSamples = pixelFaces.size)
+        texLightControl.reset()
         cost = np.zeros(10)
         for i in range(10):
-            randomFaces = np.random.randint(0, pixelFaces.size, numRandomFaces)
-            initTexLight = least_squares(opt.textureLightingResiduals, texParam2, jac = opt.textureLightingJacobian, args = (img, vertexCoords, B, m, renderObj, (1, 1), randomFaces), loss = 'soft_l1', max_nfev = 100)
+            numSamples = sampler.numSamples
+            randomFaces, pixelWeights = sampler.sample(pixelFaces)
+            initTexLight = texLightControl.leastSquares(opt.textureLightingResiduals, texParam2, opt.textureLightingJacobian, args = (img, vertexCoords, B, m, renderObj, (1, 1), randomFaces, pixelWeights), loss = 'soft_l1', tr_solver = 'lsmr')
             texParam2 = initTexLight['x']
             cost[i] = initTexLight.cost
+            sampler.update(cost[i])
+            
+            # The costs are normalized by the mini-batch size, so they are only compared between the fits on the full-size mini-batches, and the loop stops when these stop decreasing
+            if numSamples == sampler.maxSamples and texLightControl.converged(cost[i]):
+                break
             
         texCoef = texParam[:m.numTex]
         lightCoef = texParam[m.numTex:].reshape(9, 3)
@@ -244,5 +218,25 @@ if __name__ == "__main__":
         '''
         Optimization over shape, texture, and lighting
         '''
-        # Need to do
-        break
\ No newline at end of file
+        # Jointly optimize the shape, pose, texture, and lighting parameters against the image and the landmarks. The shape and pose derivatives chain the image gradients at the rendered pixels through their barycentric coordinates, so each iteration only needs one rendering. Most of the iterations are run on the coarse levels of an image pyramid.
+        shapeTexParam = opt.coarseToFineFit(np.r_[param, texParam2], img, lm, B, m, renderObj, (wCol, wLan, wReg), maxNfev = (40, 20, 10), numRandomPixels = numRandomFaces)
+        
+        param = shapeTexParam[:m.numId + m.numExp + 6]
+        idCoef = param[:m.numId]
+        expCoef = param[m.numId: m.numId + m.numExp]
+        texParam = shapeTexParam[m.numId + m.numExp + 6:]
+        texCoef = texParam[:m.numTex]
+        
+        # Render the 3DMM with the jointly fitted parameters
+        vertexCoords = generateFace(np.r_[param[:-1], 0, param[-1]], m)
+        texture = generateTexture(vertexCoords, texParam, m)
+        renderObj.updateVertexBuffer(np.r_[vertexCoords.T, texture.T])
+        renderObj.resetFramebufferObject()
+        renderObj.render()
+        rendering = renderObj.grabRendering()
+        
+        plt.figure()
+        plt.imshow(rendering)
+        break
+    
+    frameSource.close()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from mm.utils.io import ingestLandmarks
+
+import argparse
+import numpy as np
+
+if __name__ == "__main__":
+    
+    # The directory of per-frame OpenPose .json landmark files, and the filename of the landmark store to create from it, e.g., 'landmark' and 'landmark' for the 'landmark/' directory in the data folder of a video
+    parser = argparse.ArgumentParser(description = 'Convert a directory of per-frame OpenPose .json landmark files into a single memory-mapped landmark store.')
+    parser.add_argument('landmarkDir', help = 'directory of the .json landmark files')
+    parser.add_argument('fNameOut', help = 'filename of the landmark store, without the .npy extension')
+    parser.add_argument('--numLandmarks', type = int, default = 70, help = 'number of landmarks per frame')
+    args = parser.parse_args()
+    
+    store = ingestLandmarks(args.landmarkDir, args.fNameOut, args.numLandmarks)
+    
+    # Report the frames that were ingested, and how many of them have no face detected by OpenPose
+    numMissing = np.sum(np.all(store.landmarks[..., 2] == 0, axis = 1))
+    print('Stored the landmarks for {} frames ({} to {}) in {}.npy, {} of them without a face.'.format(len(store), store.frames.min(), store.frames.max(), args.fNameOut, numMissing))
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from mm.utils.mesh import generateFace
 from mm.utils.transform import rotMat2angle
-from mm.utils.io import importObj, speechProc
+from mm.utils.io import speechProc
 from mm.models import MeshModel
 
 import os
@@ -100,15 +100,15 @@ if __name__ == "__main__":
     obsLabels_siro = gmmObs.predict(siroAudioVec.T)
     obsLabels_kuro = gmmObs.predict(kuroAudioVec.T)
     
-    # Cluster the mouth vertices from the 3DMMs fitted to the video
-    mouthFace = importObj('mouth.obj', dataToImport = ['f'])[0]
-    mouthIdx = np.load('../../models/bfmMouthIdx.npy')
-#    mouthVertices = np.zeros((numFramesSiro, mouthIdx.size, 3))
-#    for i in range(numFramesSiro):
-#        fName = '{:0>5}'.format(i + 1)
-#        mouthVertices[i, :] = importObj('shapes/' + fName + '.obj', dataToImport = ['v'])[0][mouthIdx, :].flatten()
+    # Load 3DMM and the 3DMM parameters for the siro video
+    m = MeshModel('../../models/bfm2017.npz')
+    param = np.load('paramRTS2Orig.npy')
     
-    mouthVertices = np.load('mouthVertices.npy')
+    # Cluster the mouth vertices from the 3DMMs fitted to the video, which are synthesized with the 3DMM of the mouth region rather than sliced from meshes of the whole head, with the x, y, z coordinates of each vertex next to each other
+    mouthIdx = np.load('../../models/bfmMouthIdx.npy')
+    mouth = m.submodel(mouthIdx)
+    mouthFace = mouth.face + 1
+    mouthVertices = np.array([generateFace(np.r_[param[i, :m.numId + m.numExp], np.zeros(6), 1], mouth).flatten(order = 'F') for i in range(numFramesSiro)])
     
     N = 100
     kShapes = KMeans(n_clusters = N)
@@ -130,9 +130,6 @@ if __name__ == "__main__":
         
     
     # Find and cluster the features of the video in model-space
-    m = MeshModel('../../models/bfm2017.npz')
-    
-    param = np.load('paramRTS2Orig.npy')
 #    
 #    N = 150
 #    X = param[:, 80: -7]
@@ -282,9 +279,9 @@ if __name__ == "__main__":
     # Animations
     s = stateShapes.reshape((N, 3, mouthIdx.size), order = 'F')
     v = mouthVertices.reshape((numFramesSiro, 3, mouthIdx.size), order = 'F')
-    animate(v[:240], mouthFace, 'color/1_origSiroFrames', m.texMean[:, mouthIdx])
-    animate(s[stateLabels[:240]], mouthFace, 'color/2_siroKmeansStateSeq', m.texMean[:, mouthIdx])
-    animate(s[stateSeq_siro[:240]], mouthFace, 'color/3_siroHMMStateSeq', m.texMean[:, mouthIdx])
-    animate(s[stateSeq_kuro[:240]], mouthFace, 'color/4_kuroHMMStateSeq', m.texMean[:, mouthIdx])
-    animate(v[selectedFrames[:240]], mouthFace, 'color/5_closestFramesToKuroFromSiroViaRTS', m.texMean[:, mouthIdx])
-    animate(v[frames[:240]], mouthFace, 'color/6_closestFramesToKuroFromSiroViaHMM', m.texMean[:, mouthIdx])
\ No newline at end of file
+    animate(v[:240], mouthFace, 'color/1_origSiroFrames', mouth.texMean)
+    animate(s[stateLabels[:240]], mouthFace, 'color/2_siroKmeansStateSeq', mouth.texMean)
+    animate(s[stateSeq_siro[:240]], mouthFace, 'color/3_siroHMMStateSeq', mouth.texMean)
+    animate(s[stateSeq_kuro[:240]], mouthFace, 'color/4_kuroHMMStateSeq', mouth.texMean)
+    animate(v[selectedFrames[:240]], mouthFace, 'color/5_closestFramesToKuroFromSiroViaRTS', mouth.texMean)
+    animate(v[frames[:240]], mouthFace, 'color/6_closestFramesToKuroFromSiroViaHMM', mouth.texMean)
\ No newline at end of file
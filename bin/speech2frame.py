@@ -2,11 +2,11 @@
 # -*- coding: utf-8 -*-
 from mm.utils.mesh import generateFace
 from mm.utils.transform import rotMat2angle
-from mm.utils.io import importObj, speechProc
+from mm.utils.io import speechProc, LandmarkStore
 from mm.models import MeshModel
 from mm.utils.visualize import animate
 
-import glob, os, json
+import glob, os
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import StandardScaler
@@ -46,11 +46,9 @@ if __name__ == "__main__":
     for i in range(numFramesSiro):
         R[i, ...] = rotMat2angle(angles[i, :])
     
-    # Load OpenPose 2D landmarks for the siro video
-    lm = np.empty((numFramesSiro, 70, 2))
-    for i in range(numFramesSiro):
-        with open('landmark/' + '{:0>5}'.format(i+1) + '.json', 'r') as fd:
-            lm[i, ...] = np.array([l[0] for l in json.load(fd)], dtype = int).squeeze()[:, :2]
+    # Load OpenPose 2D landmarks for the siro video from the landmark store made with bin/landmark2store.py
+    landmarks = LandmarkStore('landmark')
+    lm = landmarks.take(np.arange(1, numFramesSiro + 1))[..., :2]
     
     # These pairs of OpenPose landmark indices correspond to certain features that we want to measure, such as the distance between the lower and upper lips, eyelids, etc.
     targetLMPairs = np.array([[42, 47], [43, 46], [44, 45], [30, 36], [42, 45], [44, 47], [25, 29], [26, 28], [19, 23], [20, 22]])
@@ -61,10 +59,11 @@ if __name__ == "__main__":
     # Get the unique landmarks in these landmark pairs
     uniqueSourceLM, uniqueInv = np.unique(sourceLMPairs, return_inverse = True)
     
-    # Load mouth region from 3DMM for animation
+    # Extract the 3DMM of the mouth region for animation, and synthesize the mouth vertices of the shiro video frames without the similarity transform
     mouthIdx = np.load('../../models/bfmMouthIdx.npy')
-    mouthVertices = np.load('mouthVertices.npy')
-    mouthFace = importObj('mouth.obj', dataToImport = ['f'])
+    mouth = m.submodel(mouthIdx)
+    mouthVertices = np.array([generateFace(np.r_[param[t, :m.numId + m.numExp], np.zeros(6), 1], mouth) for t in range(numFramesSiro)])
+    mouthFace = mouth.face + 1
     
     """
     Loop through the kuro (target) audio files of interest and find the shortest path sequence of shiro video frames to reenact the target audio file
@@ -128,6 +127,5 @@ if __name__ == "__main__":
 #        np.save('graphOptPath/' + os.path.splitext(os.path.basename(fNameKuro))[0], optPath)
         
         # Animate the reenactment and save
-        v = mouthVertices.reshape((numFramesSiro, 3, mouthIdx.size), order = 'F')
-        animate(v[optPath], mouthFace, 'temp/' + os.path.splitext(os.path.basename(fNameKuro))[0], m.texMean[:, mouthIdx])
+        animate(mouthVertices[optPath], mouthFace, 'temp/' + os.path.splitext(os.path.basename(fNameKuro))[0], mouth.texMean)
         break
\ No newline at end of file
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from mm.models import MeshModel
+from mm.utils.mesh import generateFace, basisDot, basisTransposeDot
+from mm.optimize.depth import initialShapeFit
+
+import argparse
+import copy
+import sys
+import numpy as np
+
+def evecBytes(model):
+    return sum(getattr(model, basis + 'Evec').nbytes for basis in ('id', 'exp', 'tex') if hasattr(model, basis + 'Evec'))
+
+if __name__ == "__main__":
+    
+    # Quantize a 3DMM with MeshModel.quantize and compare it to the float 3DMM on random faces drawn from the 3DMM, on the gradients of the fits, and on landmark fits to these faces
+    parser = argparse.ArgumentParser(description = 'Report the memory savings and the reconstruction error of a quantized 3DMM against the float 3DMM.')
+    parser.add_argument('modelFile', help = 'filename of the .npz 3DMM, e.g., models/bfm2017.npz')
+    parser.add_argument('--dtype', choices = ['int16', 'int8'], nargs = '+', default = ['int16', 'int8'], help = 'integer types to quantize to')
+    parser.add_argument('--numSamples', type = int, default = 20, help = 'number of random faces')
+    parser.add_argument('--tol', type = float, default = 1e-2, help = 'largest acceptable relative error of the random faces, textures, and gradients')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the random faces')
+    args = parser.parse_args()
+    
+    m = MeshModel(args.modelFile)
+    bases = [basis for basis in ('id', 'exp', 'tex') if hasattr(m, basis + 'Evec')]
+    
+    # Random coefficients with the variances of the eigenvalues, with the identity similarity transform, and random residuals for the gradients
+    rng = np.random.default_rng(args.seed)
+    coefs = {basis: rng.standard_normal((args.numSamples, getattr(m, basis + 'Eval').size)) * np.sqrt(getattr(m, basis + 'Eval')) for basis in bases}
+    pose = np.r_[np.zeros(6), 1]
+    residuals = rng.standard_normal((args.numSamples, 3, m.numVertices))
+    
+    print('Float eigenvectors: %.1f MB' % (evecBytes(m) / 2**20))
+    
+    failed = False
+    for dtype in args.dtype:
+        q = copy.copy(m)
+        q.quantize(getattr(np, dtype), bases)
+        
+        print('\n%s eigenvectors: %.1f MB, %.1f times smaller' % (dtype, evecBytes(q) / 2**20, evecBytes(m) / evecBytes(q)))
+        
+        errors = []
+        for basis in bases:
+            print('    %s eigenvectors: relative Frobenius error %.2e' % (basis, getattr(q, basis + 'Basis').error))
+            
+            # Relative errors of the linear combinations of the eigenvectors and of the gradients with respect to their coefficients
+            combinationError = max(np.linalg.norm(basisDot(q, basis, coef) - basisDot(m, basis, coef)) / np.linalg.norm(basisDot(m, basis, coef)) for coef in coefs[basis])
+            gradError = max(np.linalg.norm(basisTransposeDot(q, basis, r) - basisTransposeDot(m, basis, r)) / np.linalg.norm(basisTransposeDot(m, basis, r)) for r in residuals)
+            errors += [combinationError, gradError]
+            print('    %s eigenvectors: largest relative error of the random combinations %.2e and of the gradients %.2e' % (basis, combinationError, gradError))
+        
+        # Vertex errors of the random faces, in the units of the 3DMM
+        vertexErrors = np.array([np.linalg.norm(generateFace(np.r_[idCoef, expCoef, pose], q) - generateFace(np.r_[idCoef, expCoef, pose], m), axis = 0) for idCoef, expCoef in zip(coefs['id'], coefs['exp'])])
+        print('    Faces: RMS vertex error %.2e, largest vertex error %.2e' % (np.sqrt(np.mean(vertexErrors ** 2)), vertexErrors.max()))
+        
+        # Fit the landmarks of the random faces with both 3DMMs, and compare the landmark errors and the fitted faces
+        if hasattr(m, 'sourceLMInd'):
+            lmErrors = []
+            fitErrors = []
+            for idCoef, expCoef in zip(coefs['id'], coefs['exp']):
+                target = generateFace(np.r_[idCoef, expCoef, pose], m, ind = m.sourceLMInd).T
+                paramFloat = initialShapeFit(target, m)
+                paramQuantized = initialShapeFit(target, q)
+                
+                lmErrors.append([np.sqrt(np.mean(np.sum((generateFace(param, model, ind = m.sourceLMInd).T - target) ** 2, axis = 1))) for param, model in ((paramFloat, m), (paramQuantized, q))])
+                fitErrors.append(np.sqrt(np.mean(np.sum((generateFace(paramQuantized, m) - generateFace(paramFloat, m)) ** 2, axis = 0))))
+            
+            lmErrors = np.mean(lmErrors, axis = 0)
+            print('    Landmark fits: mean RMS landmark error %.4g with the float 3DMM and %.4g with the quantized 3DMM, mean RMS vertex difference of the fitted faces %.2e' % (lmErrors[0], lmErrors[1], np.mean(fitErrors)))
+        
+        if max(errors) > args.tol:
+            failed = True
+            print('    The largest relative error %.2e is above the tolerance %.2e' % (max(errors), args.tol))
+    
+    sys.exit(1 if failed else 0)
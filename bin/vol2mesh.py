@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from mm.models import MeshModel
-from mm.utils.io import exportObj
+from mm.utils.io import exportObj, FrameSource, LandmarkStore, loadImage, loadVolume
 from mm.optimize.camera import initialRegistration
 import mm.optimize.depth as opt
+from mm.optimize.convergence import ConvergenceControl, progressiveRankFit
 from mm.utils.mesh import generateFace
+from mm.track import KeyframeSchedule
 
-import os, json
+import os
 import numpy as np
 from scipy.interpolate import interpn
-from scipy.optimize import minimize, check_grad, least_squares
+from scipy.optimize import check_grad
 from sklearn.neighbors import NearestNeighbors
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 from mpl_toolkits.mplot3d import Axes3D
 from pylab import savefig
 
@@ -27,6 +28,9 @@ if __name__ == "__main__":
     # Load 3DMM
     m = MeshModel('../../models/bfm2017.npz')
     
+    # The facial expression eigenvectors are close to 0 over the back of the head, the neck, and the ears, so only keep them where they are not, within a relative error of 1e-3
+    m.sparsify(1e-3, ('exp',))
+    
     # While looping through each frame in the video to fit the 3DMM, you might want to generate and save some matplotlib figures. In that case, uncomment the 'plt.ioff()' line to turn off interactive plotting so that the figure windows remain hidden. If you want to see the figure windows to debug code, then remember to set 'plt.ion()'.
 #    plt.ion()
 #    plt.ioff()
@@ -42,6 +46,16 @@ if __name__ == "__main__":
     wLan = 50
     wReg = 1
     
+    # Whether to fit the keyframes with a growing number of eigenvectors
+    progressiveRank = True
+    
+    # Set this to True to stop after the first fitted frame and plot the fitted 3DMM over the original image
+    debug = False
+    
+    # Stopping criteria for the shape fits of the keyframes and of the frames in between them, which are warm-started from interpolated parameters and only refined. The number of evaluations that each frame used is printed.
+    keyframeControl = ConvergenceControl(ftol = 1e-6, gtol = 1e-4, xtol = 1e-5, maxIter = 40, name = 'keyframe', verbose = True)
+    refineControl = ConvergenceControl(ftol = 1e-5, gtol = 1e-3, xtol = 1e-4, maxIter = 10, name = 'in-between', verbose = True)
+    
     # It is very important that you save the 'crop.tmp' file from the VRN fitting because we use it to find the correspondence between the original images and the cropped and scaled images produced by VRN
     with open('crop.tmp', 'r') as fd:
         crop = []
@@ -49,8 +63,20 @@ if __name__ == "__main__":
             crop.append([float(x) for x in l.split(' ')[1:]])
     crop = np.array(crop)
     
+    # The OpenPose landmarks for all frames in the original video, which are ingested from the per-frame .json files with bin/landmark2store.py
+    landmarks = LandmarkStore('landmark')
+    
+    # Most frames of a talking-head video barely move, so only fully fit keyframes chosen by how far the landmarks moved. Static frames reuse the parameters of the previous fitted frame and are not loaded, and the frames in between keyframes are initialized by interpolating the keyframes and only refined. The keyframes are fitted first.
+    schedule = KeyframeSchedule(landmarks.take(np.arange(1, numFrames + 1), fill = 0)[..., :2], np.arange(1, numFrames + 1))
+    
+    # The original and VRN cropped and scaled images and the volume files produced by VRN for each frame are loaded in background threads while the current frame is fitted
+    frameSource = FrameSource(schedule.order, {'imgOrig': ('orig/{:0>5}.png', loadImage), 'imgScaled': ('scaled/{:0>5}.png', loadImage), 'vol': ('volume/{:0>5}.raw', loadVolume)})
+    
+    # The 3DMM shape identity parameters of the speaker are learned on the first 20 keyframes, which are fitted before any of the frames in between them
+    idFrames = schedule.keyframes[:20]
+    
     # Loop through each frame in the video
-    for frame in np.arange(1, numFrames + 1):
+    for frame, frameData in frameSource:
         print(frame)
         
         """
@@ -58,34 +84,13 @@ if __name__ == "__main__":
         """
         fName = '{:0>5}'.format(frame)
         
-        # The VRN cropped and scaled images
-        fNameImgScaled = 'scaled/' + fName + '.png'
-        
-        # The images/frames from the original video
-        fNameImgOrig = 'orig/' + fName + '.png'
-        
-        # The volume files produced by VRN
-        fNameVol = 'volume/' + fName + '.raw'
-        
-        # The OpenPose landmarks for each frame from the original video
-        fNameLandmarks = 'landmark/' + fName + '.json'
-        
-        # Read the landmarks generated by OpenPose (it will be the .json condition)
-        if fNameLandmarks.endswith('.txt'):
-            with open(fNameLandmarks, 'r') as fd:
-                lm = []
-                for l in fd:
-                    lm.append([int(coord) for coord in l.split(',')])
-            lm = np.array(lm)
-        elif fNameLandmarks.endswith('.json'):
-            with open(fNameLandmarks, 'r') as fd:
-                lm = json.load(fd)
-            lm = np.array([l[0] for l in lm], dtype = int).squeeze()[:, :3]
-            lmConf = lm[:, -1]  # This is the confidence value of the landmarks
-            lm = lm[:, :2]
-            
+        # The landmarks generated by OpenPose, with the confidence value of each landmark in the last column
+        lm = landmarks[frame]
+        lmConf = lm[:, -1]
+        lm = lm[:, :2]
+        
         # Load the original image, and you can choose to plot the OpenPose landmarks over the image
-        imgOrig = mpimg.imread(fNameImgOrig)
+        imgOrig = frameData['imgOrig']
 #        plt.figure()
 #        plt.imshow(imgOrig)
 #        plt.scatter(lm[:, 0], lm[:, 1], s = 2)
@@ -124,7 +129,7 @@ if __name__ == "__main__":
 #        np.save('landmarks_scaled/' + fName, lmScaled)
         
         # You can plot these scaled landmarks too
-        imgScaled = mpimg.imread(fNameImgScaled)
+        imgScaled = frameData['imgScaled']
 #        fig, ax = plt.subplots()
 #        plt.imshow(imgScaled)
 #        plt.hold(True)
@@ -148,8 +153,7 @@ if __name__ == "__main__":
         '''
         
         # Import volume generated by VRN
-        vol = np.fromfile(fNameVol, dtype = np.int8)
-        vol = vol.reshape((200, 192, 192))
+        vol = frameData['vol']
         
         # Take the max values of volume as the depth map and rescale the z-axis by 1/2
         depth = np.argmax(vol[::-1, :, :] > 0, axis = 0) / 2
@@ -188,9 +192,8 @@ if __name__ == "__main__":
             # Initialize the parameters: the shape coefficients are all 0, and we concatenate the similarity transform parameters at the end
             P = np.r_[np.zeros(m.numId + m.numExp), rho]
             
-            # Find initial guess of shape coefficients while simulataneously optimizing the similarity transform paramters
-            initFit = minimize(opt.initialShapeCost, P, args = (targetLandmarks, m, (wLan, wReg)), jac = opt.initialShapeGrad)
-            P = initFit.x
+            # Find initial guess of shape coefficients while simulataneously optimizing the similarity transform paramters, alternating between closed-form solutions for each
+            P = opt.initialShapeFit(targetLandmarks, m, (wLan, wReg), P)
             
             # You can use check_grad from scipy.optimize to make sure your analytical gradient is close to the numerical gradient
 #            grad = check_grad(initialShapeCost, initialShapeGrad, P, targetLandmarks, m)
@@ -201,8 +204,14 @@ if __name__ == "__main__":
 #            plt.imshow(imgScaled)
 #            plt.scatter(source[0, m.sourceLMInd], source[1, m.sourceLMInd], s = 1)
         
-        # For the following frames in the video, only do initial registration of similarity transform parameters
+        # For the following keyframes in the video, only do initial registration of similarity transform parameters
+        elif schedule.isKeyframe[frame - 1]:
+            P[-7:] = initialRegistration(generateFace(np.r_[P[:m.numId + m.numExp], np.zeros(6), 1], m, ind = m.sourceLMInd), targetLandmarks)
+        
+        # For the frames in between keyframes, interpolate the shape parameters of the keyframes on either side, but take the learned shape identity parameters, which the keyframes that were fitted while learning them do not all share. The similarity transforms are for the VRN crops of each frame, which move between frames, so they are registered again.
         else:
+            P = schedule.interpolate(frame, param)
+            P[:m.numId] = param[idFrames[-1] - 1, :m.numId]
             P[-7:] = initialRegistration(generateFace(np.r_[P[:m.numId + m.numExp], np.zeros(6), 1], m, ind = m.sourceLMInd), targetLandmarks)
         
         '''
@@ -217,14 +226,24 @@ if __name__ == "__main__":
         
 #        grad = check_grad(shapeCost, shapeGrad, P, m, target, targetLandmarks, NN, False)
         
-        # For the first 20 frames, we learn the 3DMM shape identity parameters of the speaker in the video along with all the other parameters (this is set by the last the 'True' boolean argument)
-        if frame <= 20:
-            optFit = minimize(opt.shapeCost, P, args = (m, target, targetLandmarks, NN, (wVer, wLan, wReg), True), jac = opt.shapeGrad, options = {'maxiter': 40})
-            P = optFit['x']
+        # Keyframes get a full fit, and the interpolated frames in between them are only refined
+        control = keyframeControl if schedule.isKeyframe[frame - 1] else refineControl
+        
+        # For the first 20 keyframes, we learn the 3DMM shape identity parameters of the speaker in the video along with all the other parameters (this is set by the 'calcID' boolean argument). After them, we assume the shape identity parameters will be the same, so we can exclude them from the optimization to save time.
+        calcID = frame in idFrames
+        
+        # The keyframes are fitted with a growing number of eigenvectors, starting from the ones with the highest eigenvalues, until adding more of them stops improving the cost. The shape identity eigenvectors are all kept once the identity is fixed.
+        if progressiveRank and schedule.isKeyframe[frame - 1]:
+            def fit(subModel, subP):
+                optFit = control.minimize(opt.shapeCost, subP, opt.shapeGrad, args = (subModel, target, targetLandmarks, NN, (wVer, wLan, wReg), calcID))
+                return optFit['x'], optFit['fun']
+            
+            ranks = ((20, 10, None), (40, 30, None), (None, None, None)) if calcID else ((None, 10, None), (None, 30, None), (None, None, None))
+            P, rank = progressiveRankFit(fit, m, P, 7, ranks)[:2]
+            print('Rank reached: %d identity, %d expression eigenvectors' % rank[:2])
         
-        # After the first 20 frames, we assume the shape identity parameters will be the same, so we can exclude them from the optimization to save time (note that the 'True' argument is now 'False')
         else:
-            optFit = minimize(opt.shapeCost, P, args = (m, target, targetLandmarks, NN, (wVer, wLan, wReg), False), jac = opt.shapeGrad, options = {'maxiter': 40})
+            optFit = control.minimize(opt.shapeCost, P, opt.shapeGrad, args = (m, target, targetLandmarks, NN, (wVer, wLan, wReg), calcID))
             P = optFit['x']
         
         # You can generate the vertices with a set of parameters and the model
@@ -268,16 +287,24 @@ if __name__ == "__main__":
         elif (cropCorner < 0).any() and ((192 + cropCorner) > scaledImgDim).any():
             TS2orig[frame - 1, :2] = (P[-4: -2] + cropCorner * (cropCorner > 0) - (192 - (scaledImgDim - cropCorner * (cropCorner > 0))) / 2) / scale
         
-        # You can now plot the 3DMM over the original image
-        source = generateFace(np.r_[P[:m.numId + m.numExp + 3], TS2orig[frame - 1, :]], m)
-        plt.figure()
-        plt.imshow(imgOrig)
-        plt.scatter(source[0, :], source[1, :], s = 1)
-        
-        plt.figure()
-        plt.imshow(imgOrig)
-        plt.scatter(source[0, m.sourceLMInd], source[1, m.sourceLMInd], s = 1)
-        break
+        # When debugging, you can now plot the 3DMM over the original image
+        if debug:
+            source = generateFace(np.r_[P[:m.numId + m.numExp + 3], TS2orig[frame - 1, :]], m)
+            plt.figure()
+            plt.imshow(imgOrig)
+            plt.scatter(source[0, :], source[1, :], s = 1)
+            
+            plt.figure()
+            plt.imshow(imgOrig)
+            plt.scatter(source[0, m.sourceLMInd], source[1, m.sourceLMInd], s = 1)
+            break
+    
+    frameSource.close()
+    print('%d cost evaluations for %d keyframe fits, %d for %d in-between fits' % (keyframeControl.numEvals, len(keyframeControl.history), refineControl.numEvals, len(refineControl.history)))
+    
+    # Copy the parameters of the fitted frames to the static frames
+    param = schedule.fill(param)
+    TS2orig = schedule.fill(TS2orig)
 
     """
     At the end of the loop, save the learned 3DMM parameters
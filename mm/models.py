@@ -2,6 +2,224 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import os
+import copy
+
+class SparseBasis:
+    """Eigenvectors of a 3DMM stored only at the vertices where they are not negligible, e.g., the facial expression eigenvectors, which are close to 0 over the back of the head, the neck, and the ears.
+    
+    The vertices are dropped in order of increasing energy (the sum of squares of their rows of the eigenvectors) for as long as the relative Frobenius norm of the dropped part stays within ``tol``, so the reconstruction error of any combination of the eigenvectors is bounded by ``tol`` times the norm of its coefficients weighted by the eigenvectors.
+    
+    Args:
+        evec (ndarray): Eigenvectors, (3, numVertices, numEvecs)
+        tol (float): Relative Frobenius norm of the eigenvectors at the dropped vertices
+    
+    Attributes:
+        evec (ndarray): Eigenvectors at the kept vertices, (3, numKept, numEvecs)
+        vertices (ndarray): Indices of the kept vertices, in increasing order, (numKept,)
+        position (ndarray): Position of each vertex in ``vertices``, or -1 if the vertex was dropped, (numVertices,)
+        numVertices (int): Number of vertices in the 3DMM
+        numEvecs (int): Number of eigenvectors
+        error (float): Relative Frobenius norm of the eigenvectors at the dropped vertices
+    """
+    def __init__(self, evec, tol = 1e-3):
+        self.numVertices = evec.shape[1]
+        self.numEvecs = evec.shape[2]
+        
+        # Drop the vertices with the lowest energies while their total energy is within the tolerance
+        energy = np.sum(evec ** 2, axis = (0, 2))
+        order = np.argsort(energy)
+        numDropped = np.searchsorted(np.cumsum(energy[order]), tol ** 2 * energy.sum(), side = 'right')
+        
+        self.vertices = np.sort(order[numDropped:])
+        self.position = -np.ones(self.numVertices, dtype = int)
+        self.position[self.vertices] = np.arange(self.vertices.size)
+        self.evec = np.ascontiguousarray(evec[:, self.vertices, :])
+        self.error = np.sqrt(energy[order[:numDropped]].sum() / energy.sum())
+    
+    def dot(self, coef, ind = None):
+        """Linear combination of the eigenvectors.
+        
+        Args:
+            coef (ndarray): Coefficients of the eigenvectors, (numEvecs,)
+            ind (ndarray): Optional, a list of certain vertex indices to return
+        
+        Returns:
+            ndarray: Linear combination at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+        """
+        if ind is None:
+            combination = np.zeros((3, self.numVertices))
+            combination[:, self.vertices] = np.tensordot(self.evec, coef, axes = 1)
+            return combination
+        
+        pos = self.position[ind]
+        kept = pos >= 0
+        combination = np.zeros((3, pos.size))
+        combination[:, kept] = np.tensordot(self.evec[:, pos[kept], :], coef, axes = 1)
+        
+        return combination
+    
+    def transposeDot(self, r, ind = None):
+        """Inner products of the eigenvectors with values at the vertices, e.g., the residuals of a fit, which are the gradients of the residuals with respect to the coefficients.
+        
+        Args:
+            r (ndarray): Values at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+            ind (ndarray): Optional, the vertex indices of ``r``
+        
+        Returns:
+            ndarray, (numEvecs,): Inner products
+        """
+        if ind is None:
+            return np.tensordot(self.evec, r[:, self.vertices], axes = ([0, 1], [0, 1]))
+        
+        pos = self.position[ind]
+        kept = pos >= 0
+        
+        return np.tensordot(self.evec[:, pos[kept], :], r[:, kept], axes = ([0, 1], [0, 1]))
+    
+    def truncated(self, numEvecs):
+        """Makes a copy with only the first ``numEvecs`` eigenvectors, keeping the same vertices.
+        """
+        basis = copy.copy(self)
+        basis.numEvecs = min(numEvecs, self.numEvecs)
+        basis.evec = self.evec[:, :, :basis.numEvecs]
+        
+        return basis
+    
+    def restricted(self, vertexIndices):
+        """Makes a copy with only the vertices ``vertexIndices``, in that order, e.g., for :meth:`MeshModel.submodel`.
+        """
+        basis = copy.copy(self)
+        pos = self.position[vertexIndices]
+        kept = pos >= 0
+        
+        basis.numVertices = pos.size
+        basis.vertices = np.flatnonzero(kept)
+        basis.position = -np.ones(basis.numVertices, dtype = int)
+        basis.position[basis.vertices] = np.arange(basis.vertices.size)
+        basis.evec = np.ascontiguousarray(self.evec[:, pos[kept], :])
+        
+        return basis
+    
+    def toarray(self):
+        """Returns the eigenvectors with zeros at the dropped vertices, (3, numVertices, numEvecs).
+        """
+        evec = np.zeros((3, self.numVertices, self.numEvecs))
+        evec[:, self.vertices, :] = self.evec
+        
+        return evec
+
+class QuantizedBasis:
+    """Eigenvectors of a 3DMM stored as 16 or 8 bit integers with a scale for each eigenvector, so that a 3DMM takes 4 or 8 times less memory than with 64 bit floats, e.g., for many fitting processes on one machine.
+    
+    Each eigenvector is divided by its largest absolute value over the 127 or 32767 steps of the integer type, and rounded, so its largest reconstruction error at any vertex is half of its scale. The eigenvectors are never converted back as a whole. Linear combinations and inner products are computed over blocks of vertices, where only the block is converted to floats, and the scales are applied to the coefficients or the inner products instead of the eigenvectors.
+    
+    Indexing, e.g., ``basis[:, ind, :]``, returns the converted eigenvectors at the indexed vertices, so the functions that index into ``idEvec``, ``expEvec``, or ``texEvec`` work unchanged when those are quantized with :meth:`MeshModel.quantize`.
+    
+    Args:
+        evec (ndarray): Eigenvectors, (3, numVertices, numEvecs)
+        dtype (type): ``np.int16`` or ``np.int8``
+        blockSize (int): Number of vertices converted to floats at a time
+    
+    Attributes:
+        q (ndarray): Quantized eigenvectors, (3, numVertices, numEvecs)
+        scale (ndarray): Scale of each eigenvector, (numEvecs,)
+        numVertices (int): Number of vertices in the 3DMM
+        numEvecs (int): Number of eigenvectors
+        shape (tuple): Shape of the eigenvectors, (3, numVertices, numEvecs)
+        error (float): Relative Frobenius norm of the quantization error
+    """
+    def __init__(self, evec, dtype = np.int16, blockSize = 4096):
+        self.numVertices = evec.shape[1]
+        self.numEvecs = evec.shape[2]
+        self.blockSize = blockSize
+        
+        # Scale each eigenvector to the full range of the integer type, leaving eigenvectors that are 0 as they are
+        self.scale = np.max(np.abs(evec), axis = (0, 1)) / np.iinfo(dtype).max
+        self.scale[self.scale == 0] = 1
+        self.q = np.round(evec / self.scale).astype(dtype)
+        
+        self.error = np.linalg.norm(evec - self.q * self.scale) / np.linalg.norm(evec)
+    
+    @property
+    def shape(self):
+        return (3, self.numVertices, self.numEvecs)
+    
+    @property
+    def nbytes(self):
+        return self.q.nbytes + self.scale.nbytes
+    
+    def dot(self, coef, ind = None):
+        """Linear combination of the eigenvectors.
+        
+        Args:
+            coef (ndarray): Coefficients of the eigenvectors, (numEvecs,)
+            ind (ndarray): Optional, a list of certain vertex indices to return
+        
+        Returns:
+            ndarray: Linear combination at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+        """
+        q = self.q if ind is None else self.q[:, ind, :]
+        scaledCoef = self.scale * coef
+        
+        combination = np.empty((3, q.shape[1]))
+        for start in range(0, q.shape[1], self.blockSize):
+            block = slice(start, start + self.blockSize)
+            combination[:, block] = np.dot(q[:, block, :].astype(np.float64), scaledCoef)
+        
+        return combination
+    
+    def transposeDot(self, r, ind = None):
+        """Inner products of the eigenvectors with values at the vertices, e.g., the residuals of a fit, which are the gradients of the residuals with respect to the coefficients.
+        
+        Args:
+            r (ndarray): Values at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+            ind (ndarray): Optional, the vertex indices of ``r``
+        
+        Returns:
+            ndarray, (numEvecs,): Inner products
+        """
+        q = self.q if ind is None else self.q[:, ind, :]
+        
+        product = np.zeros(self.numEvecs)
+        for start in range(0, q.shape[1], self.blockSize):
+            block = slice(start, start + self.blockSize)
+            product += np.tensordot(q[:, block, :].astype(np.float64), r[:, block], axes = ([0, 1], [0, 1]))
+        
+        return self.scale * product
+    
+    def truncated(self, numEvecs):
+        """Makes a copy with only the first ``numEvecs`` eigenvectors, which shares the quantized eigenvectors with this one.
+        """
+        basis = copy.copy(self)
+        basis.numEvecs = min(numEvecs, self.numEvecs)
+        basis.q = self.q[:, :, :basis.numEvecs]
+        basis.scale = self.scale[:basis.numEvecs]
+        
+        return basis
+    
+    def restricted(self, vertexIndices):
+        """Makes a copy with only the vertices ``vertexIndices``, in that order, e.g., for :meth:`MeshModel.submodel`.
+        """
+        basis = copy.copy(self)
+        basis.numVertices = len(vertexIndices)
+        basis.q = np.ascontiguousarray(self.q[:, vertexIndices, :])
+        
+        return basis
+    
+    def toarray(self):
+        """Returns the eigenvectors converted to floats, (3, numVertices, numEvecs).
+        """
+        return self.q * self.scale
+    
+    def __getitem__(self, key):
+        # The scales of the eigenvectors broadcast over the last axis, which is the eigenvector axis unless it is indexed by an integer
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        
+        return self.q[key] * self.scale[key[2]]
+    
+    def __array__(self, dtype = None, copy = None):
+        return self.toarray() if dtype is None else self.toarray().astype(dtype)
 
 class MeshModel:
     """A 3D Morphable Model class object
@@ -30,6 +248,13 @@ class MeshModel:
         texEval (ndarray): texture eigenvalues, (numTex,)
         targetLMInd (ndarray): landmark indices for OpenPose
         sourceLMInd (ndarray): vertex indices of the 3DMM that correspond to ``targetLMInd``
+        lmMean (ndarray): shape identity mean at the landmarks, (3, numLandmarks)
+        lmEvec (ndarray): shape identity and facial expression eigenvectors at the landmarks, (3, numLandmarks, numId + numExp)
+        lmGram (ndarray): Gram matrices between the x, y, z components of ``lmEvec``, where ``lmGram[i, j] = lmEvec[i].T.dot(lmEvec[j])``, (3, 3, numId + numExp, numId + numExp)
+        idBasis (SparseBasis or QuantizedBasis): Optional, sparse or quantized shape identity eigenvectors from :meth:`sparsify` or :meth:`quantize`, which are used by :func:`mm.utils.mesh.basisDot` and :func:`mm.utils.mesh.basisTransposeDot` instead of ``idEvec``
+        expBasis (SparseBasis or QuantizedBasis): Optional, sparse or quantized shape facial expression eigenvectors from :meth:`sparsify` or :meth:`quantize`, which are used instead of ``expEvec``
+        texBasis (QuantizedBasis): Optional, quantized texture eigenvectors from :meth:`quantize`, which are used by :func:`mm.utils.mesh.basisDot` instead of ``texEvec``
+        parentVertexInd (ndarray): Only for a sub-model from :meth:`submodel`, the vertex indices of the 3DMM it was extracted from that correspond to its vertices, (numVertices,)
     """
     def __init__(self, modelFile, numIdEvecs = 80, numExpEvecs = 76, numTexEvecs = 80):
         """Loads a 3DMM from a .npz file.
@@ -59,4 +284,161 @@ class MeshModel:
             self.targetLMInd = np.array([0, 1, 2, 3, 8, 13, 14, 15, 16, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 61, 62, 63, 65, 66, 67, 68, 69])
             
             # These are vertex indices that correspond with the OpenPose landmark indices above
-            self.sourceLMInd = np.array([16203, 16235, 16260, 16290, 27061, 22481, 22451, 22426, 22394, 8134, 8143, 8151, 8156, 6986, 7695, 8167, 8639, 9346, 2345, 4146, 5180, 6214, 4932, 4158, 10009, 11032, 12061, 13872, 12073, 11299, 5264, 6280, 7472, 8180, 8888, 10075, 11115, 9260, 8553, 8199, 7845, 7136, 7600, 8190, 8780, 8545, 8191, 7837, 4538, 11679])
\ No newline at end of file
+            self.sourceLMInd = np.array([16203, 16235, 16260, 16290, 27061, 22481, 22451, 22426, 22394, 8134, 8143, 8151, 8156, 6986, 7695, 8167, 8639, 9346, 2345, 4146, 5180, 6214, 4932, 4158, 10009, 11032, 12061, 13872, 12073, 11299, 5264, 6280, 7472, 8180, 8888, 10075, 11115, 9260, 8553, 8199, 7845, 7136, 7600, 8190, 8780, 8545, 8191, 7837, 4538, 11679])
+            
+            self.landmarkBasis()
+    
+    def landmarkBasis(self):
+        """Caches the part of the shape model at the landmark vertices ``sourceLMInd`` in ``lmMean``, ``lmEvec``, and ``lmGram``, so that fitting the landmarks does not have to index into the full eigenvectors. This should be called again if ``sourceLMInd`` or the shape eigenvectors are changed.
+        """
+        self.lmMean = self.idMean[:, self.sourceLMInd]
+        self.lmEvec = np.concatenate((self.idEvec[:, self.sourceLMInd, :], self.expEvec[:, self.sourceLMInd, :]), axis = 2)
+        self.lmGram = np.einsum('iLk,jLl->ijkl', self.lmEvec, self.lmEvec)
+    
+    def sparsify(self, tol = 1e-3, bases = ('id', 'exp')):
+        """Stores sparse copies of the shape eigenvectors (see :class:`SparseBasis`) in ``idBasis`` and ``expBasis``, so that synthesizing and fitting shapes only touches the vertices where the eigenvectors are not negligible. The dense eigenvectors are kept for the functions that index into them.
+        
+        Args:
+            tol (float): Relative Frobenius norm of the eigenvectors at the dropped vertices
+            bases (tuple): Which of the shape identity ``'id'`` and facial expression ``'exp'`` eigenvectors to sparsify
+        """
+        for basis in bases:
+            setattr(self, basis + 'Basis', SparseBasis(np.asarray(getattr(self, basis + 'Evec')), tol))
+    
+    def quantize(self, dtype = np.int16, bases = ('id', 'exp', 'tex'), blockSize = 4096):
+        """Replaces the eigenvectors with quantized ones (see :class:`QuantizedBasis`), which take 4 times less memory with ``np.int16`` and 8 times less with ``np.int8``. The quantized eigenvectors are stored in both ``idEvec`` and ``idBasis``, etc., so that :func:`mm.utils.mesh.basisDot` and :func:`mm.utils.mesh.basisTransposeDot` convert them a block at a time, and the functions that index into the eigenvectors convert only the indexed vertices. This replaces the sparse eigenvectors of :meth:`sparsify`. Check the reconstruction error of a 3DMM with ``bin/validateQuantization.py`` before deploying it.
+        
+        Args:
+            dtype (type): ``np.int16`` or ``np.int8``
+            bases (tuple): Which of the shape identity ``'id'``, shape facial expression ``'exp'``, and texture ``'tex'`` eigenvectors to quantize
+            blockSize (int): Number of vertices converted to floats at a time
+        """
+        for basis in bases:
+            evec = getattr(self, basis + 'Evec', None)
+            if evec is None:
+                continue
+            
+            if isinstance(evec, QuantizedBasis):
+                evec = evec.toarray()
+            
+            quantized = QuantizedBasis(evec, dtype, blockSize)
+            setattr(self, basis + 'Evec', quantized)
+            setattr(self, basis + 'Basis', quantized)
+        
+        if hasattr(self, 'sourceLMInd'):
+            self.landmarkBasis()
+    
+    def truncated(self, numId = None, numExp = None, numTex = None):
+        """Makes a copy of the 3DMM with only the eigenvectors with the highest eigenvalues, e.g., to fit with a few of them first. Like the constructor, this assumes that the eigenvectors are sorted by decreasing eigenvalues. The copy shares the mesh and the mean shape and texture with this 3DMM.
+        
+        Args:
+            numId (int): Number of shape identity eigenvectors to keep. All of them are kept if ``None``.
+            numExp (int): Number of shape facial expression eigenvectors to keep. All of them are kept if ``None``.
+            numTex (int): Number of texture eigenvectors to keep. All of them are kept if ``None``.
+        
+        Returns:
+            MeshModel: Truncated 3DMM
+        """
+        model = copy.copy(self)
+        
+        # Quantized eigenvectors that also have a separate sparse copy, e.g., after quantize() and then sparsify(), are truncated without converting them
+        def truncatedEvec(evec, numEvecs):
+            return evec.truncated(numEvecs) if isinstance(evec, (SparseBasis, QuantizedBasis)) else evec[:, :, :numEvecs]
+        
+        if numId is not None:
+            model.numId = min(numId, self.numId)
+            model.idEval = self.idEval[:model.numId]
+            if getattr(self, 'idBasis', None) is not None:
+                model.idBasis = self.idBasis.truncated(model.numId)
+            model.idEvec = model.idBasis if self.idEvec is getattr(self, 'idBasis', None) else truncatedEvec(self.idEvec, model.numId)
+        
+        if numExp is not None:
+            model.numExp = min(numExp, self.numExp)
+            model.expEval = self.expEval[:model.numExp]
+            if getattr(self, 'expBasis', None) is not None:
+                model.expBasis = self.expBasis.truncated(model.numExp)
+            model.expEvec = model.expBasis if self.expEvec is getattr(self, 'expBasis', None) else truncatedEvec(self.expEvec, model.numExp)
+        
+        if numTex is not None and hasattr(self, 'numTex'):
+            model.numTex = min(numTex, self.numTex)
+            model.texEval = self.texEval[:model.numTex]
+            if getattr(self, 'texBasis', None) is not None:
+                model.texBasis = self.texBasis.truncated(model.numTex)
+            model.texEvec = model.texBasis if self.texEvec is getattr(self, 'texBasis', None) else truncatedEvec(self.texEvec, model.numTex)
+        
+        if hasattr(self, 'sourceLMInd'):
+            model.landmarkBasis()
+        
+        return model
+    
+    def submodel(self, vertexIndices):
+        """Extracts the 3DMM of a region of the face, e.g., the mouth, so that synthesizing, fitting, and exporting the region cost in proportion to its number of vertices rather than that of the whole head. The sub-model is a self-contained MeshModel, whose vertices are ``vertexIndices`` in that order:
+        
+        * The faces are those with all three vertices in the region, re-indexed to the sub-model vertices, and ``vertex2face`` is re-indexed to these faces
+        * The means and eigenvectors are contiguous copies at the region vertices, and sparse or quantized eigenvectors (see :meth:`sparsify` and :meth:`quantize`) stay sparse or quantized
+        * The landmark correspondences ``sourceLMInd`` and ``targetLMInd`` keep the landmarks inside the region, and the landmark eigenvectors are recomputed with :meth:`landmarkBasis`
+        
+        The sub-model shares the eigenvalues with this 3DMM, so its parameters are the same as those of this 3DMM, e.g., ``generateFace(param, subModel)`` equals ``generateFace(param, model)[:, vertexIndices]``.
+        
+        Args:
+            vertexIndices (ndarray): Indices of the vertices in the region, without repeats
+        
+        Returns:
+            MeshModel: 3DMM of the region, with ``parentVertexInd`` set to ``vertexIndices``
+        """
+        vertexIndices = np.asarray(vertexIndices)
+        model = copy.copy(self)
+        model.numVertices = vertexIndices.size
+        model.parentVertexInd = vertexIndices
+        
+        # Position of each vertex of this 3DMM in the sub-model, or -1 if it is outside of the region
+        position = -np.ones(self.numVertices, dtype = int)
+        position[vertexIndices] = np.arange(vertexIndices.size)
+        
+        # Keep the faces that are entirely inside the region, and re-index the faces of each vertex
+        keptFaces = np.all(position[self.face] >= 0, axis = 1)
+        model.face = position[self.face[keptFaces]]
+        model.numFaces = model.face.shape[0]
+        
+        facePosition = -np.ones(self.numFaces, dtype = int)
+        facePosition[keptFaces] = np.arange(model.numFaces)
+        model.vertex2face = np.empty(model.numVertices, dtype = object)
+        for i, vertexInd in enumerate(vertexIndices):
+            faces = facePosition[np.asarray(self.vertex2face[vertexInd], dtype = int)]
+            model.vertex2face[i] = faces[faces >= 0]
+        
+        for mean in ('idMean', 'expMean', 'texMean'):
+            if hasattr(self, mean):
+                setattr(model, mean, np.ascontiguousarray(getattr(self, mean)[:, vertexIndices]))
+        
+        for basis in ('id', 'exp', 'tex'):
+            evec = getattr(self, basis + 'Evec', None)
+            if evec is None:
+                continue
+            
+            compactBasis = getattr(self, basis + 'Basis', None)
+            if compactBasis is not None:
+                setattr(model, basis + 'Basis', compactBasis.restricted(vertexIndices))
+            
+            # The eigenvectors can be quantized and also have a separate sparse copy, e.g., after quantize() and then sparsify(), so they are restricted in their own format rather than converted
+            if evec is compactBasis:
+                setattr(model, basis + 'Evec', getattr(model, basis + 'Basis'))
+            elif isinstance(evec, (SparseBasis, QuantizedBasis)):
+                setattr(model, basis + 'Evec', evec.restricted(vertexIndices))
+            else:
+                setattr(model, basis + 'Evec', np.ascontiguousarray(evec[:, vertexIndices, :]))
+        
+        # Keep the OpenPose landmarks and the landmarks of the 3DMM that are inside the region
+        if hasattr(self, 'sourceLMInd'):
+            inside = position[self.sourceLMInd] >= 0
+            model.sourceLMInd = position[self.sourceLMInd[inside]]
+            model.targetLMInd = self.targetLMInd[inside]
+            model.landmarkBasis()
+        
+        if hasattr(self, 'landmarkInd'):
+            inside = position[self.landmarkInd] >= 0
+            model.landmarkInd = position[self.landmarkInd[inside]]
+            model.landmark = self.landmark[inside]
+            model.landmarkName = np.asarray(self.landmarkName)[inside]
+        
+        return model
@@ -4,7 +4,7 @@
 """
 
 import numpy as np
-from ..utils.transform import rotMat2angle
+from ..utils.transform import rotMat2angle, rotMat2angleBatch
 from scipy.linalg import rq
 from scipy.optimize import least_squares
 
@@ -25,35 +25,87 @@ def initialRegistration(A, B):
     if B.shape[0] == 3:
         B = B.T
     
+    return initialRegistrationBatch(A[np.newaxis, ...], B[np.newaxis, ...])[0]
+
+def initialRegistrationBatch(A, B):
+    """Performs the Kabsch/Umeyama algorithm for many sets of 3D-3D landmark correspondences at once, e.g., for all of the frames in a video or a chunk of them. The cross-covariance matrices of all of the sets are decomposed with one stacked SVD.
+    
+    Args:
+        A (ndarray, (numFrames, n, 3) or (n, 3)): Sets of source vertices, or one set of source vertices that is registered to every set of target vertices
+        B (ndarray, (numFrames, n, 3)): Sets of target vertices such at B' = s*R*A.T + t
+    
+    Returns:
+        ndarray, (numFrames, 7): The optimal Euler angles, the 3D translation vector, and the scaling factor for each set
+    """
+    A = np.broadcast_to(A, B.shape)
+    
     # Find centroids of A and B landmarks and move them to the origin
-    muA = np.mean(A, axis = 0)
-    muB = np.mean(B, axis = 0)
+    muA = np.mean(A, axis = 1, keepdims = True)
+    muB = np.mean(B, axis = 1, keepdims = True)
     A = A - muA
     B = B - muB
     
-    # Calculate the rotation matrix R. Note that the returned V is actually V.T.
-    U, V = np.linalg.svd(np.dot(A.T, B))[::2]
-    R = np.dot(V.T, U.T)
+    # Calculate the rotation matrices R. Note that the returned V is actually V.T.
+    U, V = np.linalg.svd(np.matmul(A.transpose(0, 2, 1), B))[::2]
     
-    # Flip sign on the third column of R if it is a reflectance matrix
-    if np.linalg.det(R) < 0:
-        R[:, 2] *= -1
-        
-    # Find scale factor
-    s = np.trace(np.dot(B.T, np.dot(A, R.T))) / np.trace(np.dot(A.T, A))
+    # If R = V.T * U.T would be a reflection, flip the sign of the singular vector with the smallest singular value so that R is a proper rotation
+    reflection = np.linalg.det(np.matmul(U, V)) < 0
+    V[reflection, 2, :] *= -1
+    R = np.matmul(V.transpose(0, 2, 1), U.transpose(0, 2, 1))
     
-    # Find the translation vector
-    t = -s*np.dot(R, muA) + muB
+    # Find scale factors, trace(B.T * A * R.T) / trace(A.T * A)
+    AR = np.matmul(A, R.transpose(0, 2, 1))
+    s = np.sum(AR * B, axis = (1, 2)) / np.sum(A * A, axis = (1, 2))
     
-    # Find Euler angles underlying rotation matrix
-    angles = rotMat2angle(R)
+    # Find the translation vectors
+    t = -s[:, np.newaxis] * np.matmul(R, muA.transpose(0, 2, 1))[..., 0] + muB[:, 0, :]
     
-    return np.r_[angles, t, s]
+    # Find Euler angles underlying rotation matrices
+    angles = rotMat2angleBatch(R)
+    
+    return np.c_[angles, t, s]
+
+def cameraProjectionResidual(M, x, X):
+    """Geometric error of a perspective camera projection matrix, i.e., the differences between the 2D points and the 3D points projected by the camera and divided by their homogeneous coordinates:
+    
+    min_{P} sum_{i} || x_i - PX_i / (PX_i)_3 ||^2
+    
+    Args:
+        M (ndarray, (12,)): Flattened (3, 4) camera projection matrix
+        x (ndarray, (n, 3)): Homogeneous 2D points, with ones in the last column
+        X (ndarray, (n, 4)): Homogeneous 3D points, with ones in the last column
+    
+    Returns:
+        ndarray, (2*n,): Residuals, ordered by point and then by x, y
+    """
+    PX = np.dot(X, M.reshape((3, 4)).T)
+    
+    return (PX[:, :2] / PX[:, 2, np.newaxis] - x[:, :2]).flatten()
+
+def cameraProjectionJacobian(M, x, X):
+    """Jacobian of :func:`cameraProjectionResidual` with respect to the flattened camera projection matrix.
+    
+    Returns:
+        ndarray, (2*n, 12): Jacobian of the residuals
+    """
+    numPoints = X.shape[0]
+    
+    PX = np.dot(X, M.reshape((3, 4)).T)
+    proj = PX[:, :2] / PX[:, 2, np.newaxis]
+    Xw = X / PX[:, 2, np.newaxis]
+    
+    # The projected x only depends on the first and third rows of the camera matrix, and the projected y on the second and third rows
+    J = np.zeros((numPoints, 2, 3, 4))
+    J[:, 0, 0, :] = Xw
+    J[:, 1, 1, :] = Xw
+    J[:, :, 2, :] = -proj[..., np.newaxis] * Xw[:, np.newaxis, :]
+    
+    return J.reshape((2 * numPoints, 12))
 
 def estimateCamMat(lm2D, lm3D, cam = 'orthographic'):
     """Estimates camera matrix from 2D-3D landmark correspondences using the Direct linear transform / "Gold Standard Algorithm".
     
-    For an orthographic camera, the algebraic and geometric errors in the algorithm are equivalent, so there is no need to do the least squares step at the end. The orthographic camera returns a 2x4 camera matrix, since the third row is just [0, 0, 0, 1].
+    For an orthographic camera, the algebraic and geometric errors in the algorithm are equivalent, so there is no need to do the least squares step at the end. The orthographic camera returns a 2x4 camera matrix, since the third row is just [0, 0, 0, 1]. For a perspective camera, the DLT solution is refined by minimizing the geometric error with :func:`cameraProjectionResidual` and its analytic Jacobian :func:`cameraProjectionJacobian`.
     
     Args:
         lm2D (ndarray, (n, 2)): landmark x, y coordinates in an image
@@ -111,20 +163,55 @@ def estimateCamMat(lm2D, lm3D, cam = 'orthographic'):
         V = np.linalg.svd(A, full_matrices = 0)[-1]
         Pnorm = np.reshape(V[-1, :], (3, 4))
         
-        # Further nonlinear LS to minimize error between 2D landmarks and 3D projections onto 2D plane.
-        def cameraProjectionResidual(M, x, X):
-            """
-            min_{P} sum_{i} || x_i - PX_i ||^2
-            """
-            return x.flatten() - np.dot(X, M.reshape((3, 4)).T).flatten()
-        
-        Pgold = least_squares(cameraProjectionResidual, Pnorm.flatten(), args = (x, X))
+        # Further nonlinear LS to minimize the geometric error between the 2D landmarks and the 3D landmarks projected onto the 2D plane, with an analytic Jacobian
+        Pgold = least_squares(cameraProjectionResidual, Pnorm.flatten(), jac = cameraProjectionJacobian, args = (x, X))
         
         # Denormalize P
         P = Tinv.dot(Pgold.x.reshape(3, 4)).dot(U)
         
         return P
 
+def estimateCamMatBatch(lm2D, lm3D):
+    """Estimates orthographic camera matrices from the 2D-3D landmark correspondences of many frames at once. This is the vectorized version of :func:`estimateCamMat` with ``cam = 'orthographic'``.
+    
+    For an orthographic camera, the x and y rows of the camera matrix are separate linear least squares problems with the same normalized 3D landmarks, so both are solved from the 4x4 normal equations of each frame with one stacked solve.
+    
+    Args:
+        lm2D (ndarray, (numFrames, n, 2)): landmark x, y coordinates in the image of each frame. Frames with all-zero landmarks get a NaN camera matrix
+        lm3D (ndarray, (numFrames, n, 3) or (n, 3)): landmark x, y, z coordinates in the 3DMM for each frame, or for all of the frames
+    
+    Returns:
+        ndarray, (numFrames, 2, 4): Camera projection matrix for each frame
+    """
+    numFrames, numLandmarks = lm2D.shape[:2]
+    lm3D = np.broadcast_to(lm3D, (numFrames, numLandmarks, 3))
+    
+    # Normalize landmark coordinates; preconditioning
+    c2D = np.mean(lm2D, axis = 1, keepdims = True)
+    uvCentered = lm2D - c2D
+    s2D = np.linalg.norm(uvCentered, axis = 2).mean(axis = 1)
+    
+    # Frames where the landmarks were not detected (all at the same point) have no camera and get NaN instead
+    s2D[s2D == 0] = np.nan
+    
+    c3D = np.mean(lm3D, axis = 1, keepdims = True)
+    xyzCentered = lm3D - c3D
+    s3D = np.linalg.norm(xyzCentered, axis = 2).mean(axis = 1)
+    X = np.concatenate((xyzCentered / s3D[:, np.newaxis, np.newaxis] * np.sqrt(3), np.ones((numFrames, numLandmarks, 1))), axis = 2)
+    x = uvCentered / s2D[:, np.newaxis, np.newaxis] * np.sqrt(2)
+    
+    # Solve the normal equations for both rows of each normalized projection matrix, (numFrames, 2, 4)
+    XtX = np.matmul(X.transpose(0, 2, 1), X)
+    Xtx = np.matmul(X.transpose(0, 2, 1), x)
+    p8 = np.linalg.solve(XtX, Xtx).transpose(0, 2, 1)
+    
+    # De-normalize: P = Tinv * Pnorm * U, where Tinv scales by s2D and translates by c2D, and U translates by -c3D and scales by 1/s3D
+    P = np.empty((numFrames, 2, 4))
+    P[:, :, :3] = (s2D / s3D)[:, np.newaxis, np.newaxis] * p8[:, :, :3]
+    P[:, :, 3] = s2D[:, np.newaxis] * p8[:, :, 3] - np.matmul(P[:, :, :3], c3D.transpose(0, 2, 1))[..., 0] + c2D[:, 0, :]
+    
+    return P
+
 def splitCamMat(P, cam = 'orthographic'):
     """Splits the camera projection matrix into relevant intrinsic and extrinsic parameters.
     
@@ -135,9 +222,9 @@ def splitCamMat(P, cam = 'orthographic'):
     Returns:
         (tuple): tuple containing:
             
-            K (ndarray (1,) or (3, 3)): orthographic scale parameter or perspective intrinsic camera matrix
+            K (ndarray (1,) or (3, 3)): orthographic scale parameter or perspective intrinsic camera matrix, normalized so that K[2, 2] = 1
             angles (ndarray (3,)): Euler angles
-            t (ndarray (2,)): translation vector
+            t (ndarray (2,) or (3,)): translation vector
     """
     if cam == 'orthographic':
         # Extract params from orthographic projection matrix
@@ -170,7 +257,56 @@ def splitCamMat(P, cam = 'orthographic'):
     elif cam == 'perspective':
         # Get inner parameters from projection matrix via RQ decomposition
         K, R = rq(P[:, :3], mode = 'economic')
-        angles = rotMat2angle(R)
+        
+        # The RQ decomposition is unique up to the signs of the diagonal of K, so make the focal lengths positive
+        T = np.diag(np.sign(np.diag(K)))
+        K = K.dot(T)
+        R = T.dot(R)
+        
+        # P is only defined up to scale, so flip its sign if R is a reflection
+        if np.linalg.det(R) < 0:
+            R = -R
+            P = -P
+        
         t = np.linalg.inv(K).dot(P[:, -1])
+        angles = rotMat2angle(R)
         
-        return K, angles, t
\ No newline at end of file
+        # Normalize K so that K[2, 2] = 1. Then P = c * K * [R | t], where c is K[2, 2] before the normalization, which does not change the projection because P is only defined up to scale
+        K = K / K[2, 2]
+        
+        return K, angles, t
+
+def splitCamMatBatch(P):
+    """Splits the orthographic camera matrices of many frames into their scales, Euler angles, and translations at once. This is the vectorized version of :func:`splitCamMat` with ``cam = 'orthographic'``.
+    
+    Args:
+        P (ndarray, (numFrames, 2, 4)): Orthographic camera projection matrices, e.g., from :func:`estimateCamMatBatch`
+    
+    Returns:
+        (tuple): tuple containing:
+            
+            K (ndarray (numFrames,)): orthographic scale parameters
+            angles (ndarray (numFrames, 3)): Euler angles
+            t (ndarray (numFrames, 2)): translation vectors
+    """
+    t = P[:, :, 3].copy()
+    
+    norms = np.linalg.norm(P[:, :, :3], axis = 2)
+    K = norms.mean(axis = 1)
+    r1 = P[:, 0, :3] / norms[:, 0, np.newaxis]
+    r2 = P[:, 1, :3] / norms[:, 1, np.newaxis]
+    R = np.stack((r1, r2, np.cross(r1, r2)), axis = 1)
+    
+    # Set R to closest orthogonal matrix to estimated rotation matrix. Frames without a camera matrix (NaN) are left as NaN
+    valid = np.isfinite(R).all(axis = (1, 2))
+    U, V = np.linalg.svd(R[valid])[::2]
+    R[valid] = np.matmul(U, V)
+    
+    # Determinant of R must = 1
+    reflection = np.linalg.det(R[valid]) < 0
+    U[reflection, 2, :] = -U[reflection, 2, :]
+    R[np.flatnonzero(valid)[reflection]] = np.matmul(U[reflection], V[reflection])
+    
+    angles = rotMat2angleBatch(R)
+    
+    return K, angles, t
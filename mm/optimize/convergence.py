@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This module contains stopping criteria for the per-frame optimizations, so that a frame that is warm-started close to its solution does not pay for a fixed number of iterations, and a driver that grows the number of eigenvectors of the 3DMM during a fit until the cost stops improving.
+"""
+
+import numpy as np
+from scipy.optimize import minimize, least_squares, OptimizeResult
+from ..utils.mesh import basisDot
+
+class ConvergenceControl:
+    """Stopping criteria for one stage of a per-frame fit, with a count of the cost and gradient evaluations that each call used.
+    
+    An optimization stops when any of the following holds:
+    
+    * The relative decrease of the cost in an iteration is at most ``ftol``
+    * The largest component of the gradient is at most ``gtol``
+    * The largest component of the parameter step in an iteration is at most ``xtol`` times (1 + the largest parameter)
+    * ``maxIter`` iterations have been done
+    
+    With :meth:`minimize`, the first two are the ``ftol`` and ``gtol`` options of L-BFGS-B, and the parameter step is checked in a callback that raises ``StopIteration``. With :meth:`leastSquares`, they are the ``ftol``, ``gtol``, and ``xtol`` arguments of ``least_squares``, and ``maxIter`` bounds the number of cost evaluations. For loops that call an optimizer repeatedly, e.g., on growing mini-batches of pixels, :meth:`converged` applies ``ftol`` to the costs of successive rounds, which have to be comparable, e.g., from mini-batches of the same size.
+    
+    Args:
+        ftol (float): Relative cost decrease threshold
+        gtol (float): Gradient norm threshold
+        xtol (float): Relative parameter step threshold
+        maxIter (int): Maximum number of iterations
+        name (str): Name of the stage for the log
+        verbose (bool): Whether to print the number of evaluations of each call
+    
+    Attributes:
+        history (list): A dict for each call with the number of cost evaluations ``nfev``, gradient or Jacobian evaluations ``njev``, iterations ``nit``, the final ``cost``, and the ``reason`` the optimization stopped
+    """
+    def __init__(self, ftol = 1e-6, gtol = 1e-5, xtol = 1e-6, maxIter = 100, name = '', verbose = False):
+        self.ftol = ftol
+        self.gtol = gtol
+        self.xtol = xtol
+        self.maxIter = maxIter
+        self.name = name
+        self.verbose = verbose
+        self.history = []
+        self.costs = []
+    
+    def minimize(self, fun, x0, jac, args = (), bounds = None):
+        """Minimizes a scalar cost function with L-BFGS-B.
+        
+        Args:
+            fun (function): Cost function
+            x0 (ndarray): Initial parameters, e.g., the parameters of the previous frame
+            jac (function): Gradient of the cost function
+            args (tuple): Extra arguments to the cost function and its gradient
+            bounds (sequence): Optional, bounds of the parameters as in ``scipy.optimize.minimize``
+        
+        Returns:
+            OptimizeResult: Result of the optimization
+        """
+        xPrev = [np.asarray(x0, dtype = float)]
+        stopped = []
+        
+        def stepCallback(x):
+            step = np.max(np.abs(x - xPrev[0]))
+            xPrev[0] = x.copy()
+            if step <= self.xtol * (1 + np.max(np.abs(x))):
+                stopped.append(True)
+                raise StopIteration
+        
+        # Older versions of scipy let the StopIteration through, so the result is put together from the last iterate
+        try:
+            result = minimize(fun, x0, args = args, jac = jac, method = 'L-BFGS-B', bounds = bounds, callback = stepCallback, options = {'ftol': self.ftol, 'gtol': self.gtol, 'maxiter': self.maxIter})
+        except StopIteration:
+            x = xPrev[0]
+            result = OptimizeResult(x = x, fun = fun(x, *args), nfev = -1, njev = -1, nit = -1, success = True)
+        
+        if stopped:
+            result.success = True
+            reason = 'xtol'
+        elif result.nit >= self.maxIter:
+            reason = 'maxIter'
+        else:
+            reason = result.message if isinstance(result.message, str) else result.message.decode()
+        
+        self.record(result.nfev, result.njev, result.nit, result.fun, reason)
+        
+        return result
+    
+    def leastSquares(self, fun, x0, jac = '2-point', args = (), **kwargs):
+        """Minimizes a sum of squared residuals with ``scipy.optimize.least_squares``.
+        
+        Args:
+            fun (function): Residual function
+            x0 (ndarray): Initial parameters, e.g., the parameters of the previous frame
+            jac (function): Jacobian of the residuals
+            args (tuple): Extra arguments to the residual function and its Jacobian
+            **kwargs: Other arguments to ``least_squares``, e.g., ``loss`` or ``tr_solver``
+        
+        Returns:
+            OptimizeResult: Result of the optimization
+        """
+        result = least_squares(fun, x0, jac = jac, args = args, ftol = self.ftol, xtol = self.xtol, gtol = self.gtol, max_nfev = self.maxIter, **kwargs)
+        
+        reason = {-1: 'improper input', 0: 'maxIter', 1: 'gtol', 2: 'ftol', 3: 'xtol', 4: 'ftol and xtol'}[result.status]
+        njev = result.njev if result.njev is not None else 0
+        
+        self.record(result.nfev, njev, njev, result.cost, reason)
+        
+        return result
+    
+    def converged(self, cost):
+        """Checks whether the relative decrease from the previous cost is at most ``ftol``, for loops that call an optimizer repeatedly. Call :meth:`reset` before the first round of a new frame.
+        
+        Args:
+            cost (float): Cost after this round
+        
+        Returns:
+            bool: Whether the loop can stop
+        """
+        self.costs.append(cost)
+        if len(self.costs) < 2:
+            return False
+        
+        return self.costs[-2] - cost <= self.ftol * max(abs(self.costs[-2]), abs(cost), 1)
+    
+    def reset(self):
+        """Forgets the costs of the rounds of :meth:`converged`.
+        """
+        self.costs = []
+    
+    def record(self, nfev, njev, nit, cost, reason):
+        """Appends the evaluation counts of a call to ``history`` and prints them if ``verbose``.
+        """
+        self.history.append({'nfev': nfev, 'njev': njev, 'nit': nit, 'cost': cost, 'reason': reason})
+        
+        if self.verbose:
+            print('%s: %d cost evaluations, %d gradient evaluations, %d iterations, cost %g, stopped by %s' % (self.name, nfev, njev, nit, cost, reason))
+    
+    @property
+    def numEvals(self):
+        """Total number of cost evaluations over all calls.
+        """
+        return sum(h['nfev'] for h in self.history if h['nfev'] > 0)
+
+def resizeParam(param, model, newModel, numPose, texture = False, fill = None):
+    """Maps parameters between two truncations of the same 3DMM (see :meth:`mm.models.MeshModel.truncated`). The coefficients of eigenvectors that are added are set to 0, or taken from ``fill``, and those of eigenvectors that are removed are dropped.
+    
+    Args:
+        param (ndarray): Concatenation of the shape identity parameters, the shape facial expression parameters, ``numPose`` similarity transform parameters, and if ``texture``, the texture parameters followed by any other parameters, e.g., spherical harmonic lighting parameters
+        model (MeshModel): 3DMM of ``param``
+        newModel (MeshModel): 3DMM to map ``param`` to
+        numPose (int): Number of similarity transform parameters, e.g., 7 in :mod:`mm.optimize.depth` and 6 in :mod:`mm.optimize.image`
+        texture (bool): Whether ``param`` contains texture parameters after the similarity transform parameters
+        fill (ndarray): Optional, parameters for ``newModel`` whose coefficients are used for the eigenvectors that are added
+    
+    Returns:
+        ndarray: Parameters for ``newModel``
+    """
+    if fill is None:
+        fill = np.zeros(newModel.numId + newModel.numExp + numPose + (newModel.numTex if texture else 0))
+    
+    def resize(coef, fillCoef):
+        return np.r_[coef[:fillCoef.size], fillCoef[coef.size:]]
+    
+    idCoef = param[:model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    rest = param[model.numId + model.numExp:]
+    pose = rest[:numPose]
+    
+    fillId = fill[:newModel.numId]
+    fillExp = fill[newModel.numId: newModel.numId + newModel.numExp]
+    
+    if texture:
+        texCoef = rest[numPose: numPose + model.numTex]
+        fillTex = fill[newModel.numId + newModel.numExp + numPose:][:newModel.numTex]
+        return np.r_[resize(idCoef, fillId), resize(expCoef, fillExp), pose, resize(texCoef, fillTex), rest[numPose + model.numTex:]]
+    
+    return np.r_[resize(idCoef, fillId), resize(expCoef, fillExp), rest]
+
+def progressiveRankFit(fit, model, param, numPose, ranks = ((10, 10, 10), (20, 20, 20), (40, 40, 40), (None, None, None)), tol = 1e-2, texture = False):
+    """Fits a 3DMM with a growing number of eigenvectors. The fit starts with the eigenvectors with the highest eigenvalues, and more eigenvectors are added in stages until the relative cost improvement of a stage falls below ``tol``, so early iterations are much cheaper, and easy frames never use the full 3DMM.
+    
+    The coefficients of the eigenvectors that a stage leaves out are held at their values in ``param``, e.g., from the fit of the previous frame, by adding their linear combinations to the means of the truncated 3DMM, so a warm start is not lost, and they are returned unchanged if no stage reaches them. Their regularization is not part of the cost of the stage.
+    
+    Args:
+        fit (function): Fits the parameters of a truncated 3DMM, as ``fit(truncatedModel, param)``, and returns the fitted parameters and their cost, e.g., with :meth:`ConvergenceControl.minimize`
+        model (MeshModel): Full 3DMM
+        param (ndarray): Initial parameters for the full 3DMM, see :func:`resizeParam`
+        numPose (int): Number of similarity transform parameters, see :func:`resizeParam`
+        ranks (sequence): Numbers of shape identity, shape facial expression, and texture eigenvectors in each stage, where ``None`` keeps all of them, as in :meth:`mm.models.MeshModel.truncated`. Keep all of the shape identity eigenvectors if the identity is held fixed.
+        tol (float): Relative cost improvement below which no more eigenvectors are added
+        texture (bool): Whether ``param`` contains texture parameters, see :func:`resizeParam`
+    
+    Returns:
+        (tuple): tuple containing:
+            
+            param (ndarray): Fitted parameters for the full 3DMM
+            rank (tuple): Numbers of shape identity, shape facial expression, and texture eigenvectors that were reached
+            cost (float): Cost of the fitted parameters
+    """
+    cost = np.inf
+    for numId, numExp, numTex in ranks:
+        subModel = model.truncated(numId, numExp, numTex)
+        
+        # Hold the coefficients of the eigenvectors that are left out by folding them into the means, which the truncated 3DMM shares with the full 3DMM, so new arrays are assigned
+        heldParam = param - resizeParam(resizeParam(param, model, subModel, numPose, texture), subModel, model, numPose, texture)
+        heldId = heldParam[:model.numId]
+        heldExp = heldParam[model.numId: model.numId + model.numExp]
+        if heldId.any() or heldExp.any():
+            subModel.idMean = model.idMean + basisDot(model, 'id', heldId) + basisDot(model, 'exp', heldExp)
+            if hasattr(model, 'sourceLMInd'):
+                subModel.landmarkBasis()
+        if texture:
+            heldTex = heldParam[model.numId + model.numExp + numPose:][:model.numTex]
+            if heldTex.any():
+                subModel.texMean = model.texMean + basisDot(model, 'tex', heldTex)
+        
+        subParam, subCost = fit(subModel, resizeParam(param, model, subModel, numPose, texture))
+        param = resizeParam(subParam, subModel, model, numPose, texture, param)
+        
+        improvement = cost - subCost
+        cost = subCost
+        if improvement < tol * abs(cost):
+            break
+    
+    return param, (subModel.numId, subModel.numExp, getattr(subModel, 'numTex', 0)), cost
@@ -4,8 +4,9 @@
 """
 
 import numpy as np
-from ..utils.mesh import generateFace
+from ..utils.mesh import generateFace, basisDot, basisTransposeDot
 from ..utils.transform import rotMat2angle
+from .camera import initialRegistration
 from .derivative import dR_dpsi, dR_dtheta, dR_dphi
 
 def initialShapeCost(param, target, model, w = (1, 1)):
@@ -55,6 +56,66 @@ def initialShapeGrad(param, target, model, w = (1, 1)):
     
     return 2 * (w[0] * np.dot(Jlan.T, rlan) / model.sourceLMInd.size + w[1] * np.r_[idCoef / model.idEval, expCoef / model.expEval, np.zeros(7)])
 
+def initialShapeFit(target, model, w = (1, 1), param = None, numIters = 20, tol = 1e-3):
+    """Minimizes :func:`initialShapeCost` by alternating between closed-form solutions for the similarity transform and for the shape coefficients.
+    
+    For fixed shape coefficients, the similarity transform is found with the Kabsch algorithm (:func:`mm.optimize.camera.initialRegistration`). For a fixed similarity transform, the landmark residuals are linear in the shape coefficients, so with the Tikhonov regularization the coefficients are the solution of a (numId + numExp)-dimensional linear system. Since the rotation is orthogonal, this system only depends on the cached Gram matrix of the landmark eigenvectors (``model.lmGram``) and the scaling factor.
+    
+    Args:
+        target (ndarray, (numLandmarks, 3)): Target 3D landmarks corresponding to ``model.sourceLMInd``
+        model (MeshModel): 3DMM MeshModel class object
+        w (tuple): Weights for the landmark and the regularization costs
+        param (ndarray): Optional, initial shape and similarity transform parameters. If not given, the fit starts from the mean shape.
+        numIters (int): Maximum number of alternations
+        tol (float): Stop when the cost decreases by less than this fraction
+    
+    Returns:
+        ndarray, (numId + numExp + 7,): Shape and similarity transform parameters
+    """
+    numCoef = model.numId + model.numExp
+    numLandmarks = model.sourceLMInd.size
+    
+    # Regularized normal equations without the scaling factor, which is multiplied in each iteration
+    G = model.lmGram[0, 0] + model.lmGram[1, 1] + model.lmGram[2, 2]
+    reg = w[1] * numLandmarks / w[0] / np.r_[model.idEval, model.expEval]
+    
+    if param is None:
+        coef = np.zeros(numCoef)
+        param = np.r_[coef, initialRegistration(model.lmMean, target)]
+    else:
+        coef = param[:numCoef].copy()
+    pose = param[numCoef:]
+    
+    cost = initialShapeCost(param, target, model, w)
+    for i in range(numIters):
+        R = rotMat2angle(pose[:3])
+        t = pose[3: 6]
+        s = pose[6]
+        
+        # Solve for the shape coefficients with the target landmarks transformed back into the model frame
+        z = np.dot(R.T, target.T - t[:, np.newaxis]) / s - model.lmMean
+        A = G.copy()
+        A[np.diag_indices(numCoef)] += reg / s**2
+        coef = np.linalg.solve(A, np.tensordot(model.lmEvec, z, axes = ([0, 1], [0, 1])))
+        
+        # Solve for the similarity transform of the new shape
+        shape = model.lmMean + np.tensordot(model.lmEvec, coef, axes = 1)
+        pose = initialRegistration(shape, target)
+        
+        # Keep the previous parameters if the cost did not decrease
+        paramNew = np.r_[coef, pose]
+        rlan = pose[6] * np.dot(rotMat2angle(pose[:3]), shape) + pose[3: 6, np.newaxis] - target.T
+        costNew = w[0] * np.sum(rlan ** 2) / numLandmarks + w[1] * np.sum(coef ** 2 / np.r_[model.idEval, model.expEval])
+        if costNew >= cost:
+            break
+        
+        converged = cost - costNew < tol * costNew
+        param, cost = paramNew, costNew
+        if converged:
+            break
+    
+    return param
+
 def shapeCost(param, model, target, targetLandmarks, NN, w = (1, 1, 1), calcID = True):
     # Shape eigenvector coefficients
     idCoef = param[: model.numId]
@@ -105,7 +166,7 @@ def shapeGrad(param, model, target, targetLandmarks, NN, w = (1, 1, 1), calcID =
         targetLandmarks = targetLandmarks.T
     
     # The eigenmodel, before rigid transformation and scaling
-    shape = model.idMean + np.tensordot(model.idEvec, idCoef, axes = 1) + np.tensordot(model.expEvec, expCoef, axes = 1)
+    shape = model.idMean + basisDot(model, 'id', idCoef) + basisDot(model, 'exp', expCoef)
     
     # After rigid transformation and scaling
     source = s*np.dot(R, shape) + t[:, np.newaxis]
@@ -114,31 +175,30 @@ def shapeGrad(param, model, target, targetLandmarks, NN, w = (1, 1, 1), calcID =
     distance, ind = NN.kneighbors(source.T)
     targetNN = target[ind.squeeze(axis = 1), :].T
     
-    # Calculate resisduals
-    rver = (source - targetNN).flatten('F')
-    rlan = (source[:, model.sourceLMInd] - targetLandmarks).flatten('F')
-        
-    drV_ddelta = s*np.tensordot(R, model.expEvec, axes = 1)
+    # Calculate resisduals, weighted as in the cost
+    rver = w[0] * (source - targetNN) / model.numVertices
+    rlan = w[1] * (source[:, model.sourceLMInd] - targetLandmarks) / model.sourceLMInd.size
+    
+    # The residuals rotated back into the 3DMM frame, so that the gradients with respect to the eigenvector coefficients are inner products of the eigenvectors with them, e.g., (s*R*idEvec).T * r = s*idEvec.T * (R.T * r), without forming the Jacobians
+    rverModel = s*np.dot(R.T, rver)
+    rlanModel = s*np.dot(R.T, rlan)
+    
+    dE_ddelta = basisTransposeDot(model, 'exp', rverModel) + basisTransposeDot(model, 'exp', rlanModel, model.sourceLMInd)
+    
+    # The derivatives of the vertices with respect to the similarity transform parameters
     drV_dpsi = s*np.dot(dR_dpsi(angles), shape)
     drV_dtheta = s*np.dot(dR_dtheta(angles), shape)
     drV_dphi = s*np.dot(dR_dphi(angles), shape)
-    drV_dt = np.tile(np.eye(3), [model.numVertices, 1])
     drV_ds = np.dot(R, shape)
     
+    dE_dpose = np.r_[np.sum(drV_dpsi * rver) + np.sum(drV_dpsi[:, model.sourceLMInd] * rlan), np.sum(drV_dtheta * rver) + np.sum(drV_dtheta[:, model.sourceLMInd] * rlan), np.sum(drV_dphi * rver) + np.sum(drV_dphi[:, model.sourceLMInd] * rlan), rver.sum(axis = 1) + rlan.sum(axis = 1), np.sum(drV_ds * rver) + np.sum(drV_ds[:, model.sourceLMInd] * rlan)]
+    
     if calcID:
         
-        drV_dalpha = s*np.tensordot(R, model.idEvec, axes = 1)
+        dE_dalpha = basisTransposeDot(model, 'id', rverModel) + basisTransposeDot(model, 'id', rlanModel, model.sourceLMInd)
         
-        Jver = np.c_[drV_dalpha.reshape((source.size, idCoef.size), order = 'F'), drV_ddelta.reshape((source.size, expCoef.size), order = 'F'), drV_dpsi.flatten('F'), drV_dtheta.flatten('F'), drV_dphi.flatten('F'), drV_dt, drV_ds.flatten('F')]
-        
-        Jlan = np.c_[drV_dalpha[:, model.sourceLMInd, :].reshape((targetLandmarks.size, idCoef.size), order = 'F'), drV_ddelta[:, model.sourceLMInd, :].reshape((targetLandmarks.size, expCoef.size), order = 'F'), drV_dpsi[:, model.sourceLMInd].flatten('F'), drV_dtheta[:, model.sourceLMInd].flatten('F'), drV_dphi[:, model.sourceLMInd].flatten('F'), drV_dt[:model.sourceLMInd.size * 3, :], drV_ds[:, model.sourceLMInd].flatten('F')]
-        
-        return 2 * (w[0] * np.dot(Jver.T, rver) / model.numVertices + w[1] * np.dot(Jlan.T, rlan) / model.sourceLMInd.size + w[2] * np.r_[idCoef / model.idEval, expCoef / model.expEval, np.zeros(7)])
+        return 2 * (np.r_[dE_dalpha, dE_ddelta, dE_dpose] + w[2] * np.r_[idCoef / model.idEval, expCoef / model.expEval, np.zeros(7)])
     
     else:
         
-        Jver = np.c_[drV_ddelta.reshape((source.size, expCoef.size), order = 'F'), drV_dpsi.flatten('F'), drV_dtheta.flatten('F'), drV_dphi.flatten('F'), drV_dt, drV_ds.flatten('F')]
-        
-        Jlan = np.c_[drV_ddelta[:, model.sourceLMInd, :].reshape((targetLandmarks.size, expCoef.size), order = 'F'), drV_dpsi[:, model.sourceLMInd].flatten('F'), drV_dtheta[:, model.sourceLMInd].flatten('F'), drV_dphi[:, model.sourceLMInd].flatten('F'), drV_dt[:model.sourceLMInd.size * 3, :], drV_ds[:, model.sourceLMInd].flatten('F')]
-        
-        return 2 * (np.r_[np.zeros(idCoef.size), w[0] * np.dot(Jver.T, rver) / model.numVertices] + np.r_[np.zeros(idCoef.size), w[1] * np.dot(Jlan.T, rlan) / model.sourceLMInd.size] + w[2] * np.r_[np.zeros(idCoef.size), expCoef / model.expEval, np.zeros(7)])
\ No newline at end of file
+        return 2 * (np.r_[np.zeros(idCoef.size), dE_ddelta, dE_dpose] + w[2] * np.r_[np.zeros(idCoef.size), expCoef / model.expEval, np.zeros(7)])
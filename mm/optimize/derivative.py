@@ -39,4 +39,28 @@ def dR_dphi(angles):
         ndarray, (3, 3): derivative of rotation matrix with respect to phi
     """
     psi, theta, phi = angles
-    return np.array([[-np.cos(theta)*np.sin(phi), -np.cos(psi)*np.cos(phi) - np.sin(psi)*np.sin(theta)*np.sin(phi), np.sin(psi)*np.cos(phi) - np.cos(psi)*np.sin(theta)*np.sin(phi)], [np.cos(theta)*np.cos(phi), -np.cos(psi)*np.sin(phi) + np.sin(psi)*np.sin(theta)*np.cos(phi), np.sin(psi)*np.sin(phi) + np.cos(psi)*np.sin(theta)*np.cos(phi)], [0, 0, 0]])
\ No newline at end of file
+    return np.array([[-np.cos(theta)*np.sin(phi), -np.cos(psi)*np.cos(phi) - np.sin(psi)*np.sin(theta)*np.sin(phi), np.sin(psi)*np.cos(phi) - np.cos(psi)*np.sin(theta)*np.sin(phi)], [np.cos(theta)*np.cos(phi), -np.cos(psi)*np.sin(phi) + np.sin(psi)*np.sin(theta)*np.cos(phi), np.sin(psi)*np.sin(phi) + np.cos(psi)*np.sin(theta)*np.cos(phi)], [0, 0, 0]])
+
+def checkJacobian(fun, jac, x, *args, epsilon = 1e-6):
+    """Compares an analytical Jacobian with central differences of the residuals, like ``scipy.optimize.check_grad`` does for gradients.
+    
+    Args:
+        fun (function): Residual function, called as ``fun(x, *args)``
+        jac (function): Jacobian of ``fun``, called as ``jac(x, *args)``, which may return a dense or a sparse matrix
+        x (ndarray): Parameters at which to compare the Jacobians, (numParams,)
+        epsilon (float): Step of the central differences
+    
+    Returns:
+        float: Largest absolute difference between the analytical and numerical Jacobians
+    """
+    J = jac(x, *args)
+    if hasattr(J, 'toarray'):
+        J = J.toarray()
+    
+    Jnum = np.empty(J.shape)
+    for i in range(x.size):
+        dx = np.zeros(x.size)
+        dx[i] = epsilon
+        Jnum[:, i] = (fun(x + dx, *args) - fun(x - dx, *args)) / (2 * epsilon)
+    
+    return np.abs(J - Jnum).max()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-from scipy.linalg import block_diag
-from ..utils.mesh import generateFace, generateTexture, barycentricReconstruction
+from scipy import sparse, ndimage
+from scipy.optimize import least_squares
+from ..utils.mesh import generateFace, generateTexture, barycentricReconstruction, basisDot
 from ..utils.transform import rotMat2angle
 from .derivative import dR_dpsi, dR_dtheta, dR_dphi
+from .camera import estimateCamMat, splitCamMat
 
 def initialShapeCost(param, target, model, w = (1, 1)):
     # Shape eigenvector coefficients
@@ -56,6 +58,161 @@ def initialShapeGrad(param, target, model, w = (1, 1)):
     
     return 2 * (w[0] * np.dot(Jlan.T, rlan) / model.sourceLMInd.size + w[1] * np.r_[idCoef / model.idEval, expCoef / model.expEval, np.zeros(6)])
 
+def orthographicPoseFit(shape, target, pose, numIters = 1):
+    """Refines the similarity transform parameters of an orthographic camera for a fixed shape with Gauss-Newton steps on the landmark residuals. Each step only needs the solution of a 6x6 linear system.
+    
+    Args:
+        shape (ndarray, (3, numLandmarks)): 3DMM landmarks before the similarity transform
+        target (ndarray, (numLandmarks, 2)): Target 2D landmarks
+        pose (ndarray, (6,)): Initial Euler angles, x and y translations, and scaling factor
+        numIters (int): Number of Gauss-Newton steps
+    
+    Returns:
+        ndarray, (6,): Refined similarity transform parameters
+    """
+    numLandmarks = shape.shape[1]
+    
+    for i in range(numIters):
+        angles = pose[:3]
+        R = rotMat2angle(angles)[:2, :]
+        RX = np.dot(R, shape)
+        rlan = (pose[5] * RX + pose[3: 5, np.newaxis] - target.T).flatten('F')
+        
+        J = np.c_[pose[5] * np.dot(dR_dpsi(angles)[:2, :], shape).flatten('F'), pose[5] * np.dot(dR_dtheta(angles)[:2, :], shape).flatten('F'), pose[5] * np.dot(dR_dphi(angles)[:2, :], shape).flatten('F'), np.tile(np.eye(2), [numLandmarks, 1]), RX.flatten('F')]
+        pose = pose - np.linalg.solve(np.dot(J.T, J), np.dot(J.T, rlan))
+    
+    return pose
+
+def initialShapeFit(target, model, w = (1, 1), param = None, numIters = 20, numPoseIters = 2, tol = 1e-3):
+    """Minimizes :func:`initialShapeCost` by alternating between solutions for the similarity transform of the orthographic camera and for the shape coefficients.
+    
+    Without an initial guess, the camera is found for the mean shape with the DLT (:func:`mm.optimize.camera.estimateCamMat`) and split into the similarity transform parameters. For fixed shape coefficients, the similarity transform is refined with Gauss-Newton steps. For a fixed similarity transform, the landmark residuals are linear in the shape coefficients, so with the Tikhonov regularization the coefficients are the solution of a (numId + numExp)-dimensional linear system, which is assembled from the cached Gram matrices of the landmark eigenvectors (``model.lmGram``) and the first two rows of the rotation matrix.
+    
+    Args:
+        target (ndarray, (numLandmarks, 2)): Target 2D landmarks corresponding to ``model.sourceLMInd``
+        model (MeshModel): 3DMM MeshModel class object
+        w (tuple): Weights for the landmark and the regularization costs
+        param (ndarray): Optional, initial shape and similarity transform parameters, e.g., with the camera from :func:`mm.optimize.camera.estimateCamMatBatch`. If not given, the fit starts from the mean shape.
+        numIters (int): Maximum number of alternations
+        numPoseIters (int): Number of Gauss-Newton steps for the similarity transform in each alternation
+        tol (float): Stop when the cost decreases by less than this fraction
+    
+    Returns:
+        ndarray, (numId + numExp + 6,): Shape and similarity transform parameters, with only the x and y translations
+    """
+    numCoef = model.numId + model.numExp
+    numLandmarks = model.sourceLMInd.size
+    
+    reg = w[1] * numLandmarks / w[0] / np.r_[model.idEval, model.expEval]
+    
+    if param is None:
+        coef = np.zeros(numCoef)
+        s, angles, t = splitCamMat(estimateCamMat(target, model.lmMean.T, 'orthographic'), 'orthographic')
+        pose = np.r_[angles, t, s]
+    else:
+        coef = param[:numCoef].copy()
+        pose = param[numCoef:]
+    
+    param = np.r_[coef, pose]
+    cost = initialShapeCost(param, target, model, w)
+    for i in range(numIters):
+        R = rotMat2angle(pose[:3])[:2, :]
+        t = pose[3: 5]
+        s = pose[5]
+        
+        # The linear system in the shape coefficients for s * R[:2] * (lmMean + lmEvec * coef) + t = target, where R[:2].T * R[:2] weights the Gram matrices
+        RtR = np.dot(R.T, R)
+        A = s**2 * np.tensordot(RtR, model.lmGram, axes = 2)
+        A[np.diag_indices(numCoef)] += reg
+        z = target.T - t[:, np.newaxis] - s * np.dot(R, model.lmMean)
+        coef = np.linalg.solve(A, s * np.tensordot(np.tensordot(R, model.lmEvec, axes = 1), z, axes = ([0, 1], [0, 1])))
+        
+        # The similarity transform of an orthographic camera has no closed form for a fixed shape, so refine it with Gauss-Newton steps
+        shape = model.lmMean + np.tensordot(model.lmEvec, coef, axes = 1)
+        pose = orthographicPoseFit(shape, target, pose, numPoseIters)
+        
+        # Keep the previous parameters if the cost did not decrease
+        paramNew = np.r_[coef, pose]
+        rlan = pose[5] * np.dot(rotMat2angle(pose[:3])[:2, :], shape) + pose[3: 5, np.newaxis] - target.T
+        costNew = w[0] * np.sum(rlan ** 2) / numLandmarks + w[1] * np.sum(coef ** 2 / np.r_[model.idEval, model.expEval])
+        if costNew >= cost:
+            break
+        
+        converged = cost - costNew < tol * costNew
+        param, cost = paramNew, costNew
+        if converged:
+            break
+    
+    return param
+
+def initialShapeCostPerspective(param, target, model, K, w = (1, 1)):
+    """Landmark fitting cost of :func:`initialShapeCost` for a perspective camera with known intrinsic parameters, e.g., from :func:`mm.optimize.camera.splitCamMat` or from a calibration of the camera. The landmarks of the 3DMM are rigidly transformed into the camera frame and projected by the intrinsic camera matrix, so there is no scaling factor; the size of the face in the image is given by its distance from the camera.
+    
+    Args:
+        param (ndarray): Concatenation of the shape identity parameters, the shape facial expression parameters, the three Euler angles, and the 3D translation vector
+        target (ndarray, (numLandmarks, 2)): 2D landmark (x, y) coordinates in the image
+        model (MeshModel): 3DMM MeshModel class object
+        K (ndarray, (3, 3)): Intrinsic camera matrix
+        w (tuple): Weights for the landmark and the regularization costs
+    
+    Returns:
+        float: Cost
+    """
+    # Shape eigenvector coefficients
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    
+    # Landmarks in the camera frame, projected onto the image
+    source = np.dot(K, generateFace(np.r_[param, 1], model, ind = model.sourceLMInd))
+    source = source[:2, :] / source[2, :]
+    
+    rlan = (source - target.T).flatten('F')
+    Elan = np.dot(rlan, rlan) / model.sourceLMInd.size
+    
+    # Regularization cost
+    Ereg = np.sum(idCoef ** 2 / model.idEval) + np.sum(expCoef ** 2 / model.expEval)
+    
+    return w[0] * Elan + w[1] * Ereg
+
+def initialShapeGradPerspective(param, target, model, K, w = (1, 1)):
+    """Gradient of :func:`initialShapeCostPerspective` with respect to the shape and pose parameters.
+    
+    Returns:
+        ndarray, (numId + numExp + 6,): Gradient
+    """
+    # Shape eigenvector coefficients
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    
+    # Rotation Euler angles, translation vector
+    angles = param[model.numId + model.numExp:][:3]
+    R = rotMat2angle(angles)
+    t = param[model.numId + model.numExp:][3: 6]
+    
+    # The eigenmodel, before rigid transformation
+    shape = model.idMean[:, model.sourceLMInd] + np.tensordot(model.idEvec[:, model.sourceLMInd, :], idCoef, axes = 1) + np.tensordot(model.expEvec[:, model.sourceLMInd, :], expCoef, axes = 1)
+    
+    # After rigid transformation and perspective projection
+    KX = np.dot(K, np.dot(R, shape) + t[:, np.newaxis])
+    source = KX[:2, :] / KX[2, :]
+    
+    rlan = (source - target.T).flatten('F')
+    
+    # Derivatives of the landmarks in the camera frame, (3, numLandmarks, numId + numExp + 6)
+    dX_dalpha = np.tensordot(R, model.idEvec[:, model.sourceLMInd, :], axes = 1)
+    dX_ddelta = np.tensordot(R, model.expEvec[:, model.sourceLMInd, :], axes = 1)
+    dX_dpsi = np.dot(dR_dpsi(angles), shape)
+    dX_dtheta = np.dot(dR_dtheta(angles), shape)
+    dX_dphi = np.dot(dR_dphi(angles), shape)
+    dX_dt = np.broadcast_to(np.eye(3)[:, np.newaxis, :], (3, model.sourceLMInd.size, 3))
+    dX_dparam = np.concatenate((dX_dalpha, dX_ddelta, dX_dpsi[..., np.newaxis], dX_dtheta[..., np.newaxis], dX_dphi[..., np.newaxis], dX_dt), axis = 2)
+    
+    # Chain with the derivatives of the perspective division, d(KX[:2] / KX[2]) / dX = (K[:2] - source * K[2]) / KX[2], (2, numLandmarks, 3)
+    dsource_dX = (K[:2, np.newaxis, :] - source[..., np.newaxis] * K[2, :]) / KX[2, :, np.newaxis]
+    Jlan = np.einsum('iLj,jLp->Lip', dsource_dX, dX_dparam).reshape((source.size, -1))
+    
+    return 2 * (w[0] * np.dot(Jlan.T, rlan) / model.sourceLMInd.size + w[1] * np.r_[idCoef / model.idEval, expCoef / model.expEval, np.zeros(6)])
+
 def cameraShapeCost(param, model, lm2d, lm3dInd, cam):
     """
     Minimize L2-norm of landmark fitting residuals and regularization terms for shape parameters
@@ -89,16 +246,206 @@ def cameraShapeCost(param, model, lm2d, lm3dInd, cam):
     
     return Elan + Ereg
 
+def faceBoundingBox(lm, width, height, margin = 0.3):
+    """Finds a region of interest around the face from its 2D landmarks, which can be passed to :meth:`mm.utils.opengl.Render.setROI` so that only the face is rendered. The bounding box of the landmarks is grown by ``margin`` times its larger side on each side to make room for the parts of the 3DMM outside of the landmarks, e.g., the forehead, and is clipped to the frame.
+    
+    Args:
+        lm (ndarray, (numLandmarks, 2)): 2D landmark (x, y) coordinates
+        width (int): Pixel width of the frame
+        height (int): Pixel height of the frame
+        margin (float): Margin around the landmarks as a fraction of the larger side of their bounding box
+    
+    Returns:
+        tuple: ``(x, y, width, height)`` of the region of interest in pixels
+    """
+    lmMin = lm[:, :2].min(axis = 0)
+    lmMax = lm[:, :2].max(axis = 0)
+    pad = margin * (lmMax - lmMin).max()
+    
+    x0, y0 = np.maximum(np.floor(lmMin - pad), 0).astype(int)
+    x1 = int(min(np.ceil(lmMax[0] + pad), width))
+    y1 = int(min(np.ceil(lmMax[1] + pad), height))
+    
+    return x0, y0, x1 - x0, y1 - y0
+
+def renderedPixels(rendering, pixelCoord, renderObj):
+    """Looks up the rendered colors at full-frame pixel coordinates. If a region of interest is rendered (see :meth:`mm.utils.opengl.Render.setROI`), the rendering only covers the ROI, so the pixel coordinates are shifted by its offset.
+    
+    Args:
+        rendering (ndarray, (height, width, 3)): Rendering from ``renderObj.grabRendering()``
+        pixelCoord (ndarray, (numPixels, 2)): Full-frame (row, column) coordinates of the pixels
+        renderObj (Render): Render object that made the rendering
+    
+    Returns:
+        ndarray, (numPixels, 3): Rendered colors at the pixels
+    """
+    return rendering[pixelCoord[:, 0] - renderObj.yOffset, pixelCoord[:, 1] - renderObj.xOffset]
+
+def imagePixels(img, pixelCoord):
+    """Looks up the values of an image at a set of pixels as floats. Images can be kept in their decoded integer type, e.g., from :func:`mm.utils.io.loadImage`, and only the pixels that are looked up are converted to floats in [0, 1], in the same way as ``skimage.img_as_float``. Float images are returned as they are.
+    
+    Args:
+        img (ndarray, (height, width, numChannels)): Image
+        pixelCoord (ndarray, (numPixels, 2)): (row, column) coordinates of the pixels
+    
+    Returns:
+        ndarray, (numPixels, numChannels): Values of the image at the pixels
+    """
+    pixels = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    
+    if np.issubdtype(img.dtype, np.integer):
+        return pixels / np.iinfo(img.dtype).max
+    
+    return pixels
+
+def bilinearSample(img, x, y):
+    """Bilinearly interpolates an image at window coordinates, where the centers of the pixels are at half-integer coordinates. Coordinates outside of the frame are clamped to the nearest pixel center.
+    
+    Args:
+        img (ndarray, (height, width, numChannels)): Image to sample
+        x (ndarray): x-coordinates (along the columns) of the samples, (numSamples,)
+        y (ndarray): y-coordinates (along the rows) of the samples, (numSamples,)
+    
+    Returns:
+        tuple: Interpolated values, and their derivatives with respect to x and to y, each (numSamples, numChannels)
+    """
+    height, width = img.shape[:2]
+    
+    u = np.clip(x - 0.5, 0, width - 1)
+    v = np.clip(y - 0.5, 0, height - 1)
+    
+    # Upper-left pixel of the four neighboring pixels, kept one pixel away from the last row and column so that the neighbors exist
+    u0 = np.minimum(u.astype(int), width - 2)
+    v0 = np.minimum(v.astype(int), height - 2)
+    fu = (u - u0)[:, np.newaxis]
+    fv = (v - v0)[:, np.newaxis]
+    
+    I00 = imagePixels(img, np.c_[v0, u0])
+    I01 = imagePixels(img, np.c_[v0, u0 + 1])
+    I10 = imagePixels(img, np.c_[v0 + 1, u0])
+    I11 = imagePixels(img, np.c_[v0 + 1, u0 + 1])
+    
+    top = I00 + fu * (I01 - I00)
+    bottom = I10 + fu * (I11 - I10)
+    
+    dI_dx = (1 - fv) * (I01 - I00) + fv * (I11 - I10)
+    dI_dy = bottom - top
+    
+    return top + fv * dI_dy, dI_dx, dI_dy
+
+def vertexPhotometricResiduals(param, img, sh, model, w = (1, 1), vertexInd = None):
+    """Photometric residuals between the 3DMM vertex colors and the image sampled at the orthographically projected vertices, for fitting shape, pose, texture, and lighting without rendering.
+    
+    The image is bilinearly interpolated at each vertex (see :func:`bilinearSample`), so the residuals are differentiable with respect to the shape and pose parameters. The vertices should be visible, e.g., from :func:`mm.utils.mesh.visibleVertices`, and they should be kept fixed over an optimization, since the residuals change discontinuously with the set of vertices. The spherical harmonic bases are also kept fixed.
+    
+    Args:
+        param (ndarray): Concatenation of the shape identity parameters, the shape facial expression parameters, the three Euler angles, the x and y translations, the scaling factor, the texture parameters, and the flattened (9, 3) spherical harmonic lighting parameters
+        img (ndarray, (height, width, 3)): Image to fit
+        sh (ndarray): Spherical harmonic bases evaluated at the vertex normals, (9, numVertices)
+        model (MeshModel): 3DMM MeshModel class object
+        w (tuple): Weights for the photometric and the regularization residuals
+        vertexInd (ndarray): Optional, indices of the vertices to sample. All vertices are used by default.
+    
+    Returns:
+        ndarray, (3*numSampledVertices + numId + numExp + numTex,): Residuals
+    """
+    if vertexInd is None:
+        vertexInd = np.arange(model.numVertices)
+    numVertices = vertexInd.size
+    
+    # Shape, pose, texture, and lighting parameters
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    angles = param[model.numId + model.numExp:][:3]
+    t = param[model.numId + model.numExp:][3: 5]
+    s = param[model.numId + model.numExp:][5]
+    texCoef = param[model.numId + model.numExp + 6:][:model.numTex]
+    shCoef = param[model.numId + model.numExp + 6 + model.numTex:].reshape(9, 3)
+    
+    # Orthographic projection of the vertices
+    R = rotMat2angle(angles)
+    shape = model.idMean[:, vertexInd] + basisDot(model, 'id', idCoef, vertexInd) + basisDot(model, 'exp', expCoef, vertexInd)
+    proj = s*np.dot(R[:2, :], shape) + t[:, np.newaxis]
+    
+    imgSamples = bilinearSample(img, proj[0, :], proj[1, :])[0]
+    
+    # Lit vertex colors
+    texture = model.texMean[:, vertexInd] + basisDot(model, 'tex', texCoef, vertexInd)
+    vertexColor = texture * np.dot(shCoef.T, sh[:, vertexInd])
+    
+    return np.r_[w[0] / numVertices * (vertexColor.T - imgSamples).flatten('F'), w[1] * np.r_[idCoef / np.sqrt(model.idEval), expCoef / np.sqrt(model.expEval), texCoef / np.sqrt(model.texEval)]]
+
+def vertexPhotometricJacobian(param, img, sh, model, w = (1, 1), vertexInd = None):
+    """Jacobian of :func:`vertexPhotometricResiduals` with respect to the shape, pose, texture, and lighting parameters.
+    
+    The derivatives with respect to the shape and pose parameters chain the derivatives of the bilinearly interpolated image with the derivatives of the projected vertices.
+    
+    Returns:
+        ndarray, (3*numSampledVertices + numId + numExp + numTex, numId + numExp + 6 + numTex + 27): Jacobian of the residuals
+    """
+    if vertexInd is None:
+        vertexInd = np.arange(model.numVertices)
+    numVertices = vertexInd.size
+    
+    # Shape, pose, texture, and lighting parameters
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    angles = param[model.numId + model.numExp:][:3]
+    t = param[model.numId + model.numExp:][3: 5]
+    s = param[model.numId + model.numExp:][5]
+    texCoef = param[model.numId + model.numExp + 6:][:model.numTex]
+    shCoef = param[model.numId + model.numExp + 6 + model.numTex:].reshape(9, 3)
+    
+    # Orthographic projection of the vertices
+    R = rotMat2angle(angles)
+    shape = model.idMean[:, vertexInd] + basisDot(model, 'id', idCoef, vertexInd) + basisDot(model, 'exp', expCoef, vertexInd)
+    proj = s*np.dot(R[:2, :], shape) + t[:, np.newaxis]
+    
+    dI_dx, dI_dy = bilinearSample(img, proj[0, :], proj[1, :])[1:]
+    
+    # Derivatives of the projected vertices with respect to the shape and pose parameters, (2, numSampledVertices, numId + numExp + 6)
+    dproj_dalpha = s*np.tensordot(R[:2, :], model.idEvec[:, vertexInd, :], axes = 1)
+    dproj_ddelta = s*np.tensordot(R[:2, :], model.expEvec[:, vertexInd, :], axes = 1)
+    dproj_dpsi = s*np.dot(dR_dpsi(angles)[:2, :], shape)
+    dproj_dtheta = s*np.dot(dR_dtheta(angles)[:2, :], shape)
+    dproj_dphi = s*np.dot(dR_dphi(angles)[:2, :], shape)
+    dproj_dt = np.broadcast_to(np.eye(2)[:, np.newaxis, :], (2, numVertices, 2))
+    dproj_ds = np.dot(R[:2, :], shape)
+    dproj_dparam = np.concatenate((dproj_dalpha, dproj_ddelta, dproj_dpsi[..., np.newaxis], dproj_dtheta[..., np.newaxis], dproj_dphi[..., np.newaxis], dproj_dt, dproj_ds[..., np.newaxis]), axis = 2)
+    
+    # The residuals subtract the sampled image, so the shape and pose derivatives are the negated image gradients chained with the above, (3, numSampledVertices, numId + numExp + 6)
+    J_shape = -(dI_dx.T[..., np.newaxis] * dproj_dparam[0] + dI_dy.T[..., np.newaxis] * dproj_dparam[1])
+    
+    # Derivatives of the lit vertex colors with respect to the texture parameters
+    texture = model.texMean[:, vertexInd] + basisDot(model, 'tex', texCoef, vertexInd)
+    lighting = np.dot(shCoef.T, sh[:, vertexInd])
+    J_texCoef = model.texEvec[:, vertexInd, :] * lighting[..., np.newaxis]
+    
+    # Each color channel only depends on its own nine lighting parameters, which are interleaved by channel in the flattened parameters
+    J_shCoef = np.zeros((3, numVertices, 9, 3))
+    for c in range(3):
+        J_shCoef[c, :, :, c] = texture[c, :, np.newaxis] * sh[:, vertexInd].T
+    
+    Jcol = w[0] / numVertices * np.concatenate((J_shape, J_texCoef, J_shCoef.reshape((3, numVertices, 27))), axis = 2).reshape((3 * numVertices, -1))
+    
+    # The regularization residuals are linear in the shape and texture parameters
+    numParam = Jcol.shape[1]
+    Jreg = np.zeros((model.numId + model.numExp + model.numTex, numParam))
+    regInd = np.r_[np.arange(model.numId + model.numExp), model.numId + model.numExp + 6 + np.arange(model.numTex)]
+    Jreg[np.arange(regInd.size), regInd] = w[1] / np.sqrt(np.r_[model.idEval, model.expEval, model.texEval])
+    
+    return np.r_[Jcol, Jreg]
+
 def textureCost(texCoef, img, vertexCoord, model, renderObj, w = (1, 1)):
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, vertexColor.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    rendering, pixelCoord = renderObj.grabRendering(return_info = True)[:2]
+    rendering, pixelCoord = renderObj.grabRendering(return_info = True, attachments = ('rendering', 'faceID'))[:2]
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
     # Color matching cost
     r = (rendering - img).flatten()
@@ -110,7 +457,7 @@ def textureCost(texCoef, img, vertexCoord, model, renderObj, w = (1, 1)):
     return w[0] * Ecol + w[1] * Ereg
 
 def textureGrad(texCoef, img, vertexCoord, model, renderObj, w = (1, 1)):
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, vertexColor.T])
     renderObj.resetFramebufferObject()
@@ -118,8 +465,8 @@ def textureGrad(texCoef, img, vertexCoord, model, renderObj, w = (1, 1)):
     rendering, pixelCoord, pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True)
     numPixels = pixelFaces.size
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
     pixelVertices = model.face[pixelFaces, :]
     
@@ -133,13 +480,13 @@ def textureGrad(texCoef, img, vertexCoord, model, renderObj, w = (1, 1)):
     
     return 2 * (w[0] * r.dot(J_texCoef) / numPixels + w[1] * texCoef / model.texEval)
 
-def textureResiduals(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), randomFaces = None):
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+def textureResiduals(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), randomFaces = None, pixelWeights = None):
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, vertexColor.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    rendering, pixelCoord = renderObj.grabRendering(return_info = True)[:2]
+    rendering, pixelCoord = renderObj.grabRendering(return_info = True, attachments = ('rendering', 'faceID'))[:2]
     
     if randomFaces is not None:
         numPixels = randomFaces.size
@@ -147,18 +494,22 @@ def textureResiduals(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), ra
     else:
         numPixels = pixelCoord.shape[0]
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
-    return np.r_[w[0] / numPixels * (rendering - img).flatten('F'), w[1] * texCoef ** 2 / model.texEval]
+    r = rendering - img
+    if pixelWeights is not None:
+        r *= np.sqrt(pixelWeights)[:, np.newaxis]
+    
+    return np.r_[w[0] / numPixels * r.flatten('F'), w[1] * texCoef ** 2 / model.texEval]
 
-def textureJacobian(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), randomFaces = None):
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+def textureJacobian(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), randomFaces = None, pixelWeights = None):
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, vertexColor.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True)[2:]
+    pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True, attachments = ('barycentric', 'faceID'))[2:]
     
     if randomFaces is not None:
         numPixels = randomFaces.size
@@ -173,7 +524,11 @@ def textureJacobian(texCoef, img, vertexCoord, model, renderObj, w = (1, 1), ran
     for c in range(3):
         J_texCoef[c*numPixels: (c+1)*numPixels, :] = barycentricReconstruction(model.texEvec[c].T, pixelFaces, pixelBarycentricCoords, model.face)
     
-    return np.r_[w[0] / numPixels * J_texCoef, w[1] * np.diag(texCoef / model.texEval)]
+    if pixelWeights is not None:
+        J_texCoef *= np.tile(np.sqrt(pixelWeights), 3)[:, np.newaxis]
+    
+    # The regularization block is diagonal, so it is stored sparsely, as in textureLightingJacobian
+    return sparse.bmat([[w[0] / numPixels * J_texCoef], [sparse.diags(2 * w[1] * texCoef / model.texEval)]], format = 'csr')
 
 def textureLightingCost(texParam, img, vertexCoord, sh, model, renderObj, w = (1, 1), option = 'tl', constCoef = None):
     """
@@ -194,10 +549,10 @@ def textureLightingCost(texParam, img, vertexCoord, sh, model, renderObj, w = (1
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, texture.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    rendering, pixelCoord = renderObj.grabRendering(return_info = True)[:2]
+    rendering, pixelCoord = renderObj.grabRendering(return_info = True, attachments = ('rendering', 'faceID'))[:2]
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
     # Color matching cost
     r = (rendering - img).flatten()
@@ -222,7 +577,7 @@ def textureLightingGrad(texParam, img, vertexCoord, sh, model, renderObj, w = (1
         texCoef = constCoef
         shCoef = texParam.reshape(9, 3)
         
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     texture = generateTexture(vertexCoord, np.r_[texCoef, shCoef.flatten()], model)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, texture.T])
@@ -231,8 +586,8 @@ def textureLightingGrad(texParam, img, vertexCoord, sh, model, renderObj, w = (1
     rendering, pixelCoord, pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True)
     numPixels = pixelFaces.size
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
     pixelVertices = model.face[pixelFaces, :]
     
@@ -259,7 +614,7 @@ def textureLightingGrad(texParam, img, vertexCoord, sh, model, renderObj, w = (1
     elif option is 'l':
         return 2 * w[0] * np.r_[r[:, 0].dot(J_shCoef[0]), r[:, 1].dot(J_shCoef[1]), r[:, 2].dot(J_shCoef[2])] / numPixels
     
-def textureLightingResiduals(texParam, img, vertexCoord, sh, model, renderObj, w = (1, 1), randomFaces = None):
+def textureLightingResiduals(texParam, img, vertexCoord, sh, model, renderObj, w = (1, 1), randomFaces = None, pixelWeights = None):
     """
     Energy formulation for fitting texture and spherical harmonic lighting coefficients
     """
@@ -271,7 +626,7 @@ def textureLightingResiduals(texParam, img, vertexCoord, sh, model, renderObj, w
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, texture.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    rendering, pixelCoord = renderObj.grabRendering(return_info = True)[:2]
+    rendering, pixelCoord = renderObj.grabRendering(return_info = True, attachments = ('rendering', 'faceID'))[:2]
     
     if randomFaces is not None:
         numPixels = randomFaces.size
@@ -279,22 +634,33 @@ def textureLightingResiduals(texParam, img, vertexCoord, sh, model, renderObj, w
     else:
         numPixels = pixelCoord.shape[0]
     
-    rendering = rendering[pixelCoord[:, 0], pixelCoord[:, 1]]
-    img = img[pixelCoord[:, 0], pixelCoord[:, 1]]
+    rendering = renderedPixels(rendering, pixelCoord, renderObj)
+    img = imagePixels(img, pixelCoord)
     
-    return np.r_[w[0] / numPixels * (rendering - img).flatten('F'), w[1] * texCoef ** 2 / model.texEval]
+    r = rendering - img
+    if pixelWeights is not None:
+        r *= np.sqrt(pixelWeights)[:, np.newaxis]
+    
+    return np.r_[w[0] / numPixels * r.flatten('F'), w[1] * texCoef ** 2 / model.texEval]
 
-def textureLightingJacobian(texParam, img, vertexCoord, sh, model, renderObj, w = (1, 1), randomFaces = None):
+def textureLightingJacobian(texParam, img, vertexCoord, sh, model, renderObj, w = (1, 1), randomFaces = None, pixelWeights = None):
+    """Jacobian of :func:`textureLightingResiduals` with respect to the texture and spherical harmonic lighting coefficients.
+    
+    Each color channel of a pixel only depends on the nine lighting coefficients of that channel, and the regularization residuals only depend on the texture coefficients, so the Jacobian is returned as a sparse matrix. Use it with ``least_squares(..., tr_solver = 'lsmr')``.
+    
+    Returns:
+        scipy.sparse.csr_matrix, (3*numPixels + numTex, numTex + 27): Jacobian of the residuals
+    """
     texCoef = texParam[:model.numTex]
     shCoef = texParam[model.numTex:].reshape(9, 3)
     
-    vertexColor = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+    vertexColor = model.texMean + basisDot(model, 'tex', texCoef)
     texture = generateTexture(vertexCoord, np.r_[texCoef, shCoef.flatten()], model)
     
     renderObj.updateVertexBuffer(np.r_[vertexCoord.T, texture.T])
     renderObj.resetFramebufferObject()
     renderObj.render()
-    pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True)[2:]
+    pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True, attachments = ('barycentric', 'faceID'))[2:]
     
     if randomFaces is not None:
         numPixels = randomFaces.size
@@ -304,18 +670,467 @@ def textureLightingJacobian(texParam, img, vertexCoord, sh, model, renderObj, w
         numPixels = pixelFaces.size
         
     pixelVertices = model.face[pixelFaces, :]
+    lighting = np.dot(shCoef.T, sh)
     
-    pixelTexture = barycentricReconstruction(vertexColor, pixelFaces, pixelBarycentricCoords, model.face)
-    pixelSHBasis = barycentricReconstruction(sh, pixelFaces, pixelBarycentricCoords, model.face)
-    J_shCoef = np.einsum('ij,ik->jik', pixelTexture, pixelSHBasis)
+    # The rendering interpolates the lit vertex colors, so the derivatives of the lit colors are taken at the vertices of the rendered faces before their barycentric combination
+    J_shCoef = np.einsum('pi,kpi,cpi->cpk', pixelBarycentricCoords, sh[:, pixelVertices], vertexColor[:, pixelVertices])
     
     J_texCoef = np.empty((pixelVertices.size, texCoef.size))
     for c in range(3):
-        pixelTexEvecsCombo = barycentricReconstruction(model.texEvec[c].T, pixelFaces, pixelBarycentricCoords, model.face)
-        pixelSHLighting = barycentricReconstruction(np.dot(shCoef[:, c], sh), pixelFaces, pixelBarycentricCoords, model.face)
-        J_texCoef[c*numPixels: (c+1)*numPixels, :] = pixelSHLighting * pixelTexEvecsCombo[np.newaxis, ...]
+        J_texCoef[c*numPixels: (c+1)*numPixels, :] = np.einsum('pi,pik->pk', pixelBarycentricCoords, model.texEvec[c, pixelVertices, :] * lighting[c, pixelVertices, np.newaxis])
+    
+    if pixelWeights is not None:
+        J_texCoef *= np.tile(np.sqrt(pixelWeights), 3)[:, np.newaxis]
+        J_shCoef *= np.sqrt(pixelWeights)[:, np.newaxis]
+    
+    # The lighting coefficients are flattened from shCoef, (9, 3), so the column of the kth coefficient of channel c is k*3 + c rather than the c*9 + k of the per-channel blocks
+    J_shCoef = sparse.block_diag(J_shCoef, format = 'csc')[:, np.arange(27).reshape(3, 9).T.flatten()]
+    
+    # Only the non-zero blocks are stored: the dense texture block, the per-channel lighting blocks, and the diagonal regularization block
+    return sparse.bmat([[w[0] / numPixels * J_texCoef, w[0] / numPixels * J_shCoef], [sparse.diags(2 * w[1] * texCoef / model.texEval), None]], format = 'csr')
+
+def textureLightingAlternating(img, vertexCoord, sh, model, renderObj, texCoef = None, w = (1, 1), numIters = 10, tol = 1e-4, robust = True, fScale = 0.1, randomFaces = None, pixelWeights = None):
+    """Fits the texture and spherical harmonic lighting coefficients with the 3DMM geometry held fixed, by alternating between closed-form solutions for the lighting given the texture and for the texture given the lighting. If ``robust``, the normal equations are reweighted with the soft L1 loss (IRLS).
+    
+    Args:
+        texCoef (ndarray): Optional, initial texture coefficients
+        w (tuple): Weights for the color matching and texture regularization costs
+        numIters (int): Maximum number of alternations
+        tol (float): Stop when the cost decreases by less than this fraction
+        fScale (float): Soft margin between inlier and outlier residuals for the soft L1 loss
+        randomFaces (ndarray): Optional, indices of a subset of the rendered pixels to fit to, e.g., from :class:`PixelSampler`, so that the per-pixel texture eigenvectors are only reconstructed for these pixels
+        pixelWeights (ndarray): Optional, weights of the squared residuals of the pixels in ``randomFaces``
+    
+    Returns:
+        ndarray: Texture coefficients followed by the flattened spherical harmonic lighting coefficients, as in :func:`mm.utils.mesh.generateTexture`
+    """
+    if texCoef is None:
+        texCoef = np.zeros(model.numTex)
+    
+    # The pixel coverage only depends on the geometry, so one rendering is enough for all of the passes
+    renderObj.updateVertexBuffer(np.r_[vertexCoord.T, model.texMean.T])
+    renderObj.resetFramebufferObject()
+    renderObj.render()
+    pixelCoord, pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True, attachments = ('barycentric', 'faceID'))[1:]
+    
+    if randomFaces is not None:
+        pixelCoord = pixelCoord[randomFaces, :]
+        pixelFaces = pixelFaces[randomFaces]
+        pixelBarycentricCoords = pixelBarycentricCoords[randomFaces, :]
+    numPixels = pixelFaces.size
+    
+    img = imagePixels(img, pixelCoord)
+    
+    # Per-pixel barycentric reconstructions of the texture mean and eigenvectors, (3, numPixels) and (3, numPixels, numTex), and of the spherical harmonic bases, (numPixels, 9)
+    pixelTexMean = barycentricReconstruction(model.texMean, pixelFaces, pixelBarycentricCoords, model.face).T
+    pixelTexEvec = np.empty((3, numPixels, model.numTex))
+    for c in range(3):
+        pixelTexEvec[c] = barycentricReconstruction(model.texEvec[c].T, pixelFaces, pixelBarycentricCoords, model.face)
+    pixelSHBasis = barycentricReconstruction(sh, pixelFaces, pixelBarycentricCoords, model.face)
+    
+    # The texture regularization, scaled like the color matching term of the normal equations below
+    texReg = w[1] / w[0] * numPixels / model.texEval
+    
+    if pixelWeights is None:
+        pixelWeights = np.ones(numPixels)
+    
+    weights = np.tile(pixelWeights, (3, 1))
+    shCoef = np.empty((9, 3))
+    prevCost = np.inf
+    for i in range(numIters):
+        pixelTexture = pixelTexMean + np.dot(pixelTexEvec, texCoef)
+        
+        # Lighting given texture: a separate 9-parameter weighted linear least squares problem for each color channel
+        for c in range(3):
+            A = pixelTexture[c, :, np.newaxis] * pixelSHBasis
+            AtW = A.T * weights[c]
+            shCoef[:, c] = np.linalg.lstsq(AtW.dot(A), AtW.dot(img[:, c]), rcond = None)[0]
+        
+        pixelLighting = np.dot(pixelSHBasis, shCoef).T
+        
+        # Texture given lighting: the color channels share the texture coefficients, so their normal equations are summed
+        AtWA = np.diag(texReg)
+        AtWb = np.zeros(model.numTex)
+        for c in range(3):
+            A = pixelLighting[c, :, np.newaxis] * pixelTexEvec[c]
+            AtW = A.T * weights[c]
+            AtWA += AtW.dot(A)
+            AtWb += AtW.dot(img[:, c] - pixelLighting[c] * pixelTexMean[c])
+        texCoef = np.linalg.solve(AtWA, AtWb)
+        
+        r = pixelLighting * (pixelTexMean + np.dot(pixelTexEvec, texCoef)) - img.T
+        
+        if robust:
+            z = (r / fScale) ** 2
+            weights = pixelWeights / np.sqrt(1 + z)
+            Ecol = np.sum(pixelWeights * 2 * fScale ** 2 * (np.sqrt(1 + z) - 1)) / numPixels
+        else:
+            Ecol = np.sum(pixelWeights * r ** 2) / numPixels
+        
+        cost = w[0] * Ecol + w[1] * np.sum(texCoef ** 2 / model.texEval)
+        if prevCost - cost < tol * cost:
+            break
+        prevCost = cost
+    
+    return np.r_[texCoef, shCoef.flatten()]
+
+def imageGradient(img, pixelCoord):
+    """Central difference approximations of the image gradient at a set of pixels, using one-sided differences at the borders of the image.
+    
+    Args:
+        img (ndarray, (height, width, numChannels)): Image
+        pixelCoord (ndarray, (numPixels, 2)): (row, column) coordinates of the pixels
+    
+    Returns:
+        tuple: Derivatives of the image with respect to x (along the columns) and to y (along the rows) at the pixels, each (numPixels, numChannels)
+    """
+    height, width = img.shape[:2]
+    row, col = pixelCoord[:, 0], pixelCoord[:, 1]
+    
+    left = np.maximum(col - 1, 0)
+    right = np.minimum(col + 1, width - 1)
+    up = np.maximum(row - 1, 0)
+    down = np.minimum(row + 1, height - 1)
+    
+    dI_dx = (imagePixels(img, np.c_[row, right]) - imagePixels(img, np.c_[row, left])) / (right - left)[:, np.newaxis]
+    dI_dy = (imagePixels(img, np.c_[down, col]) - imagePixels(img, np.c_[up, col])) / (down - up)[:, np.newaxis]
+    
+    return dI_dx, dI_dy
+
+def shapeTextureLightingResiduals(param, img, target, sh, model, pixelFaces, pixelBarycentricCoords, w = (1, 1, 1), pixelWeights = None):
+    """Residuals for fitting the shape, pose, texture, and lighting jointly by analysis-by-synthesis. These are the photometric residuals between the 3DMM and the image at a set of points on the 3DMM surface, the landmark residuals of :func:`initialShapeCost`, and the regularization residuals of the shape and texture parameters.
+    
+    The surface points are given by their triangular faces and barycentric coordinates, e.g., those of the pixels of a rendering of the 3DMM with the initial parameters, and they should be kept fixed over an optimization, like the vertices of :func:`vertexPhotometricResiduals`. The color of each surface point is the barycentric combination of the lit vertex colors, and the image is bilinearly interpolated at the orthographic projection of the point (see :func:`bilinearSample`), so the residuals are differentiable with respect to the shape and pose parameters. Changes in the visibility of the surface points are only accounted for when they are sampled again from a new rendering. The spherical harmonic bases are also kept fixed.
+    
+    Args:
+        param (ndarray): Concatenation of the shape identity parameters, the shape facial expression parameters, the three Euler angles, the x and y translations, the scaling factor, the texture parameters, and the flattened (9, 3) spherical harmonic lighting parameters
+        img (ndarray, (height, width, 3)): Image to fit
+        target (ndarray, (numLandmarks, 2)): 2D landmarks in the image corresponding to ``model.sourceLMInd``
+        sh (ndarray): Spherical harmonic bases evaluated at the vertex normals, (9, numVertices)
+        model (MeshModel): 3DMM MeshModel class object
+        pixelFaces (ndarray): Triangular face IDs of the surface points, (numPixels,)
+        pixelBarycentricCoords (ndarray): Barycentric coordinates of the surface points in their triangular faces, (numPixels, 3)
+        w (tuple): Weights for the photometric, landmark, and regularization residuals
+        pixelWeights (ndarray): Optional, weights of the squared photometric residuals of the surface points, e.g., from :meth:`PixelSampler.sample`
+    
+    Returns:
+        ndarray, (3*numPixels + 2*numLandmarks + numId + numExp + numTex,): Residuals
+    """
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    shapeParam = param[: model.numId + model.numExp + 6]
+    texCoef = param[model.numId + model.numExp + 6:][:model.numTex]
+    shCoef = param[model.numId + model.numExp + 6 + model.numTex:].reshape(9, 3)
+    numPixels = pixelFaces.size
+    
+    # Orthographically project the 3DMM with the current shape and pose, inserting the z translation, and light it with the current texture and lighting
+    vertexCoord = generateFace(np.r_[shapeParam[:-1], 0, shapeParam[-1]], model)
+    vertexColor = (model.texMean + basisDot(model, 'tex', texCoef)) * np.dot(shCoef.T, sh)
+    
+    # Colors of the surface points and the image at their projections
+    pixelBarycentricCoords = pixelBarycentricCoords.astype(np.float64)
+    pixelProj = barycentricReconstruction(vertexCoord[:2, :], pixelFaces, pixelBarycentricCoords, model.face)
+    pixelColor = barycentricReconstruction(vertexColor, pixelFaces, pixelBarycentricCoords, model.face)
     
-    texCoefSide = np.r_[w[0] / numPixels * J_texCoef, w[1] * np.diag(texCoef / model.texEval)]
-    shCoefSide = np.r_[w[0] / numPixels * block_diag(*J_shCoef), np.zeros((texCoef.size, shCoef.size))]
+    r = pixelColor - bilinearSample(img, pixelProj[:, 0], pixelProj[:, 1])[0]
+    if pixelWeights is not None:
+        r *= np.sqrt(pixelWeights)[:, np.newaxis]
     
-    return np.c_[texCoefSide, shCoefSide]
\ No newline at end of file
+    # Landmark residuals
+    source = vertexCoord[:2, model.sourceLMInd]
+    rlan = (source - target.T).flatten('F')
+    
+    return np.r_[w[0] / numPixels * r.flatten('F'), w[1] / model.sourceLMInd.size * rlan, w[2] * np.r_[idCoef / np.sqrt(model.idEval), expCoef / np.sqrt(model.expEval), texCoef / np.sqrt(model.texEval)]]
+
+def shapeTextureLightingJacobian(param, img, target, sh, model, pixelFaces, pixelBarycentricCoords, w = (1, 1, 1), pixelWeights = None):
+    """Jacobian of :func:`shapeTextureLightingResiduals` with respect to the shape, pose, texture, and lighting parameters.
+    
+    The derivatives of the photometric residuals with respect to the shape and pose parameters chain the negated derivatives of the bilinearly interpolated image at the projected surface points with the derivatives of these projections, which are the barycentric combinations of the derivatives of the projected vertices. The derivatives with respect to the texture and lighting parameters are the barycentric combinations of the derivatives of the vertex colors, as in :func:`textureLightingJacobian`.
+    
+    Returns:
+        ndarray, (3*numPixels + 2*numLandmarks + numId + numExp + numTex, numId + numExp + 6 + numTex + 27): Jacobian of the residuals
+    """
+    idCoef = param[: model.numId]
+    expCoef = param[model.numId: model.numId + model.numExp]
+    angles = param[model.numId + model.numExp:][:3]
+    t = param[model.numId + model.numExp:][3: 5]
+    s = param[model.numId + model.numExp:][5]
+    texCoef = param[model.numId + model.numExp + 6:][:model.numTex]
+    shCoef = param[model.numId + model.numExp + 6 + model.numTex:].reshape(9, 3)
+    numPixels = pixelFaces.size
+    
+    R = rotMat2angle(angles)
+    shape = model.idMean + basisDot(model, 'id', idCoef) + basisDot(model, 'exp', expCoef)
+    texture = model.texMean + basisDot(model, 'tex', texCoef)
+    lighting = np.dot(shCoef.T, sh)
+    
+    # Barycentric combination of a per-vertex array, (..., numVertices, k) -> (..., numPixels, k)
+    pixelVertices = model.face[pixelFaces, :]
+    pixelBarycentricCoords = pixelBarycentricCoords.astype(np.float64)
+    def barycentricCombination(vertexArray):
+        return np.einsum('pi,...pik->...pk', pixelBarycentricCoords, vertexArray[..., pixelVertices, :])
+    
+    # Derivatives of the projected surface point under each pixel with respect to the shape and pose parameters, (2, numPixels, numId + numExp + 6)
+    pixelShape = barycentricCombination(shape[..., np.newaxis])[..., 0]
+    dproj_dalpha = s*np.tensordot(R[:2, :], barycentricCombination(model.idEvec), axes = 1)
+    dproj_ddelta = s*np.tensordot(R[:2, :], barycentricCombination(model.expEvec), axes = 1)
+    dproj_dpsi = s*np.dot(dR_dpsi(angles)[:2, :], pixelShape)
+    dproj_dtheta = s*np.dot(dR_dtheta(angles)[:2, :], pixelShape)
+    dproj_dphi = s*np.dot(dR_dphi(angles)[:2, :], pixelShape)
+    dproj_dt = np.broadcast_to(np.eye(2)[:, np.newaxis, :], (2, numPixels, 2))
+    dproj_ds = np.dot(R[:2, :], pixelShape)
+    dproj_dparam = np.concatenate((dproj_dalpha, dproj_ddelta, dproj_dpsi[..., np.newaxis], dproj_dtheta[..., np.newaxis], dproj_dphi[..., np.newaxis], dproj_dt, dproj_ds[..., np.newaxis]), axis = 2)
+    
+    # The photometric residuals subtract the image at the projected surface point, (3, numPixels, numId + numExp + 6)
+    pixelProj = s*np.dot(R[:2, :], pixelShape) + t[:, np.newaxis]
+    dI_dx, dI_dy = bilinearSample(img, pixelProj[0, :], pixelProj[1, :])[1:]
+    J_shape = -(dI_dx.T[..., np.newaxis] * dproj_dparam[0] + dI_dy.T[..., np.newaxis] * dproj_dparam[1])
+    
+    # Derivatives of the rendered colors with respect to the texture parameters, (3, numPixels, numTex). Only the vertices of the rendered faces are gathered from the texture eigenvectors, which also only dequantizes these vertices of a quantized 3DMM.
+    J_texCoef = np.einsum('pi,cpik->cpk', pixelBarycentricCoords, model.texEvec[:, pixelVertices, :] * lighting[:, pixelVertices, np.newaxis])
+    
+    # Each color channel only depends on its own nine lighting parameters, which are interleaved by channel in the flattened parameters
+    J_shCoef = np.zeros((3, numPixels, 9, 3))
+    for c in range(3):
+        J_shCoef[c, :, :, c] = barycentricCombination((texture[c, :] * sh)[..., np.newaxis])[..., 0].T
+    
+    Jcol = w[0] / numPixels * np.concatenate((J_shape, J_texCoef, J_shCoef.reshape((3, numPixels, 27))), axis = 2)
+    if pixelWeights is not None:
+        Jcol *= np.sqrt(pixelWeights)[:, np.newaxis]
+    Jcol = Jcol.reshape((3 * numPixels, -1))
+    numParam = Jcol.shape[1]
+    
+    # Landmark Jacobian, as in initialShapeGrad
+    lmShape = shape[:, model.sourceLMInd]
+    drV_dalpha = s*np.tensordot(R, model.idEvec[:, model.sourceLMInd, :], axes = 1)
+    drV_ddelta = s*np.tensordot(R, model.expEvec[:, model.sourceLMInd, :], axes = 1)
+    drV_dpsi = s*np.dot(dR_dpsi(angles), lmShape)
+    drV_dtheta = s*np.dot(dR_dtheta(angles), lmShape)
+    drV_dphi = s*np.dot(dR_dphi(angles), lmShape)
+    drV_dt = np.tile(np.eye(2), [model.sourceLMInd.size, 1])
+    drV_ds = np.dot(R, lmShape)
+    
+    Jlan = np.zeros((2 * model.sourceLMInd.size, numParam))
+    Jlan[:, :model.numId + model.numExp + 6] = w[1] / model.sourceLMInd.size * np.c_[drV_dalpha[:2, ...].reshape((2 * model.sourceLMInd.size, model.numId), order = 'F'), drV_ddelta[:2, ...].reshape((2 * model.sourceLMInd.size, model.numExp), order = 'F'), drV_dpsi[:2, :].flatten('F'), drV_dtheta[:2, :].flatten('F'), drV_dphi[:2, :].flatten('F'), drV_dt, drV_ds[:2, :].flatten('F')]
+    
+    # The regularization residuals are linear in the shape and texture parameters
+    Jreg = np.zeros((model.numId + model.numExp + model.numTex, numParam))
+    regInd = np.r_[np.arange(model.numId + model.numExp), model.numId + model.numExp + 6 + np.arange(model.numTex)]
+    Jreg[np.arange(regInd.size), regInd] = w[2] / np.sqrt(np.r_[model.idEval, model.expEval, model.texEval])
+    
+    return np.r_[Jcol, Jlan, Jreg]
+
+def gaussianPyramid(img, numLevels, sigma = 1):
+    """Builds a Gaussian pyramid of an image. Each level is blurred with a Gaussian filter and downsampled by averaging 2x2 blocks of pixels, so that the window coordinates of a level are exactly half of those of the level below it, given that pixel centers are at half-integer coordinates.
+    
+    Args:
+        img (ndarray, (height, width, numChannels)): Image, either of floats or of integers, e.g., ``np.uint8``
+        numLevels (int): Number of levels, including the image itself
+        sigma (float): Standard deviation of the Gaussian filter in pixels of the finer level
+    
+    Returns:
+        list: Images of the levels from the finest (the image itself) to the coarsest
+    """
+    pyramid = [img]
+    for level in range(1, numLevels):
+        # The coarser levels are always floats, so integer images are converted like in imagePixels
+        finer = pyramid[-1] / np.iinfo(img.dtype).max if np.issubdtype(pyramid[-1].dtype, np.integer) else pyramid[-1]
+        blurred = ndimage.gaussian_filter(finer, sigma = (sigma, sigma, 0))
+        height, width = blurred.shape[0] // 2, blurred.shape[1] // 2
+        pyramid.append(blurred[:2 * height, :2 * width].reshape((height, 2, width, 2, -1)).mean(axis = (1, 3)))
+    
+    return pyramid
+
+def coarseToFineFit(param, img, target, sh, model, renderObj, w = (1, 1, 1), maxNfev = (40, 20, 10), numRandomPixels = None, loss = 'soft_l1'):
+    """Fits the shape, pose, texture, and lighting with :func:`shapeTextureLightingResiduals` from coarse to fine over a Gaussian pyramid of the image (see :func:`gaussianPyramid`).
+    
+    Halving the image halves the window coordinates, so the scaled orthographic camera of a level is the full-resolution one with its scaling factor and translation scaled by the same factor as the image, and the landmarks are scaled likewise. The parameters fitted on one level initialize the next finer level. The renderer is set to the region of interest of each level, which is the current region of interest of ``renderObj`` scaled down, and it is restored afterwards.
+    
+    Args:
+        param (ndarray): Initial parameters, as in :func:`shapeTextureLightingResiduals`, for the full-resolution image
+        img (ndarray, (height, width, 3)): Image to fit
+        target (ndarray, (numLandmarks, 2)): 2D landmarks in the image corresponding to ``model.sourceLMInd``
+        sh (ndarray): Spherical harmonic bases evaluated at the vertex normals, (9, numVertices)
+        model (MeshModel): 3DMM MeshModel class object
+        renderObj (Render): Render object for the 3DMM
+        w (tuple): Weights for the photometric, landmark, and regularization residuals. The landmark weight is scaled on each level so that the landmark residuals keep their full-resolution pixel units.
+        maxNfev (tuple): Maximum number of residual evaluations on each level, from the coarsest to the finest. The number of levels is the length of this tuple.
+        numRandomPixels (int): Optional, number of rendered pixels to sample the surface points of each level from. All of the pixels rendered with the initial parameters of a level are used by default.
+        loss (str): Loss function for ``scipy.optimize.least_squares``
+    
+    Returns:
+        ndarray: Fitted parameters for the full-resolution image
+    """
+    numLevels = len(maxNfev)
+    pyramid = gaussianPyramid(img, numLevels)
+    
+    # Scaling factor and x and y translation in the parameters
+    poseInd = model.numId + model.numExp + np.r_[3, 4, 5]
+    
+    roi = (renderObj.xOffset, renderObj.yOffset, renderObj.width, renderObj.height)
+    param = param.copy()
+    
+    for level, levelNfev in zip(range(numLevels - 1, -1, -1), maxNfev):
+        scale = 2. ** -level
+        levelImg = pyramid[level]
+        
+        # Scale the region of interest to the level, keeping it inside the level's image
+        x0, y0 = roi[0] >> level, roi[1] >> level
+        x1 = min(-(-(roi[0] + roi[2]) >> level), levelImg.shape[1])
+        y1 = min(-(-(roi[1] + roi[3]) >> level), levelImg.shape[0])
+        renderObj.setROI(x0, y0, x1 - x0, y1 - y0)
+        
+        levelParam = param.copy()
+        levelParam[poseInd] *= scale
+        
+        # Sample a fixed set of the surface points under the pixels that are rendered with the initial parameters of the level, which is kept over the level's optimization
+        shapeParam = levelParam[: model.numId + model.numExp + 6]
+        vertexCoord = generateFace(np.r_[shapeParam[:-1], 0, shapeParam[-1]], model)
+        renderObj.updateVertexBuffer(np.r_[vertexCoord.T, model.texMean.T])
+        renderObj.resetFramebufferObject()
+        renderObj.render()
+        pixelFaces, pixelBarycentricCoords = renderObj.grabRendering(return_info = True, attachments = ('barycentric', 'faceID'))[2:]
+        numPixels = pixelFaces.size
+        if numPixels == 0:
+            continue
+        
+        if numRandomPixels is not None and numRandomPixels < numPixels:
+            randomFaces = np.random.choice(numPixels, numRandomPixels, replace = False)
+            pixelFaces = pixelFaces[randomFaces]
+            pixelBarycentricCoords = pixelBarycentricCoords[randomFaces, :]
+        
+        levelWeights = (w[0], w[1] / scale, w[2])
+        levelFit = least_squares(shapeTextureLightingResiduals, levelParam, jac = shapeTextureLightingJacobian, args = (levelImg, target * scale, sh, model, pixelFaces, pixelBarycentricCoords, levelWeights), loss = loss, max_nfev = levelNfev)
+        
+        param = levelFit['x']
+        param[poseInd] /= scale
+    
+    renderObj.setROI(*roi)
+    
+    return param
+
+class PixelSampler:
+    """Samples rendered pixels for stochastic photometric fits, i.e., for the ``randomFaces`` and ``pixelWeights`` arguments of the residual and Jacobian functions in this module.
+    
+    The pixels are drawn without replacement by Poisson sampling: each pixel is included independently with an inclusion probability proportional to its importance, capped at one, such that the expected number of samples is ``numSamples``. The weights of the sampled pixels are their Horvitz-Thompson weights, i.e., their inverse inclusion probabilities, scaled so that they are one for uniform sampling. Weighting the squared residuals of the sampled pixels with these gives an unbiased estimate of the mean squared residual over all of the rendered pixels. The importance is mixed with a uniform distribution so that no pixel gets a tiny inclusion probability and a huge weight.
+    
+    The importance of a pixel is one of:
+    
+    * ``'uniform'``: the same for all pixels
+    * ``'face'``: inversely proportional to the number of pixels in its triangular face, which stratifies the samples over the triangular faces instead of concentrating them on large ones
+    * ``'residual'``: proportional to the magnitude of its photometric residual
+    * ``'gradient'``: proportional to the magnitude of the image gradient, which determines how much the pixel constrains the shape and pose
+    
+    The number of samples follows a mini-batch schedule. After each fit on a mini-batch, :meth:`update` is called with the cost of the fit, and once the relative decrease of the cost falls below ``tol``, the number of samples is multiplied by ``growth``, up to ``maxSamples``. Early fits on small mini-batches then move the parameters cheaply, and later fits on large ones refine them.
+    
+    Args:
+        numSamples (int): Initial expected number of sampled pixels
+        importance (str): Importance of the pixels, ``'uniform'``, ``'face'``, ``'residual'``, or ``'gradient'``
+        uniformMix (float): Weight of the uniform distribution in the importance, between 0 and 1
+        growth (float): Factor to grow the number of samples by
+        maxSamples (int): Optional, maximum number of samples. By default, it is only limited by the number of rendered pixels.
+        tol (float): Relative decrease in the cost below which the number of samples grows
+    
+    Attributes:
+        numSamples (int): Current expected number of sampled pixels
+        importance (str): Importance of the pixels
+        uniformMix (float): Weight of the uniform distribution in the importance
+        growth (float): Factor to grow the number of samples by
+        maxSamples (int): Maximum number of samples
+        tol (float): Relative decrease in the cost below which the number of samples grows
+        prevCost (float): Cost of the previous fit with the current number of samples, or ``None``
+    """
+    def __init__(self, numSamples, importance = 'face', uniformMix = 0.1, growth = 2, maxSamples = None, tol = 1e-2):
+        if importance not in ('uniform', 'face', 'residual', 'gradient'):
+            raise ValueError("importance must be 'uniform', 'face', 'residual', or 'gradient'.")
+        
+        self.numSamples = numSamples
+        self.importance = importance
+        self.uniformMix = uniformMix
+        self.growth = growth
+        self.maxSamples = maxSamples
+        self.tol = tol
+        self.prevCost = None
+    
+    def inclusionProbabilities(self, importance, numSamples):
+        """Finds inclusion probabilities proportional to the importance that sum to the number of samples. The probabilities of the pixels whose probabilities would exceed one are set to one, and the remaining samples are redistributed among the other pixels until none exceed one.
+        
+        Args:
+            importance (ndarray): Non-negative importance of each pixel, (numPixels,)
+            numSamples (int): Expected number of samples, at most ``numPixels``
+        
+        Returns:
+            ndarray: Inclusion probability of each pixel, (numPixels,)
+        """
+        prob = np.empty(importance.size)
+        capped = np.zeros(importance.size, dtype = bool)
+        
+        while True:
+            prob[~capped] = importance[~capped] * (numSamples - capped.sum()) / importance[~capped].sum()
+            over = ~capped & (prob >= 1)
+            if not over.any():
+                break
+            capped |= over
+            prob[capped] = 1
+        
+        return prob
+    
+    def sample(self, pixelFaces, pixelCoord = None, img = None, pixelResiduals = None):
+        """Samples the rendered pixels.
+        
+        Args:
+            pixelFaces (ndarray): Triangular face IDs of the rendered pixels, (numPixels,)
+            pixelCoord (ndarray): Pixel coordinates of the rendered pixels, which are only needed for ``'gradient'`` importance, (numPixels, 2)
+            img (ndarray, (height, width, 3)): Image, which is only needed for ``'gradient'`` importance
+            pixelResiduals (ndarray): Photometric residuals of the rendered pixels, which are only needed for ``'residual'`` importance, (numPixels, 3)
+        
+        Returns:
+            tuple: Indices of the sampled pixels and their weights
+        """
+        numPixels = pixelFaces.size
+        
+        if self.importance == 'uniform':
+            importance = np.ones(numPixels)
+        elif self.importance == 'face':
+            importance = 1 / np.bincount(pixelFaces)[pixelFaces]
+        elif self.importance == 'residual':
+            importance = np.linalg.norm(pixelResiduals.reshape((numPixels, -1)), axis = 1)
+        elif self.importance == 'gradient':
+            dI_dx, dI_dy = imageGradient(img, pixelCoord)
+            importance = np.sqrt(np.sum(dI_dx ** 2 + dI_dy ** 2, axis = 1))
+        
+        meanImportance = importance.mean()
+        if meanImportance > 0:
+            importance = (1 - self.uniformMix) * importance / meanImportance + self.uniformMix
+        else:
+            importance = np.ones(numPixels)
+        
+        numSamples = min(self.numSamples, numPixels)
+        prob = self.inclusionProbabilities(importance, numSamples)
+        
+        randomFaces = np.flatnonzero(np.random.rand(numPixels) < prob)
+        pixelWeights = numSamples / (numPixels * prob[randomFaces])
+        
+        return randomFaces, pixelWeights
+    
+    def update(self, cost):
+        """Updates the mini-batch schedule with the cost of a fit on the current mini-batch. The costs of fits with different numbers of samples are not compared, since the residuals are normalized by the number of samples.
+        
+        Args:
+            cost (float): Cost of the fit
+        
+        Returns:
+            bool: Whether or not the number of samples grew
+        """
+        if self.prevCost is not None and self.prevCost - cost < self.tol * self.prevCost:
+            numSamples = int(self.numSamples * self.growth)
+            if self.maxSamples is not None:
+                numSamples = min(numSamples, self.maxSamples)
+            
+            if numSamples > self.numSamples:
+                self.numSamples = numSamples
+                self.prevCost = None
+                return True
+        
+        self.prevCost = cost
+        return False
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This module contains a tracker that fits the 3DMM pose and facial expression to a stream of 2D landmarks online, e.g., from a webcam, instead of looping over the files of a video like the scripts in bin/.
+"""
+
+import numpy as np
+import time
+from .optimize.camera import estimateCamMat, splitCamMat
+from .optimize.image import orthographicPoseFit
+from .utils.transform import rotMat2angle
+
+class LandmarkTracker:
+    """Tracks the pose and facial expression of a face with a fixed identity from the 2D landmarks of each frame, with an orthographic camera.
+    
+    With the identity fixed, the landmark residuals of a frame are linear in the facial expression parameters for a given similarity transform. The tracker predicts the parameters of each frame from the previous two frames with a constant velocity model, refines the similarity transform with Gauss-Newton steps (:func:`mm.optimize.image.orthographicPoseFit`), and solves for the facial expression parameters with the regularized pseudo-inverse of the expression eigenvectors at the landmarks. The normal equations of the pseudo-inverse are assembled from the Gram matrices cached on the model (``model.lmGram``), so nothing of the size of the full 3DMM is touched.
+    
+    Each frame is fitted with the full path, which alternates ``numIters`` times between the similarity transform and a new pseudo-inverse, unless the full path is expected to take longer than ``budget``. Then the cheaper path is taken instead, which does one Gauss-Newton step and reuses the pseudo-inverse of the last full fit. The time of the full path is tracked with an exponential moving average, and the full path is still taken every ``refreshInterval`` frames to keep the pseudo-inverse current.
+    
+    Args:
+        model (MeshModel): 3DMM MeshModel class object with the landmark basis (see :meth:`mm.models.MeshModel.landmarkBasis`)
+        idCoef (ndarray, (numId,)): Fixed shape identity parameters, e.g., fitted on the first frames of a video with :func:`mm.optimize.image.initialShapeFit`
+        w (tuple): Weights for the landmark and the facial expression regularization costs
+        budget (float): Latency budget per frame in seconds
+        numIters (int): Number of alternations between the similarity transform and the facial expression parameters in the full path
+        refreshInterval (int): Maximum number of consecutive frames that take the cheaper path
+        landmarkDetector (callable): Optional, function that returns the OpenPose landmarks of an image. If given, the frames passed to the tracker are images.
+    
+    Attributes:
+        param (ndarray): Parameters of the last frame, the concatenation of the shape identity parameters, the shape facial expression parameters, the three Euler angles, the x and y translations, and the scaling factor, as in :func:`mm.optimize.image.initialShapeCost`
+        velocity (ndarray): Change of the facial expression and similarity transform parameters between the last two frames
+        fullTime (float): Moving average of the time of the full path in seconds
+        latency (float): Time of the last frame in seconds
+        numFull (int): Number of frames that took the full path
+        numFast (int): Number of frames that took the cheaper path
+    """
+    def __init__(self, model, idCoef, w = (1, 1), budget = 0.01, numIters = 2, refreshInterval = 10, landmarkDetector = None):
+        self.model = model
+        self.idCoef = idCoef
+        self.budget = budget
+        self.numIters = numIters
+        self.refreshInterval = refreshInterval
+        self.landmarkDetector = landmarkDetector
+        
+        numLandmarks = model.sourceLMInd.size
+        
+        # The landmarks of the neutral face with the fixed identity, and the part of the landmark basis and its Gram matrices for the facial expressions
+        self.neutral = model.lmMean + np.tensordot(model.lmEvec[:, :, :model.numId], idCoef, axes = 1)
+        self.expEvec = np.ascontiguousarray(model.lmEvec[:, :, model.numId:])
+        self.expGram = np.ascontiguousarray(model.lmGram[:, :, model.numId:, model.numId:])
+        self.reg = w[1] * numLandmarks / w[0] / model.expEval
+        
+        self.reset()
+    
+    def reset(self):
+        """Forgets the previous frames, e.g., at a cut in a video or when the face is lost.
+        """
+        self.param = None
+        self.velocity = np.zeros(self.model.numExp + 6)
+        self.pinv = None
+        self.fullTime = 0
+        self.latency = 0
+        self.numFull = 0
+        self.numFast = 0
+        self.numSinceFull = 0
+    
+    def expressionPinv(self, pose):
+        """Regularized pseudo-inverse of the facial expression eigenvectors at the landmarks after the similarity transform ``pose``, which maps the landmark residuals of the neutral face to the facial expression parameters.
+        
+        Args:
+            pose (ndarray, (6,)): Euler angles, x and y translations, and scaling factor
+        
+        Returns:
+            ndarray, (numExp, 2*numLandmarks): Pseudo-inverse, for residuals ordered by x and then by y
+        """
+        R = rotMat2angle(pose[:3])[:2, :]
+        s = pose[5]
+        
+        A = s**2 * np.tensordot(np.dot(R.T, R), self.expGram, axes = 2)
+        A[np.diag_indices(self.model.numExp)] += self.reg
+        B = s * np.tensordot(R, self.expEvec, axes = 1).reshape((-1, self.model.numExp))
+        
+        return np.linalg.solve(A, B.T)
+    
+    def expressionSolve(self, pose, target, pinv):
+        """Facial expression parameters of the landmarks ``target`` for the similarity transform ``pose`` with the pseudo-inverse from :meth:`expressionPinv`.
+        """
+        R = rotMat2angle(pose[:3])[:2, :]
+        z = target.T - pose[3: 5, np.newaxis] - pose[5] * np.dot(R, self.neutral)
+        
+        return np.dot(pinv, z.flatten())
+    
+    def update(self, frame):
+        """Fits the pose and facial expression to one frame.
+        
+        Args:
+            frame (ndarray): OpenPose landmarks of the frame, (numOpenPoseLandmarks, 2) or with the confidence values in a third column, or an image if the tracker has a ``landmarkDetector``
+        
+        Returns:
+            ndarray: Parameters of the frame, see ``param``
+        """
+        start = time.perf_counter()
+        model = self.model
+        
+        if self.landmarkDetector is not None:
+            frame = self.landmarkDetector(frame)
+        target = frame[model.targetLMInd, :2]
+        
+        # Without landmarks, e.g., where OpenPose did not find a face, continue with the prediction
+        if not target.any():
+            if self.param is not None:
+                self.param = np.r_[self.idCoef, self.param[model.numId:] + self.velocity]
+            self.latency = time.perf_counter() - start
+            return self.param
+        
+        # Initialize the similarity transform of the first frame for the neutral face
+        if self.param is None:
+            s, angles, t = splitCamMat(estimateCamMat(target, self.neutral.T, 'orthographic'), 'orthographic')
+            prediction = np.r_[np.zeros(model.numExp), angles, t, s]
+            fast = False
+        else:
+            prediction = self.param[model.numId:] + self.velocity
+            fast = self.pinv is not None and self.fullTime > self.budget and self.numSinceFull < self.refreshInterval
+        
+        expCoef = prediction[:model.numExp]
+        pose = prediction[model.numExp:]
+        
+        if fast:
+            # Cheaper path: one Gauss-Newton step for the similarity transform and the pseudo-inverse of the last full path
+            pose = orthographicPoseFit(self.neutral + np.tensordot(self.expEvec, expCoef, axes = 1), target, pose)
+            expCoef = self.expressionSolve(pose, target, self.pinv)
+            
+            self.numFast += 1
+            self.numSinceFull += 1
+        
+        else:
+            # Full path: alternate between the similarity transform and the facial expression parameters with a new pseudo-inverse
+            for i in range(self.numIters):
+                pose = orthographicPoseFit(self.neutral + np.tensordot(self.expEvec, expCoef, axes = 1), target, pose)
+                self.pinv = self.expressionPinv(pose)
+                expCoef = self.expressionSolve(pose, target, self.pinv)
+            
+            self.numFull += 1
+            self.numSinceFull = 0
+        
+        param = np.r_[expCoef, pose]
+        if self.param is not None:
+            self.velocity = param - self.param[model.numId:]
+        self.param = np.r_[self.idCoef, param]
+        
+        self.latency = time.perf_counter() - start
+        if not fast:
+            self.fullTime = self.latency if self.numFull == 1 else 0.9 * self.fullTime + 0.1 * self.latency
+        
+        return self.param
+    
+    def track(self, frames):
+        """Fits the pose and facial expression to a stream of frames.
+        
+        Args:
+            frames (iterable): Frames, see :meth:`update`
+        
+        Yields:
+            ndarray: Parameters of each frame, see ``param``
+        """
+        for frame in frames:
+            yield self.update(frame)
+
+class KeyframeSchedule:
+    """Plans the fitting of a video from the 2D landmarks of all of its frames, so that the 3DMM is fully fitted only to keyframes.
+    
+    A frame whose landmarks moved less than ``staticTol`` pixels on average from the last fitted frame, or that has no landmarks, is static and reuses the parameters of the previous frame without being fitted. A frame becomes a keyframe when its landmarks moved more than ``motionTol`` pixels on average from the last keyframe, or after ``maxGap`` frames since the last keyframe. The first and last non-static frames are always keyframes. The remaining frames are in-between frames, which are initialized by interpolating the parameters of the keyframes on either side with :meth:`interpolate` and only refined, so the keyframes have to be fitted first (see ``order``).
+    
+    Args:
+        landmarks (ndarray, (numFrames, numLandmarks, 2)): 2D landmarks of each frame, e.g., from :class:`mm.utils.io.LandmarkStore`
+        frames (ndarray, (numFrames,)): Optional, labels of the frames, e.g., the frame numbers. The default is ``np.arange(numFrames)``.
+        staticTol (float): Mean landmark motion in pixels from the last fitted frame below which a frame is static
+        motionTol (float): Mean landmark motion in pixels from the last keyframe above which a frame is a keyframe
+        maxGap (int): Maximum number of frames between keyframes
+    
+    Attributes:
+        frames (ndarray): Labels of the frames
+        isKeyframe (ndarray): Whether each frame is a keyframe, (numFrames,)
+        isStatic (ndarray): Whether each frame is static, (numFrames,)
+        keyframes (ndarray): Labels of the keyframes
+        order (ndarray): Labels of the frames to fit in order: the keyframes, and then the in-between frames
+        reference (ndarray): Index of the frame whose parameters each frame uses, which is the frame itself if it is not static, (numFrames,)
+    """
+    def __init__(self, landmarks, frames = None, staticTol = 0.5, motionTol = 3, maxGap = 30):
+        numFrames = landmarks.shape[0]
+        if frames is None:
+            frames = np.arange(numFrames)
+        self.frames = np.asarray(frames)
+        
+        detected = landmarks.any(axis = (1, 2))
+        
+        self.isStatic = np.zeros(numFrames, dtype = bool)
+        self.isKeyframe = np.zeros(numFrames, dtype = bool)
+        self.reference = np.arange(numFrames)
+        
+        lastKeyframe = None
+        for i in range(numFrames):
+            # The motion of a static frame is measured from the frame whose parameters it reuses, so that slow drifts over many frames are not missed
+            if i > 0 and (not detected[i] or np.linalg.norm(landmarks[i] - landmarks[self.reference[i - 1]], axis = 1).mean() < staticTol):
+                self.isStatic[i] = True
+                self.reference[i] = self.reference[i - 1]
+                continue
+            
+            if lastKeyframe is None or i - lastKeyframe >= maxGap or np.linalg.norm(landmarks[i] - landmarks[lastKeyframe], axis = 1).mean() > motionTol:
+                self.isKeyframe[i] = True
+                lastKeyframe = i
+        
+        # The last non-static frame is a keyframe, so that every in-between frame has a keyframe on either side
+        self.isKeyframe[np.flatnonzero(~self.isStatic)[-1]] = True
+        
+        self.keyframes = self.frames[self.isKeyframe]
+        self.order = np.r_[self.keyframes, self.frames[~self.isKeyframe & ~self.isStatic]]
+    
+    def interpolate(self, frame, param):
+        """Linearly interpolates the parameters of an in-between frame from the keyframes on either side of it.
+        
+        Args:
+            frame: Label of the frame
+            param (ndarray, (numFrames, numParam)): Parameters of each frame, where the keyframes have been fitted
+        
+        Returns:
+            ndarray, (numParam,): Interpolated parameters
+        """
+        i = np.flatnonzero(self.frames == frame)[0]
+        keyInd = np.flatnonzero(self.isKeyframe)
+        
+        j = np.searchsorted(keyInd, i)
+        if keyInd[j] == i:
+            return param[i].copy()
+        
+        prev, next = keyInd[j - 1], keyInd[j]
+        a = (i - prev) / (next - prev)
+        
+        return (1 - a) * param[prev] + a * param[next]
+    
+    def fill(self, param):
+        """Copies the parameters of the fitted frames to the static frames that reuse them.
+        
+        Args:
+            param (ndarray, (numFrames, ...)): Parameters or other per-frame results, where the non-static frames have been fitted
+        
+        Returns:
+            ndarray: ``param`` with the rows of the static frames filled in
+        """
+        return param[self.reference]
@@ -4,8 +4,14 @@
 """
 import numpy as np
 import re
+import os
+import glob
+import json
+import warnings
 import librosa
 from sklearn.neighbors import NearestNeighbors
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 def importObj(fName, dataToImport = ['v', 'f']):
     """Returns the shape vertices and the list of vertex indices for each mesh face.
@@ -187,4 +193,222 @@ def speechProc(fName, numFrames, fps, kuro = False, return_extras = False):
     if return_extras:
         return audioFeaturesSampled, audioFeatures, timeVecVideo
     else:
-        return audioFeaturesSampled
\ No newline at end of file
+        return audioFeaturesSampled
+
+def importLandmarks(fName, dtype = int):
+    """Reads the 2D landmarks of a face from an OpenPose .json file, or from a .txt file with one comma-separated landmark per line.
+    
+    Args:
+        fName (str): Filename of the landmark file
+        dtype (type): Type of the landmarks from a .json file. The default truncates them to integers, as the scripts in ``bin/`` always have, which also truncates the confidences to 0 or 1, so use a float type to keep the confidences.
+    
+    Returns:
+        ndarray: (x, y, confidence) of each OpenPose landmark for a .json file, (numLandmarks, 3), or the landmark coordinates in a .txt file, (numLandmarks, numCoordinates)
+    """
+    if fName.endswith('.json'):
+        with open(fName, 'r') as fd:
+            lm = json.load(fd)
+        return np.array([l[0] for l in lm], dtype = dtype).squeeze()[:, :3]
+    
+    with open(fName, 'r') as fd:
+        return np.array([[int(coord) for coord in l.split(',')] for l in fd])
+
+def loadImage(fName):
+    """Decodes an image file without converting it to floats, so that an 8-bit image takes an eighth of the memory of its 64-bit float version. Use :func:`mm.optimize.image.imagePixels` to convert the pixels that are actually used to floats.
+    
+    Args:
+        fName (str): Filename of the image
+    
+    Returns:
+        ndarray: Image in its decoded type, usually ``np.uint8``, (height, width) or (height, width, numChannels)
+    """
+    # scikit-image is only needed to decode images, so it is not imported with the rest of the module
+    from skimage.io import imread
+    
+    return imread(fName)
+
+def loadVolume(fName, shape = (200, 192, 192), dtype = np.int8):
+    """Reads a raw volume file, e.g., from the Volumetric Regression Network (VRN).
+    
+    Args:
+        fName (str): Filename of the volume
+        shape (tuple): Shape of the volume
+        dtype (type): Type of the volume elements
+    
+    Returns:
+        ndarray: Volume
+    """
+    return np.fromfile(fName, dtype = dtype).reshape(shape)
+
+class FrameSource:
+    """Iterates over the frames of a video, loading the files for each frame (e.g., images, landmarks, volumes) in a background thread pool.
+    
+    While a frame is processed, the files for the next ``numPrefetch`` frames are already being loaded, so the time it takes to decode them is hidden as long as processing a frame takes longer than loading one. Image decoding and file reading release the GIL, so threads are enough to overlap them with the processing.
+    
+    Each file is given by a filename pattern, which is formatted with the frame number, and a function that loads the file. For example, to iterate over the frames of a video with their OpenPose landmarks::
+    
+        source = FrameSource(range(1, numFrames + 1), {'img': ('orig/{:0>5}.png', loadImage), 'lm': ('landmark/{:0>5}.json', importLandmarks)})
+        for frame, data in source:
+            img, lm = data['img'], data['lm']
+    
+    Args:
+        frames (iterable): Frame numbers
+        files (dict): Maps the name of each file to a tuple of its filename pattern and the function that loads it
+        numPrefetch (int): Number of frames to load ahead of the current one
+        numWorkers (int): Number of threads to load the files with
+    
+    Attributes:
+        frames (iterable): Frame numbers
+        files (dict): Maps the name of each file to a tuple of its filename pattern and the function that loads it
+        numPrefetch (int): Number of frames to load ahead of the current one
+        executor (ThreadPoolExecutor): Thread pool that loads the files
+    """
+    def __init__(self, frames, files, numPrefetch = 4, numWorkers = 2):
+        self.frames = frames
+        self.files = files
+        self.numPrefetch = numPrefetch
+        self.executor = ThreadPoolExecutor(max_workers = numWorkers)
+    
+    def load(self, frame):
+        """Starts loading the files for a frame.
+        
+        Args:
+            frame (int): Frame number
+        
+        Returns:
+            dict: Maps the name of each file to a ``Future`` of its contents
+        """
+        return {name: self.executor.submit(loader, pattern.format(frame)) for name, (pattern, loader) in self.files.items()}
+    
+    def __iter__(self):
+        frames = iter(self.frames)
+        pending = deque()
+        
+        # Start loading the first frames
+        for frame in frames:
+            pending.append((frame, self.load(frame)))
+            if len(pending) > self.numPrefetch:
+                break
+        
+        while pending:
+            frame, futures = pending.popleft()
+            yield frame, {name: future.result() for name, future in futures.items()}
+            
+            # The frame has been processed, so start loading the frame that is numPrefetch frames ahead of the next one
+            nextFrame = next(frames, None)
+            if nextFrame is not None:
+                pending.append((nextFrame, self.load(nextFrame)))
+    
+    def close(self):
+        """Shuts down the thread pool.
+        """
+        self.executor.shutdown(wait = False)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+def ingestLandmarks(landmarkDir, fNameOut, numLandmarks = 70):
+    """Converts a directory of per-frame OpenPose .json landmark files into a :class:`LandmarkStore`. The frame number of each file is taken from the digits in its filename, e.g., ``00042.json`` is frame 42. Frames where OpenPose did not find a face get zero landmarks with zero confidence, as do frames whose files are corrupt or partial, which are warned about.
+    
+    Args:
+        landmarkDir (str): Directory of the .json landmark files
+        fNameOut (str): Filename of the store, without the .npy extension
+        numLandmarks (int): Number of landmarks per frame
+    
+    Returns:
+        LandmarkStore: The new landmark store
+    """
+    fNames = glob.glob(os.path.join(landmarkDir, '*.json'))
+    frames = np.array([int(re.sub(r'\D', '', os.path.basename(fName))) for fName in fNames])
+    order = np.argsort(frames)
+    
+    # Write the landmarks straight into the memory-mapped file rather than collecting them in memory first
+    landmarks = np.lib.format.open_memmap(fNameOut + '.npy', mode = 'w+', dtype = np.float32, shape = (frames.size, numLandmarks, 3))
+    for row, i in enumerate(order):
+        try:
+            landmarks[row] = importLandmarks(fNames[i], np.float32)
+        except IndexError:
+            landmarks[row] = 0
+        except ValueError:
+            # A truncated or malformed file, or one with the wrong number of landmarks, is kept as a frame without a face rather than stopping the whole ingest
+            warnings.warn('Could not read the landmarks in {}, which is corrupt or partial; frame {} gets zero landmarks.'.format(fNames[i], frames[i]))
+            landmarks[row] = 0
+    landmarks.flush()
+    del landmarks
+    
+    np.save(fNameOut + '_frames.npy', frames[order])
+    
+    return LandmarkStore(fNameOut)
+
+class LandmarkStore:
+    """Memory-mapped store of the OpenPose landmarks for all of the frames of a video, created from the per-frame .json files with :func:`ingestLandmarks`.
+    
+    The store consists of a (numFrames, numLandmarks, 3) array of the (x, y, confidence) of each landmark in ``<fName>.npy``, and the frame number of each row of this array in ``<fName>_frames.npy``. The landmarks array is memory-mapped, so opening the store only reads the frame numbers, and the landmarks for any frame are looked up in constant time. Index the store with a frame number to get the landmarks for that frame, use :meth:`take` to get them for a range of frames, or use the :attr:`landmarks` array to get them for all of the stored frames at once::
+    
+        store = LandmarkStore('landmark')
+        lm = store[42][:, :2]
+        lmRange = store.take(np.arange(1, 101), fill = 0)[..., :2]
+        lmAll = store.landmarks[..., :2]
+    
+    Args:
+        fName (str): Filename of the store, without the .npy extension
+    
+    Attributes:
+        landmarks (ndarray): Memory-mapped (x, y, confidence) of each landmark for each frame, (numFrames, numLandmarks, 3)
+        frames (ndarray): Frame number of each row of ``landmarks``, (numFrames,)
+        rows (ndarray): Row of ``landmarks`` for each frame number, or -1 if there is no such frame, so use :meth:`take` rather than indexing ``landmarks`` with it
+    """
+    def __init__(self, fName):
+        self.landmarks = np.load(fName + '.npy', mmap_mode = 'r')
+        self.frames = np.load(fName + '_frames.npy')
+        
+        self.rows = np.full(self.frames.max() + 1 if self.frames.size else 0, -1, dtype = np.int64)
+        self.rows[self.frames] = np.arange(self.frames.size)
+    
+    def __len__(self):
+        return self.frames.size
+    
+    def __contains__(self, frame):
+        return 0 <= frame < self.rows.size and self.rows[frame] >= 0
+    
+    def __getitem__(self, frame):
+        """Gets the landmarks for a frame.
+        
+        Args:
+            frame (int): Frame number
+        
+        Returns:
+            ndarray: (x, y, confidence) of each landmark, (numLandmarks, 3)
+        """
+        if frame not in self:
+            raise KeyError('There are no landmarks for frame {}.'.format(frame))
+        
+        return np.array(self.landmarks[self.rows[frame]])
+    
+    def take(self, frames, fill = None):
+        """Gets the landmarks for several frames at once.
+        
+        Args:
+            frames (ndarray): Frame numbers, (numFrames,)
+            fill (float): Value of the landmarks for the frames that are not in the store, e.g., 0 to treat them like frames where OpenPose did not find a face, or ``np.nan``. If None, a missing frame raises a KeyError.
+        
+        Returns:
+            ndarray: (x, y, confidence) of each landmark for each frame, (numFrames, numLandmarks, 3)
+        """
+        frames = np.asarray(frames)
+        inStore = (frames >= 0) & (frames < self.rows.size)
+        rows = np.full(frames.shape, -1, dtype = np.int64)
+        rows[inStore] = self.rows[frames[inStore]]
+        missing = rows < 0
+        
+        if missing.any() and fill is None:
+            raise KeyError('There are no landmarks for frames {}.'.format(frames[missing].tolist()))
+        
+        lm = np.empty(frames.shape + self.landmarks.shape[1:], dtype = np.result_type(self.landmarks.dtype, fill) if fill is not None else self.landmarks.dtype)
+        lm[~missing] = self.landmarks[rows[~missing]]
+        lm[missing] = fill
+        
+        return lm
@@ -28,12 +28,56 @@ def generateFace(param, model, ind = None):
     
     # The eigenmodel, before rigid transformation and scaling
     if ind is None:
-        model = model.idMean + np.tensordot(model.idEvec, idCoef, axes = 1) + np.tensordot(model.expEvec, expCoef, axes = 1)
+        shape = model.idMean + basisDot(model, 'id', idCoef) + basisDot(model, 'exp', expCoef)
     else:
-        model = model.idMean[:, ind] + np.tensordot(model.idEvec[:, ind, :], idCoef, axes = 1) + np.tensordot(model.expEvec[:, ind, :], expCoef, axes = 1)
+        shape = model.idMean[:, ind] + basisDot(model, 'id', idCoef, ind) + basisDot(model, 'exp', expCoef, ind)
     
     # After rigid transformation and scaling
-    return s*np.dot(R, model) + t[:, np.newaxis]
+    return s*np.dot(R, shape) + t[:, np.newaxis]
+
+def basisDot(model, basis, coef, ind = None):
+    """Linear combination of the shape identity, shape facial expression, or texture eigenvectors of a 3DMM. If the eigenvectors have been sparsified with :meth:`mm.models.MeshModel.sparsify`, only the vertices where they are not negligible are touched, and if they have been quantized with :meth:`mm.models.MeshModel.quantize`, they are converted to floats a block of vertices at a time.
+    
+    Args:
+        model (MeshModel): 3DMM MeshModel class object
+        basis (str): ``'id'`` for the shape identity eigenvectors, ``'exp'`` for the shape facial expression eigenvectors, or ``'tex'`` for the texture eigenvectors
+        coef (ndarray): Coefficients of the eigenvectors
+        ind (ndarray): Optional, a list of certain vertex indices in the 3DMM to return
+    
+    Returns:
+        ndarray: Linear combination at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+    """
+    sparseBasis = getattr(model, basis + 'Basis', None)
+    if sparseBasis is not None:
+        return sparseBasis.dot(coef, ind)
+    
+    evec = getattr(model, basis + 'Evec')
+    if ind is None:
+        return np.tensordot(evec, coef, axes = 1)
+    
+    return np.tensordot(evec[:, ind, :], coef, axes = 1)
+
+def basisTransposeDot(model, basis, r, ind = None):
+    """Inner products of the shape identity, shape facial expression, or texture eigenvectors of a 3DMM with values at the vertices, e.g., the gradient of a sum of squared vertex residuals with respect to the coefficients of the eigenvectors, without forming the Jacobian. If the eigenvectors have been sparsified with :meth:`mm.models.MeshModel.sparsify`, only the vertices where they are not negligible are touched, and if they have been quantized with :meth:`mm.models.MeshModel.quantize`, they are converted to floats a block of vertices at a time.
+    
+    Args:
+        model (MeshModel): 3DMM MeshModel class object
+        basis (str): ``'id'`` for the shape identity eigenvectors, ``'exp'`` for the shape facial expression eigenvectors, or ``'tex'`` for the texture eigenvectors
+        r (ndarray): Values at all of the vertices, (3, numVertices), or at ``ind``, (3, ind.size)
+        ind (ndarray): Optional, the vertex indices of ``r``
+    
+    Returns:
+        ndarray: Inner products, one for each eigenvector
+    """
+    sparseBasis = getattr(model, basis + 'Basis', None)
+    if sparseBasis is not None:
+        return sparseBasis.transposeDot(r, ind)
+    
+    evec = getattr(model, basis + 'Evec')
+    if ind is None:
+        return np.tensordot(evec, r, axes = ([0, 1], [0, 1]))
+    
+    return np.tensordot(evec[:, ind, :], r, axes = ([0, 1], [0, 1]))
 
 def generateTexture(vertexCoord, texParam, model):
     """Generates vertex colors based on the 3DMM eigenmodel, the vertex coordinates, and the texture parameters and spherical harmonic lighting parameters.
@@ -49,7 +93,7 @@ def generateTexture(vertexCoord, texParam, model):
     texCoef = texParam[:model.texEval.size]
     shCoef = texParam[model.texEval.size:].reshape(9, 3)
     
-    texture = model.texMean + np.tensordot(model.texEvec, texCoef, axes = 1)
+    texture = model.texMean + basisDot(model, 'tex', texCoef)
     
     # Evaluate spherical harmonics at face shape normals
     vertexNorms = calcNormals(vertexCoord, model)
@@ -100,6 +144,32 @@ def calcNormals(vertexCoord, model):
     
     return normalize(vNorm)
 
+def visibleVertices(vertexCoord, vertexNorms, width, height, cellSize = 4, depthTol = 10):
+    """Finds the vertices that are visible in an orthographic projection of the 3DMM onto the image plane without rasterizing the triangular faces. A vertex is visible if it projects inside the frame, its normal faces the viewer (i.e., it has a negative z-component, since the front faces are clockwise in window coordinates), and it is within ``depthTol`` of the nearest vertex in its cell of a coarse z-buffer.
+    
+    Args:
+        vertexCoord (ndarray): Vertex coordinates for the 3DMM in window space, (3, numVertices)
+        vertexNorms (ndarray): Per-vertex normal vectors from :func:`calcNormals`, (numVertices, 3)
+        width (int): Pixel width of the frame
+        height (int): Pixel height of the frame
+        cellSize (int): Pixel width and height of the cells of the z-buffer, which should be about the projected spacing between vertices so that each cell is covered by the nearest surface
+        depthTol (float): Depth tolerance for vertices behind the nearest vertex in a cell, in window space units
+    
+    Returns:
+        ndarray: Indices of the visible vertices
+    """
+    x, y, z = vertexCoord
+    
+    candidates = np.flatnonzero((vertexNorms[:, 2] < 0) & (x >= 0) & (x < width) & (y >= 0) & (y < height))
+    
+    # Keep the nearest depth in each cell of the z-buffer
+    gridWidth = -(-width // cellSize)
+    cellInd = (y[candidates] // cellSize).astype(int) * gridWidth + (x[candidates] // cellSize).astype(int)
+    zBuffer = np.full(gridWidth * -(-height // cellSize), np.inf)
+    np.minimum.at(zBuffer, cellInd, z[candidates])
+    
+    return candidates[z[candidates] <= zBuffer[cellInd] + depthTol]
+
 def subdivide(v, f):
     """Uses Catmull-Clark subdivision to subdivide a 3DMM with quadrilateral faces, increasing the number of faces by 4 times.
     
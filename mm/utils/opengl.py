@@ -1,10 +1,145 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from OpenGL.GL import *
-from OpenGL.GLUT import *
+"""This module renders 3DMMs offscreen with OpenGL.
+
+All of the :class:`Render` objects in a process share a single OpenGL context, which is created the first time that a :class:`Render` object is constructed. By default, the context comes from a hidden GLUT window, which requires a display. On headless machines, set the ``PYOPENGL_PLATFORM`` environment variable to ``egl`` (for a GPU) or ``osmesa`` (for software rendering with Mesa) before this module, or any other module that imports PyOpenGL, is imported.
+
+Since creating a :class:`Render` object compiles shaders and allocates GPU buffers, :func:`getRender` should be used when a mesh is rendered repeatedly at possibly different image sizes, e.g., for each frame of a video. It reuses the :class:`Render` objects in a process-wide pool. :func:`getRender` can also return a :class:`mm.utils.raster.SoftwareRender` object instead, which needs neither a GPU nor a display, and this module can be imported without PyOpenGL in that case.
+"""
+try:
+    from OpenGL.GL import *
+    from OpenGL.GLUT import *
+    from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as glReadPixelsToBuffer
+    hasOpenGL = True
+except ImportError:
+    hasOpenGL = False
+from .raster import SoftwareRender
 import numpy as np
+import ctypes
+import os
+from collections import deque
+
+# The OpenGL context shared by all Render objects, the shader programs compiled in it for indexed and non-indexed drawing, and the pool of Render objects used by getRender
+sharedContext = None
+shaderPrograms = {}
+renderPool = []
+
+def createContext():
+    """Creates the OpenGL context that is shared by all :class:`Render` objects in the process, if it has not been created already. The kind of context is chosen by the ``PYOPENGL_PLATFORM`` environment variable: ``egl`` and ``osmesa`` create headless contexts, and anything else creates a hidden GLUT window.
+    
+    Returns:
+        object: Handle of the OpenGL context
+    """
+    global sharedContext
+    if sharedContext is not None:
+        return sharedContext
+    
+    platform = os.environ.get('PYOPENGL_PLATFORM', '').lower()
+    if platform == 'egl':
+        sharedContext = createEGLContext()
+    elif platform == 'osmesa':
+        sharedContext = createOSMesaContext()
+    else:
+        # Since we're rendering offscreen to an FBO, we don't need to bother to display, which is why we hide the GLUT window.
+        glutInit()
+        sharedContext = glutCreateWindow('Merely creating an OpenGL context...')
+        glutHideWindow()
+    
+    return sharedContext
 
-def windowToClip(width, height, zNear, zFar):
+def createEGLContext():
+    """Creates a headless OpenGL 3.3 core profile context with EGL. No surface is needed because we only render to FBOs.
+    
+    Returns:
+        tuple: EGL display and context handles
+    """
+    from OpenGL import EGL
+    
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError('EGL display initialization failed.')
+    
+    configAttribs = (EGL.EGLint * 7)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_DEPTH_SIZE, 24, EGL.EGL_NONE)
+    config = EGL.EGLConfig()
+    numConfigs = EGL.EGLint()
+    if not EGL.eglChooseConfig(display, configAttribs, ctypes.pointer(config), 1, ctypes.pointer(numConfigs)) or numConfigs.value == 0:
+        raise RuntimeError('No EGL configuration supports offscreen OpenGL rendering.')
+    
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    contextAttribs = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3, EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, contextAttribs)
+    if context == EGL.EGL_NO_CONTEXT:
+        raise RuntimeError('EGL context creation failed.')
+    
+    if not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+        raise RuntimeError('Could not make the EGL context current.')
+    
+    return display, context
+
+def createOSMesaContext():
+    """Creates a headless OpenGL 3.3 core profile context with OSMesa. OSMesa needs a color buffer to make the context current, but we only render to FBOs, so a single pixel is enough.
+    
+    Returns:
+        tuple: OSMesa context handle and its color buffer
+    """
+    from OpenGL import osmesa
+    
+    attribs = (ctypes.c_int * 9)(osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA, osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE, osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3, osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3, 0)
+    context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+    if not context:
+        raise RuntimeError('OSMesa context creation failed.')
+    
+    colorBuffer = np.zeros((1, 1, 4), dtype = np.uint8)
+    if not osmesa.OSMesaMakeCurrent(context, colorBuffer, GL_UNSIGNED_BYTE, 1, 1):
+        raise RuntimeError('Could not make the OSMesa context current.')
+    
+    return context, colorBuffer
+
+def getRender(width, height, meshData, indexData, indexed = False, img = None, roi = None, backend = 'opengl'):
+    """Gets a :class:`Render` object for a mesh from the process-wide pool, so that the shaders and GPU buffers are only created once for each mesh topology. A pooled object with the same triangular faces and backend is resized if needed and loaded with the new mesh data, ROI, and background image, and a new object is created and added to the pool otherwise.
+    
+    Args:
+        width (int): Pixel width of the full frame
+        height (int): Pixel height of the full frame
+        meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
+        indexData (ndarray): 3DMM vertex indices for each triangular face
+        indexed (bool): Determines whether or not to do indexed OpenGL drawing
+        img (ndarray, (height, width, 1 or 3)): Optional background image for rendering, which is cropped to the ROI
+        roi (tuple): Optional, ``(x, y, width, height)`` of the region of the full frame to render (see :meth:`Render.setROI`). The full frame is rendered by default.
+        backend (str): Either ``'opengl'`` to render with OpenGL, or ``'software'`` to render with the NumPy rasterizer of :class:`mm.utils.raster.SoftwareRender`
+    
+    Returns:
+        Render or SoftwareRender: Render object with a cleared FBO that is ready to render the mesh
+    """
+    if backend == 'opengl':
+        if not hasOpenGL:
+            raise RuntimeError('PyOpenGL could not be imported. Use backend = \'software\' to render without OpenGL.')
+        renderClass = Render
+    elif backend == 'software':
+        renderClass = SoftwareRender
+    else:
+        raise ValueError("backend must be 'opengl' or 'software'.")
+    
+    x, y, roiWidth, roiHeight = roi if roi is not None else (0, 0, width, height)
+    
+    for renderObj in renderPool:
+        if type(renderObj) is renderClass and renderObj.indexed == indexed and renderObj.numVertices == meshData.shape[0] // 2 and np.array_equal(renderObj.indexData, indexData):
+            renderObj.updateVertexBuffer(meshData)
+            break
+    else:
+        renderObj = renderClass(roiWidth, roiHeight, meshData, indexData, indexed)
+        renderPool.append(renderObj)
+    
+    # Resize a pooled object to the ROI before clearing it, since the contents of a reallocated FBO are undefined until it is cleared
+    renderObj.setROI(x, y, roiWidth, roiHeight)
+    renderObj.resetFramebufferObject()
+    if img is not None:
+        renderObj.setBackground(img)
+    
+    return renderObj
+
+def windowToClip(width, height, zNear, zFar, xOffset = 0, yOffset = 0):
     """Creates elements for an OpenGL-style column-based orthographic transformation matrix that maps homogenous coordinates from window space to clip space.
     
     Args:
@@ -12,15 +147,17 @@ def windowToClip(width, height, zNear, zFar):
         height (int): Pixel height of window/viewport
         zNear (int): Nearside clipping plane
         zFar (int): Farside clipping plane
+        xOffset (int): Optional, window x-coordinate that is mapped to the left edge of the viewport
+        yOffset (int): Optional, window y-coordinate that is mapped to the bottom edge of the viewport
     
     Returns:
         ndarray, (16,): Vectorized transformation matrix
     """
     windowToClipMat = np.zeros(16, dtype = np.float32)
     windowToClipMat[0] = 2 / width
-    windowToClipMat[3] = -1
+    windowToClipMat[3] = -1 - 2 * xOffset / width
     windowToClipMat[5] = 2 / height
-    windowToClipMat[7] = -1
+    windowToClipMat[7] = -1 - 2 * yOffset / height
     windowToClipMat[10] = 2 / (zFar - zNear)
     windowToClipMat[11] = -(zFar + zNear) / (zFar - zNear)
     windowToClipMat[15] = 1
@@ -53,6 +190,55 @@ void main()
 """str: OpenGL GLSL vertex shader
 """
 
+indexedVertexShaderString = """
+#version 330
+
+layout(location = 0) in vec3 windowCoordinates;
+layout(location = 1) in vec3 vertexColor;
+
+out vec3 geometryColor;
+
+uniform mat4 windowToClipMat;
+
+void main()
+{
+    gl_Position = windowToClipMat * vec4(windowCoordinates, 1.0f);
+    geometryColor = vertexColor;
+}
+"""
+"""str: OpenGL GLSL vertex shader for indexed drawing
+"""
+
+geometryShaderString = """
+#version 330
+
+layout(triangles) in;
+layout(triangle_strip, max_vertices = 3) out;
+
+in vec3 geometryColor[];
+
+smooth out vec3 fragmentColor;
+smooth out vec3 fragmentBarycentricCoordinates;
+flat out uint fragmentFaceID;
+
+const vec3 barycentricBasis[3] = vec3[3](vec3(1., 0., 0.), vec3(0., 1., 0.), vec3(0., 0., 1.));
+
+void main()
+{
+    for (int i = 0; i < 3; i++)
+    {
+        gl_Position = gl_in[i].gl_Position;
+        fragmentColor = geometryColor[i];
+        fragmentBarycentricCoordinates = barycentricBasis[i];
+        fragmentFaceID = uint(gl_PrimitiveIDIn) + 1u;
+        EmitVertex();
+    }
+    EndPrimitive();
+}
+"""
+"""str: OpenGL GLSL geometry shader for indexed drawing. Since the vertices of a triangle are shared with its neighbors when doing indexed drawing, the barycentric coordinates and the triangular face ID (from the primitive ID of the draw call) are assigned to the vertices of each triangle here rather than being stored in the VBO.
+"""
+
 fragmentShaderString = """
 #version 330
 
@@ -82,7 +268,7 @@ class Render:
         height (int): Pixel height of window/viewport
         meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
         indexData (ndarray): 3DMM vertex indices for each triangular face
-        indexed (bool): Determines whether or not to do indexed OpenGL drawing
+        indexed (bool): Determines whether or not to do indexed OpenGL drawing. Indexed drawing stores each vertex once in the VBO and derives the barycentric coordinates and triangular face IDs in a geometry shader, whereas non-indexed drawing replicates the vertices of each triangular face in the VBO.
         img (ndarray, (height, width, 1 or 3)): Optional background image for rendering
             
     Attributes:
@@ -97,9 +283,18 @@ class Render:
         vertexDim (int): Dimensionality of 3DMM vertices
         indexed (bool): Determines whether or not to do indexed OpenGL drawing
         img (ndarray, (height, width, 1 or 3)): Optional background image for rendering
-        window (int): Instance of OpenGL GLUT context
+        xOffset (int): Full-frame x-coordinate (column) of the left edge of the rendered region, see :meth:`setROI`
+        yOffset (int): Full-frame y-coordinate (row) of the bottom edge of the rendered region, see :meth:`setROI`
+        context (object): Handle of the OpenGL context shared by all Render objects, see :func:`createContext`
         shaderDict (dict): Dictionary of OpenGL shader strings
+        shaderProgram (int): Handle of the shader program, which is shared by all Render objects that use the same kind of drawing
+        windowToClipMat (ndarray, (16,)): Window-to-clip space transform matrix, which is loaded into the shader program before each rendering
         numStoredVertices (int): Number of 3DMM vertices stored in the VBO
+        indexType (type): ``np.uint16``, or ``np.uint32`` if the mesh has more than 65,536 vertices
+        faceIDType (type): ``np.uint16``, or ``np.uint32`` if the mesh has 65,535 or more triangular faces
+        glIndexType (int): OpenGL type corresponding to ``indexType``
+        glFaceIDType (int): OpenGL type corresponding to ``faceIDType``
+        vertexBufferObject (int): Handle of the VBO for the mesh data
     """
     def __init__(self, width, height, meshData, indexData, indexed = False, img = None):
         # Initialize input
@@ -109,37 +304,48 @@ class Render:
         self.zFar = 1000
         
         self.meshData = meshData.astype(np.float32)
-        self.indexData = indexData.astype(np.uint16)
         
         self.numVertices = self.meshData.shape[0] // 2
-        self.numFaces = self.indexData.shape[0]
+        self.numFaces = indexData.shape[0]
         self.vertexDim = 3
         
+        # Use 32-bit vertex indices and face IDs for meshes that are too large for 16-bit ones. The face IDs are offset by one so that 0 can mark the background.
+        self.indexType = np.uint16 if self.numVertices <= np.iinfo(np.uint16).max + 1 else np.uint32
+        self.faceIDType = np.uint16 if self.numFaces + 1 <= np.iinfo(np.uint16).max else np.uint32
+        self.glIndexType = GL_UNSIGNED_SHORT if self.indexType is np.uint16 else GL_UNSIGNED_INT
+        self.glFaceIDType = GL_UNSIGNED_SHORT if self.faceIDType is np.uint16 else GL_UNSIGNED_INT
+        
+        self.indexData = indexData.astype(self.indexType)
+        
         self.indexed = indexed
         self.img = img
         
+        # The whole window is rendered until a region of interest is set
+        self.xOffset = 0
+        self.yOffset = 0
+        
         self.initializeContext()
     
     def initializeContext(self):
-        """Intializes an OpenGL context for rendering.
+        """Intializes the OpenGL objects for rendering in the shared OpenGL context, creating the context first if this is the first Render object in the process.
         """
-        # You can use any means to initialize an OpenGL context (e.g. GLUT), but since we're rendering offscreen to an FBO, we don't need to bother to display, which is why we hide the GLUT window.
-        glutInit()
-        self.window = glutCreateWindow('Merely creating an OpenGL context...')
-        glutHideWindow()
+        self.context = createContext()
         
         # Organize the strings defining our shaders into a dictionary
-        self.shaderDict = {GL_VERTEX_SHADER: vertexShaderString, GL_FRAGMENT_SHADER: fragmentShaderString}
+        if self.indexed:
+            self.shaderDict = {GL_VERTEX_SHADER: indexedVertexShaderString, GL_GEOMETRY_SHADER: geometryShaderString, GL_FRAGMENT_SHADER: fragmentShaderString}
+        else:
+            self.shaderDict = {GL_VERTEX_SHADER: vertexShaderString, GL_FRAGMENT_SHADER: fragmentShaderString}
         
-        # Use this dictionary to compile the shaders and link them to the GPU processors
-        self.initializeShaders()
+        # Use this dictionary to compile the shaders and link them to the GPU processors, unless another Render object has already done so
+        if self.indexed not in shaderPrograms:
+            self.initializeShaders()
+            shaderPrograms[self.indexed] = self.shaderProgram
+        self.shaderProgram = shaderPrograms[self.indexed]
         
         # A utility function to modify uniform inputs to the shaders
         self.configureShaders()
         
-        # Set the dimensions of the viewport
-        glViewport(0, 0, self.width, self.height)
-        
         # Performs face culling
         glEnable(GL_CULL_FACE)
         glCullFace(GL_BACK)
@@ -160,12 +366,13 @@ class Render:
             self.numStoredVertices = self.vertexDim * self.numFaces
             barycentricCoord = np.tile(np.eye(3, dtype = np.float32), (self.numFaces, 1))
             self.meshData = np.r_[self.meshData[:self.numVertices, :][self.indexData.flat], self.meshData[self.numVertices:, :][self.indexData.flat], barycentricCoord].astype(np.float32)
-            faceID = np.repeat(np.arange(self.numFaces, dtype = np.uint16), 3) + 1
+            faceID = np.repeat(np.arange(1, self.numFaces + 1, dtype = self.faceIDType), 3)
             
             self.initializeVertexBuffer(faceID)
             self.initializeVertexArray()
         
         self.initializeFramebufferObject()
+        self.initializePixelBufferObjects()
 
     def initializeShaders(self):
         """Compiles each shader defined in shaderDict, attaches them to a program object, and links them (i.e., creates executables that will be run on the vertex, geometry, and fragment processors on the GPU). This is more-or-less boilerplate.
@@ -201,20 +408,13 @@ class Render:
             glDeleteShader(shader)
     
     def configureShaders(self):
-        """Modifies the window-to-clip space transform matrix in the vertex shader, but you can use this to configure your shaders however you'd like, of course.
+        """Modifies the window-to-clip space transform matrix in the vertex shader, but you can use this to configure your shaders however you'd like, of course. Since the shader program is shared with other Render objects, the matrix is kept here and assigned to the shader program in :meth:`render`.
         """
         # Grabs the handle for the uniform input from the shader
-        windowToClipMatUnif = glGetUniformLocation(self.shaderProgram, "windowToClipMat")
+        self.windowToClipMatUnif = glGetUniformLocation(self.shaderProgram, "windowToClipMat")
         
         # Get input parameters to define a matrix that will be used as the uniform input
-        windowToClipMat = windowToClip(self.width, self.height, self.zNear, self.zFar)
-        
-        # Assign the matrix to the uniform input in our shader program. Note that GL_TRUE here transposes the matrix because of OpenGL conventions
-        glUseProgram(self.shaderProgram)
-        glUniformMatrix4fv(windowToClipMatUnif, 1, GL_TRUE, windowToClipMat)
-        
-        # We're finished modifying our shader, so we set the program to be used as null to be proper
-        glUseProgram(0)
+        self.windowToClipMat = windowToClip(self.width, self.height, self.zNear, self.zFar, self.xOffset, self.yOffset)
     
     def initializeVertexBuffer(self, faceID = None):
         """Assigns the triangular mesh data and the triplets of vertex indices that form the triangles (index data) to VBOs
@@ -223,13 +423,13 @@ class Render:
             faceID (ndarray): Optional, an array of triangular face ID numbers for each vertex. This is only used with non-indexed OpenGL drawing, where vertices are replicated in the VBO so that each set of three vertices corresponding to a triangular face can have a vertex attribute representing the index number of the triangular face.
         """
         # Create a handle and assign the VBO for the mesh data to it
-        self.shaderProgram = glGenBuffers(1)
+        self.vertexBufferObject = glGenBuffers(1)
         
         # Bind the VBO to the GL_ARRAY_BUFFER target in the OpenGL context
-        glBindBuffer(GL_ARRAY_BUFFER, self.shaderProgram)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertexBufferObject)
         
-        # Allocate enough memory for this VBO to contain the mesh data
-        glBufferData(GL_ARRAY_BUFFER, self.meshData, GL_STATIC_DRAW)
+        # Allocate enough memory for this VBO to contain the mesh data. This memory is kept for the lifetime of the VBO and is overwritten in place by updateVertexBuffer.
+        glBufferData(GL_ARRAY_BUFFER, self.meshData, GL_DYNAMIC_DRAW)
         
         # Unbind the VBO from the target to be proper
         glBindBuffer(GL_ARRAY_BUFFER, 0)
@@ -250,36 +450,39 @@ class Render:
     def updateVertexBuffer(self, meshData):
         """Updates the VBO with new 3DMM vertex coordinates and RGB colors without having to reinitialize the VBO.
         
+        The mesh data is written directly into the mapped VBO memory. For non-indexed drawing, the vertices of each triangular face are gathered into the mapped memory with ``np.take``, which still goes through a temporary buffer because the float64 mesh data is cast to the float32 VBO.
+        
         Args:
             meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
         """
-        # Set the VAO as the currently used object in the OpenGL context
-        glBindVertexArray(self.vertexArrayObject)
-        
         # Bind the VBO to the GL_ARRAY_BUFFER target in the OpenGL context
-        glBindBuffer(GL_ARRAY_BUFFER, self.shaderProgram)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertexBufferObject)
+        
+        # Map the part of the VBO that holds the vertex coordinates and colors. Invalidating the range lets the driver hand us fresh memory instead of waiting for any pending draw calls that read the old mesh data.
+        numStoredElements = 2 * self.numStoredVertices * self.vertexDim
+        pointer = glMapBufferRange(GL_ARRAY_BUFFER, 0, numStoredElements * 4, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_RANGE_BIT)
+        vertexBuffer = np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_float)), shape = (2 * self.numStoredVertices, self.vertexDim))
         
         # Replace the mesh data (vertex coordinates and colors) in the VBO
-        meshData = meshData.astype(np.float32)
-        if not self.indexed:
-            meshData = np.r_[meshData[:self.numVertices, :][self.indexData.flat], meshData[self.numVertices:, :][self.indexData.flat]].astype(np.float32)
+        if self.indexed:
+            vertexBuffer[...] = meshData
+        else:
+            np.take(meshData[:self.numVertices, :], self.indexData.ravel(), axis = 0, out = vertexBuffer[:self.numStoredVertices, :])
+            np.take(meshData[self.numVertices:, :], self.indexData.ravel(), axis = 0, out = vertexBuffer[self.numStoredVertices:, :])
         
-        glBufferSubData(GL_ARRAY_BUFFER, 0, meshData.nbytes, meshData)
+        glUnmapBuffer(GL_ARRAY_BUFFER)
         
         # Unbind the VBO from the target to be proper
         glBindBuffer(GL_ARRAY_BUFFER, 0)
-        
-        # Unset the VAO as the current object in the OpenGL context
-        glBindVertexArray(0)
     
     def initializeFramebufferObject(self):
         """Creates an FBO and assign a texture to it for the purpose of offscreen rendering. Also assigns textures to hold the barycentric coordinates and face IDs for each pixel during the rendering.
         """
         # Create a handle and assign a texture buffer to it
-        renderedTexture = glGenTextures(1)
+        self.renderedTexture = glGenTextures(1)
         
         # Bind the texture buffer to the GL_TEXTURE_2D target in the OpenGL context
-        glBindTexture(GL_TEXTURE_2D, renderedTexture)
+        glBindTexture(GL_TEXTURE_2D, self.renderedTexture)
         
         # Attach a texture 'img' (which should be of unsigned bytes) to the texture buffer. If you don't want a specific texture, you can just replace 'img' with 'None'.
         glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, self.width, self.height, 0, GL_RGB, GL_FLOAT, self.img)
@@ -292,26 +495,27 @@ class Render:
         glBindTexture(GL_TEXTURE_2D, 0)
         
         # Make a similar texture for the barycentric coordinates of each pixel
-        barycentricTexture = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, barycentricTexture)
+        self.barycentricTexture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.barycentricTexture)
         glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, self.width, self.height, 0, GL_RGB, GL_FLOAT, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glBindTexture(GL_TEXTURE_2D, 0)
         
         # Make a similar texture for the triangle face ID of each pixel
-        faceIDTexture = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, faceIDTexture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_R16UI, self.width, self.height, 0, GL_RED_INTEGER, GL_UNSIGNED_SHORT, None)
+        self.faceIDTexture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.faceIDTexture)
+        faceIDFormat = GL_R16UI if self.faceIDType is np.uint16 else GL_R32UI
+        glTexImage2D(GL_TEXTURE_2D, 0, faceIDFormat, self.width, self.height, 0, GL_RED_INTEGER, self.glFaceIDType, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glBindTexture(GL_TEXTURE_2D, 0)
         
         # Create a handle and assign a renderbuffer to it
-        depthRenderbuffer = glGenRenderbuffers(1)
+        self.depthRenderbuffer = glGenRenderbuffers(1)
         
         # Bind the renderbuffer to the GL_RENDERBUFFER target in the OpenGL context
-        glBindRenderbuffer(GL_RENDERBUFFER, depthRenderbuffer)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depthRenderbuffer)
         
         # Allocate enough memory for the renderbuffer to hold depth values for the texture
         glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT, self.width, self.height)
@@ -326,16 +530,16 @@ class Render:
         glBindFramebuffer(GL_FRAMEBUFFER, self.framebufferObject)
         
         # Attaches the texture buffer created above to the GL_COLOR_ATTACHMENT0 attachment point of the FBO
-        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, renderedTexture, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.renderedTexture, 0)
         
         # Attaches the barycentric buffer created above to the GL_COLOR_ATTACHMENT1 attachment point of the FBO
-        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT1, GL_TEXTURE_2D, barycentricTexture, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT1, GL_TEXTURE_2D, self.barycentricTexture, 0)
         
         # Attaches the faceID buffer created above to the GL_COLOR_ATTACHMENT2 attachment point of the FBO
-        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT2, GL_TEXTURE_2D, faceIDTexture, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT2, GL_TEXTURE_2D, self.faceIDTexture, 0)
         
         # Attaches the renderbuffer created above to the GL_DEPTH_ATTACHMENT attachment point of the FBO
-        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depthRenderbuffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depthRenderbuffer)
         
         # Defines which buffers the fragment shader will draw to
         glDrawBuffers(3, [GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1, GL_COLOR_ATTACHMENT2])
@@ -347,6 +551,63 @@ class Render:
         # Unbind the FBO, relinquishing the GL_FRAMEBUFFER back to the window manager (i.e. GLUT)
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
     
+    def deleteFramebufferObject(self):
+        """Deletes the FBO, its attachments, and the PBOs that they are read into.
+        """
+        glDeleteFramebuffers(1, [self.framebufferObject])
+        glDeleteTextures([self.renderedTexture, self.barycentricTexture, self.faceIDTexture])
+        glDeleteRenderbuffers(1, [self.depthRenderbuffer])
+        glDeleteBuffers(len(self.pixelBufferObjects) * 3, [pixelBuffer for pixelBuffers in self.pixelBufferObjects for pixelBuffer in pixelBuffers.values()])
+        self.pendingReadbacks.clear()
+    
+    def resize(self, width, height):
+        """Changes the size of the rendering. The FBO and PBOs are only reallocated if the size changes. The contents of a reallocated FBO are undefined until :meth:`resetFramebufferObject` is called.
+        
+        Args:
+            width (int): Pixel width of window/viewport
+            height (int): Pixel height of window/viewport
+        """
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.img = None
+            
+            self.deleteFramebufferObject()
+            self.configureShaders()
+            self.initializeFramebufferObject()
+            self.initializePixelBufferObjects()
+    
+    def setROI(self, x, y, width, height):
+        """Restricts the rendering to a region of interest (ROI) of the full frame, e.g., a bounding box around the face in a large video frame. The FBO is sized to the ROI and the window-to-clip space transform is translated so that the 3DMM is still given in full-frame window coordinates, so only the pixels in the ROI are rasterized and read back.
+        
+        The rendering returned by :meth:`grabRendering` covers only the ROI, with its first row and column at full-frame row ``y`` and column ``x``, whereas the pixel coordinates are reported in full-frame space. Use ``setROI(0, 0, frameWidth, frameHeight)`` to render the full frame again. Readbacks that are still pending when the ROI moves are discarded, since their pixel coordinates would be reported for the new ROI.
+        
+        Args:
+            x (int): Full-frame x-coordinate (column) of the left edge of the ROI
+            y (int): Full-frame y-coordinate (row) of the bottom edge of the ROI
+            width (int): Pixel width of the ROI
+            height (int): Pixel height of the ROI
+        """
+        if (int(x), int(y)) != (self.xOffset, self.yOffset):
+            self.pendingReadbacks.clear()
+        
+        self.xOffset = int(x)
+        self.yOffset = int(y)
+        self.resize(int(width), int(height))
+        self.configureShaders()
+    
+    def setBackground(self, img):
+        """Draws a background image into the rendering texture of the FBO, replacing anything drawn there. The image is cropped to the ROI.
+        
+        Args:
+            img (ndarray, (frameHeight, frameWidth, 3)): Full-frame background image for rendering
+        """
+        self.img = np.ascontiguousarray(img[self.yOffset: self.yOffset + self.height, self.xOffset: self.xOffset + self.width], dtype = np.float32)
+        
+        glBindTexture(GL_TEXTURE_2D, self.renderedTexture)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.width, self.height, GL_RGB, GL_FLOAT, self.img)
+        glBindTexture(GL_TEXTURE_2D, 0)
+    
     def resetFramebufferObject(self):
         """Erases any drawn objects from the FBO.
         """
@@ -371,7 +632,7 @@ class Render:
         glBindVertexArray(self.vertexArrayObject)
         
         # Bind the VBO for the mesh data to the GL_ARRAY_BUFFER target in the OpenGL context
-        glBindBuffer(GL_ARRAY_BUFFER, self.shaderProgram)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertexBufferObject)
         
         # Specify the location indices for the types of inputs to the shaders
         glEnableVertexAttribArray(0)
@@ -398,7 +659,7 @@ class Render:
             # Assign the face indices for each mesh triangle vertex as the fourth input to the shaders
             glBindBuffer(GL_ARRAY_BUFFER, self.faceIDBufferObject)
             glEnableVertexAttribArray(3)
-            glVertexAttribIPointer(3, 1, GL_UNSIGNED_SHORT, 0, None)
+            glVertexAttribIPointer(3, 1, self.glFaceIDType, 0, None)
         
         # Unset the VAO as the current object in the OpenGL context
         glBindVertexArray(0)
@@ -406,8 +667,12 @@ class Render:
     def render(self):
         """Renders the objects defined in the VAO to the FBO.
         """
-        # Defines what shaders to use
+        # Defines what shaders to use, and assigns this object's window-to-clip space transform matrix to the shared shader program. Note that GL_TRUE here transposes the matrix because of OpenGL conventions
         glUseProgram(self.shaderProgram)
+        glUniformMatrix4fv(self.windowToClipMatUnif, 1, GL_TRUE, self.windowToClipMat)
+        
+        # Set the dimensions of the viewport, which are shared with other Render objects in the OpenGL context
+        glViewport(0, 0, self.width, self.height)
         
         # Use our initialized FBO instead of the default GLUT framebuffer
         glBindFramebuffer(GL_FRAMEBUFFER, self.framebufferObject)
@@ -416,8 +681,8 @@ class Render:
         glBindVertexArray(self.vertexArrayObject)
         
         if self.indexed:
-            # Draws the mesh triangles defined in the VBO of the VAO above according to the vertices defining the triangles in indexData, which is of unsigned shorts
-            glDrawElements(GL_TRIANGLES, self.vertexDim * self.numFaces, GL_UNSIGNED_SHORT, None)
+            # Draws the mesh triangles defined in the VBO of the VAO above according to the vertices defining the triangles in indexData, which is of unsigned shorts or unsigned ints
+            glDrawElements(GL_TRIANGLES, self.vertexDim * self.numFaces, self.glIndexType, None)
         else:
             glDrawArrays(GL_TRIANGLES, 0, self.vertexDim * self.numFaces)
         
@@ -426,44 +691,136 @@ class Render:
         glUseProgram(0)
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
     
-    def grabRendering(self, return_info = False):
-        """Reads the rendered pixels from the FBO into an array.
+    def initializePixelBufferObjects(self):
+        """Creates two sets of PBOs to read the FBO attachments into. Reading into a PBO returns immediately, and alternating between the two sets lets the pixels from one rendering be transferred while the CPU works on the pixels from the previous one.
+        """
+        self.pixelBufferObjects = []
+        for i in range(2):
+            pixelBuffers = {}
+            for attachment in ('rendering', 'barycentric', 'faceID'):
+                # Allocate enough memory for the largest pixel type that the attachment can be read as
+                pixelBuffers[attachment] = glGenBuffers(1)
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffers[attachment])
+                glBufferData(GL_PIXEL_PACK_BUFFER, self.width * self.height * (4 if attachment == 'faceID' else 12), None, GL_STREAM_READ)
+            self.pixelBufferObjects.append(pixelBuffers)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        
+        # Index of the set of PBOs to read into next, and the queue of readbacks that have been started but not yet grabbed
+        self.pixelBufferIndex = 0
+        self.pendingReadbacks = deque()
+    
+    def readPixelsToBuffer(self, attachments = ('rendering', 'barycentric', 'faceID'), halfFloat = False):
+        """Starts reading the current contents of the FBO attachments into PBOs without waiting for the transfer to finish. The pixels are retrieved with :meth:`grabRendering`.
+        
+        Since there are two sets of PBOs, a readback can be started for the next rendering before grabbing the previous one. If two readbacks are already pending, the oldest one is discarded.
         
         Args:
-            return_info (bool): Optional, can choose whether or not to return the barycentric coordinates and triangular face IDs for each pixel. You can only get this extra information when doing non-indexed OpenGL drawing. If ``False``, it only returns the rendering. If ``True``, it returns a tuple containing the rendering, the pixel coordinates where the 3DMM is drawn, the triangular face IDs for each pixel where the 3DMM is drawn, and the barycentric coordinates of the triangular face underlying each pixel where the 3DMM is drawn.
-            
-        Returns:
-            ndarray or tuple
+            attachments (tuple): Names of the FBO attachments to read, any of ``'rendering'``, ``'barycentric'``, and ``'faceID'``
+            halfFloat (bool): Whether or not to read the rendering and the barycentric coordinates as 16-bit floats instead of 32-bit floats
         """
+        if len(self.pendingReadbacks) == 2:
+            self.pendingReadbacks.popleft()
+        
         # Use our initialized FBO instead of the default GLUT framebuffer
         glBindFramebuffer(GL_FRAMEBUFFER, self.framebufferObject)
         
-        # Configure how we store the pixels in memory for our subsequent reading of the FBO to store the rendering into memory. The second argument specifies that our pixels will be in bytes.
-    #    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        # Pack the rows of pixels tightly, since rows of 16-bit values do not necessarily end on a 4-byte boundary
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        
+        pixelBuffers = self.pixelBufferObjects[self.pixelBufferIndex]
+        for attachment in attachments:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffers[attachment])
+            
+            # With a PBO bound to GL_PIXEL_PACK_BUFFER, the last argument is an offset into the PBO rather than a pointer to client memory
+            if attachment == 'faceID':
+                glReadBuffer(GL_COLOR_ATTACHMENT2)
+                glReadPixelsToBuffer(0, 0, self.width, self.height, GL_RED_INTEGER, self.glFaceIDType, ctypes.c_void_p(0))
+            else:
+                glReadBuffer(GL_COLOR_ATTACHMENT0 if attachment == 'rendering' else GL_COLOR_ATTACHMENT1)
+                glReadPixelsToBuffer(0, 0, self.width, self.height, GL_RGB, GL_HALF_FLOAT if halfFloat else GL_FLOAT, ctypes.c_void_p(0))
+        
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        
+        self.pendingReadbacks.append((self.pixelBufferIndex, attachments, halfFloat))
+        self.pixelBufferIndex = 1 - self.pixelBufferIndex
+    
+    def mapPixelBuffer(self, pixelBuffer, dtype, shape):
+        """Maps a PBO to read its contents as an array. The array is only valid until the PBO is unmapped with ``glUnmapBuffer(GL_PIXEL_PACK_BUFFER)``.
+        
+        Args:
+            pixelBuffer (int): Handle of the PBO
+            dtype (type): Data type of the pixels in the PBO
+            shape (tuple): Shape of the array of pixels
+        
+        Returns:
+            ndarray: View of the mapped PBO memory
+        """
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pixelBuffer)
+        numBytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, numBytes, GL_MAP_READ_BIT)
+        
+        return np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_ubyte)), shape = (numBytes,)).view(dtype).reshape(shape)
+    
+    def grabRendering(self, return_info = False, attachments = None, halfFloat = None):
+        """Reads the rendered pixels from the FBO into an array.
         
-        # Set the color buffer that we want to read from. The GL_COLORATTACHMENT0 target is where we assigned our texture buffer in the FBO.
-        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        If a readback was started with :meth:`readPixelsToBuffer`, the oldest pending readback is grabbed, and it has to contain the requested attachments. Otherwise, the current contents of the FBO are read.
         
-        # Now we do the actual reading, noting that we read the pixels in the buffer as unsigned bytes to be consistent will how they are stored
-        rendering = glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_FLOAT)
-        rendering = np.frombuffer(rendering, dtype = np.float32).reshape(self.height, self.width, 3)
+        Args:
+            return_info (bool): Optional, can choose whether or not to return the barycentric coordinates and triangular face IDs for each pixel. If ``False``, it only returns the rendering. If ``True``, it returns a tuple containing the rendering, the pixel coordinates where the 3DMM is drawn, the triangular face IDs for each pixel where the 3DMM is drawn, and the barycentric coordinates of the triangular face underlying each pixel where the 3DMM is drawn.
+            attachments (tuple): Optional, names of the FBO attachments to read, any of ``'rendering'``, ``'barycentric'``, and ``'faceID'``. By default, all of them are read if ``return_info`` is ``True``. The entries of the returned tuple for attachments that are not read are ``None``. The face IDs are always read if ``return_info`` is ``True``, since they determine which pixels the 3DMM is drawn on.
+            halfFloat (bool): Optional, whether or not to return the rendering and the barycentric coordinates as 16-bit floats. By default, this is taken from the pending readback, or is ``False`` if there is none.
+            
+        Returns:
+            ndarray or tuple
+        """
+        if attachments is None:
+            attachments = ('rendering', 'barycentric', 'faceID') if return_info else ('rendering',)
+        elif return_info and 'faceID' not in attachments:
+            attachments = tuple(attachments) + ('faceID',)
+        
+        if not self.pendingReadbacks:
+            self.readPixelsToBuffer(attachments, bool(halfFloat))
+        
+        # The PBOs of attachments that the pending readback did not read hold the pixels of an earlier rendering
+        index, pendingAttachments, pendingHalfFloat = self.pendingReadbacks[0]
+        if not set(attachments) <= set(pendingAttachments):
+            raise RuntimeError('The pending readback only read the {} attachments, but {} were requested.'.format(pendingAttachments, attachments))
+        if halfFloat is not None and halfFloat != pendingHalfFloat:
+            raise RuntimeError('The pending readback was read with halfFloat = {}, but halfFloat = {} was requested.'.format(pendingHalfFloat, halfFloat))
+        
+        self.pendingReadbacks.popleft()
+        attachments = pendingAttachments
+        halfFloat = pendingHalfFloat
+        pixelBuffers = self.pixelBufferObjects[index]
+        floatType = np.float16 if halfFloat else np.float32
+        
+        rendering = None
+        if 'rendering' in attachments:
+            rendering = self.mapPixelBuffer(pixelBuffers['rendering'], floatType, (self.height, self.width, 3)).copy()
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
         
         if not return_info:
-            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
             return rendering
-        else:
-            glReadBuffer(GL_COLOR_ATTACHMENT1)
-            barycentricCoords = glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_FLOAT)
-            barycentricCoords = np.frombuffer(barycentricCoords, dtype = np.float32).reshape(self.height, self.width, 3)
-            
-            glReadBuffer(GL_COLOR_ATTACHMENT2)
-            faceID = glReadPixels(0, 0, self.width, self.height, GL_RED_INTEGER, GL_UNSIGNED_SHORT)
-            faceID = np.frombuffer(faceID, dtype = np.uint16).reshape(self.height, self.width)
-            
-            glBindFramebuffer(GL_FRAMEBUFFER, 0)
-            
-            pixelCoord = np.transpose(np.nonzero(faceID))
-            pixelFaces = faceID[faceID != 0] - 1
-            pixelBarycentricCoords = barycentricCoords[faceID != 0]
-            
-            return rendering, pixelCoord, pixelFaces, pixelBarycentricCoords
\ No newline at end of file
+        
+        # Find the pixels where the 3DMM is drawn in one pass over the face IDs, and compact the face IDs and barycentric coordinates of these pixels straight out of the mapped PBOs
+        faceID = self.mapPixelBuffer(pixelBuffers['faceID'], self.faceIDType, (self.height * self.width,))
+        pixelInd = np.flatnonzero(faceID)
+        pixelFaces = faceID[pixelInd] - 1
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        
+        # Report the pixel coordinates in full-frame space when a ROI is rendered
+        pixelCoord = np.c_[np.divmod(pixelInd, self.width)]
+        pixelCoord += (self.yOffset, self.xOffset)
+        
+        pixelBarycentricCoords = None
+        if 'barycentric' in attachments:
+            barycentricCoords = self.mapPixelBuffer(pixelBuffers['barycentric'], floatType, (self.height * self.width, 3))
+            pixelBarycentricCoords = barycentricCoords[pixelInd]
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        
+        return rendering, pixelCoord, pixelFaces, pixelBarycentricCoords
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""This module contains a software rasterizer written with NumPy. It has the same interface as :class:`mm.utils.opengl.Render`, so it can be used in its place on machines without a GPU or a display.
+"""
+import numpy as np
+
+class SoftwareRender:
+    """NumPy rendering class that mimics the OpenGL rendering class
+    
+    The triangles are rasterized in a vectorized manner: the pixel centers within the bounding box of each triangle are tested against the triangle. Small triangles, which are most of those of a 3DMM, are processed together by bounding box size on a fixed grid of pixel offsets, and the larger ones in tiles whose total number of bounding box pixels is bounded by ``maxCandidates``. A z-buffer keeps the nearest triangle at each pixel. The same conventions as :class:`mm.utils.opengl.Render` are used, i.e., pixel centers are at half-integer window coordinates, clockwise triangles are front-facing and back-facing triangles are culled, and smaller z values are nearer.
+    
+    Args:
+        width (int): Pixel width of window/viewport
+        height (int): Pixel height of window/viewport
+        meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
+        indexData (ndarray): 3DMM vertex indices for each triangular face
+        indexed (bool): Has no effect on the rendering, it is only here to match the arguments of :class:`mm.utils.opengl.Render`
+        img (ndarray, (height, width, 1 or 3)): Optional background image for rendering
+        maxCandidates (int): Maximum number of bounding box pixels of the larger triangles to test at once
+        maxBoxPixels (int): Largest number of bounding box pixels of the triangles that are rasterized together by bounding box size
+    
+    Attributes:
+        width (int): Pixel width of window/viewport
+        height (int): Pixel height of window/viewport
+        zNear (int): Nearside clipping plane
+        zFar (int): Farside clipping plane
+        meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
+        indexData (ndarray): 3DMM vertex indices for each triangular face
+        indexed (bool): Has no effect on the rendering, it is only kept so that :func:`mm.utils.opengl.getRender` can pool these objects like :class:`mm.utils.opengl.Render` objects
+        faceVertices (ndarray): Transposed ``indexData``, (3, numFaces)
+        numVertices (int): Number of 3DMM vertices
+        numFaces (int): Number of 3DMM triangular faces
+        vertexDim (int): Dimensionality of 3DMM vertices
+        img (ndarray, (height, width, 1 or 3)): Optional background image for rendering
+        maxCandidates (int): Maximum number of bounding box pixels of the larger triangles to test at once
+        maxBoxPixels (int): Largest number of bounding box pixels of the triangles that are rasterized together by bounding box size
+        xOffset (int): Full-frame x-coordinate (column) of the left edge of the rendered region, see :meth:`setROI`
+        yOffset (int): Full-frame y-coordinate (row) of the bottom edge of the rendered region, see :meth:`setROI`
+        faceIDType (type): ``np.uint16``, or ``np.uint32`` if the mesh has 65,535 or more triangular faces
+        colorBuffer (ndarray): Rendered RGB values, (height, width, 3)
+        barycentricBuffer (ndarray): Barycentric coordinates of the triangular face drawn at each pixel, (height * width, 3)
+        faceIDBuffer (ndarray): Triangular face ID drawn at each pixel plus one, or zero where nothing is drawn, (height * width,)
+        depthBuffer (ndarray): Normalized depth of each pixel, (height * width,)
+    """
+    def __init__(self, width, height, meshData, indexData, indexed = False, img = None, maxCandidates = 2 ** 22, maxBoxPixels = 64):
+        # Initialize input
+        self.width = width
+        self.height = height
+        self.zNear = -1000
+        self.zFar = 1000
+        
+        self.meshData = meshData.astype(np.float32)
+        self.indexData = np.asarray(indexData)
+        self.faceVertices = np.ascontiguousarray(self.indexData.T)
+        self.indexed = indexed
+        
+        self.numVertices = self.meshData.shape[0] // 2
+        self.numFaces = self.indexData.shape[0]
+        self.vertexDim = 3
+        
+        self.img = img
+        self.maxCandidates = maxCandidates
+        self.maxBoxPixels = maxBoxPixels
+        
+        # The whole window is rendered until a region of interest is set
+        self.xOffset = 0
+        self.yOffset = 0
+        
+        # The face IDs are offset by one so that 0 can mark the background
+        self.faceIDType = np.uint16 if self.numFaces + 1 <= np.iinfo(np.uint16).max else np.uint32
+        
+        self.initializeFramebufferObject()
+    
+    def initializeFramebufferObject(self):
+        """Allocates the buffers that hold the rendered colors, barycentric coordinates, face IDs, and depths of each pixel, and draws the background image into the color buffer if there is one.
+        """
+        self.colorBuffer = np.zeros((self.height, self.width, 3), dtype = np.float32)
+        if self.img is not None:
+            self.colorBuffer[...] = self.img.reshape((self.height, self.width, -1))
+        
+        self.barycentricBuffer = np.zeros((self.height * self.width, 3), dtype = np.float32)
+        self.faceIDBuffer = np.zeros(self.height * self.width, dtype = self.faceIDType)
+        self.depthBuffer = np.ones(self.height * self.width, dtype = np.float32)
+    
+    def updateVertexBuffer(self, meshData):
+        """Updates the 3DMM vertex coordinates and RGB colors to render.
+        
+        Args:
+            meshData (ndarray): 3DMM vertex coordinates and RGB values, concatenated vertically
+        """
+        self.meshData = meshData.astype(np.float32)
+    
+    def resize(self, width, height):
+        """Changes the size of the rendering. The buffers are only reallocated if the size changes.
+        
+        Args:
+            width (int): Pixel width of window/viewport
+            height (int): Pixel height of window/viewport
+        """
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.img = None
+            self.initializeFramebufferObject()
+    
+    def setROI(self, x, y, width, height):
+        """Restricts the rendering to a region of interest (ROI) of the full frame, in the same way as :meth:`mm.utils.opengl.Render.setROI`.
+        
+        Args:
+            x (int): Full-frame x-coordinate (column) of the left edge of the ROI
+            y (int): Full-frame y-coordinate (row) of the bottom edge of the ROI
+            width (int): Pixel width of the ROI
+            height (int): Pixel height of the ROI
+        """
+        self.xOffset = int(x)
+        self.yOffset = int(y)
+        self.resize(int(width), int(height))
+    
+    def setBackground(self, img):
+        """Draws a background image into the color buffer, replacing anything drawn there. The image is cropped to the ROI.
+        
+        Args:
+            img (ndarray, (frameHeight, frameWidth, 3)): Full-frame background image for rendering
+        """
+        self.img = np.ascontiguousarray(img[self.yOffset: self.yOffset + self.height, self.xOffset: self.xOffset + self.width], dtype = np.float32)
+        self.colorBuffer[...] = self.img.reshape((self.height, self.width, -1))
+    
+    def resetFramebufferObject(self):
+        """Erases any drawn objects from the buffers.
+        """
+        self.colorBuffer.fill(0)
+        self.barycentricBuffer.fill(0)
+        self.faceIDBuffer.fill(0)
+        self.depthBuffer.fill(1)
+    
+    def render(self):
+        """Rasterizes the triangular faces of the 3DMM into the buffers.
+        """
+        # Window coordinates of the three vertices of each triangular face relative to the ROI, each (3, numFaces)
+        vertexCoord = self.meshData[:self.numVertices, :3].T
+        x, y, z = [np.take(vertexCoord[i], self.faceVertices) for i in range(3)]
+        x -= self.xOffset
+        y -= self.yOffset
+        
+        # Twice the signed area of each triangle in window coordinates. Clockwise triangles have a negative area, and only these front-facing triangles are drawn.
+        area = (x[1] - x[0]) * (y[2] - y[0]) - (x[2] - x[0]) * (y[1] - y[0])
+        
+        # Bounding boxes of the pixel centers covered by each triangle, clipped to the viewport
+        xMin = np.maximum(np.ceil(x.min(axis = 0) - 0.5), 0).astype(np.int64)
+        xMax = np.minimum(np.floor(x.max(axis = 0) - 0.5), self.width - 1).astype(np.int64)
+        yMin = np.maximum(np.ceil(y.min(axis = 0) - 0.5), 0).astype(np.int64)
+        yMax = np.minimum(np.floor(y.max(axis = 0) - 0.5), self.height - 1).astype(np.int64)
+        
+        faces = np.flatnonzero((area < 0) & (xMax >= xMin) & (yMax >= yMin))
+        if faces.size == 0:
+            return
+        
+        # The triangles of a 3DMM mostly cover a few pixels each, so the triangles with the same small bounding box size are rasterized together on a fixed grid of pixel offsets, which needs no per-pixel bookkeeping, with the triangles along the contiguous axis so that NumPy loops over them rather than over the few offsets. The triangles are sorted by bounding box size, with the larger ones last, so that each group is a contiguous slice.
+        xMin, yMin = xMin[faces], yMin[faces]
+        boxWidth = xMax[faces] - xMin + 1
+        boxHeight = yMax[faces] - yMin + 1
+        numCandidates = boxWidth * boxHeight
+        boxSize = np.where(numCandidates <= self.maxBoxPixels, boxWidth * (self.maxBoxPixels + 1) + boxHeight, np.iinfo(np.uint16).max).astype(np.uint16)
+        order = np.argsort(boxSize, kind = 'stable')
+        faces, boxSize, boxWidth, numCandidates, xMin, yMin = faces[order], boxSize[order], boxWidth[order], numCandidates[order], xMin[order], yMin[order]
+        
+        # Move the origin to the pixel center at the bottom left of the bounding box of each triangle, so that the small pixel offsets within the bounding box are accurate in single precision
+        x, y, z, area = np.take(x, faces, axis = 1), np.take(y, faces, axis = 1), np.take(z, faces, axis = 1), np.take(area, faces)
+        x -= xMin + 0.5
+        y -= yMin + 0.5
+        cornerInd = yMin * self.width + xMin
+        
+        # The first two barycentric coordinates and the normalized depth are affine functions of the pixel offsets, so we find the coefficients of these functions for each triangle, (9, numFaces)
+        planes = np.empty((9, faces.size), dtype = np.float32)
+        for k in range(2):
+            i, j = (k + 1) % 3, (k + 2) % 3
+            planes[3*k] = (y[i] - y[j]) / area
+            planes[3*k + 1] = (x[j] - x[i]) / area
+            planes[3*k + 2] = (x[i] * y[j] - x[j] * y[i]) / area
+        
+        # The depth interpolates the vertex depths with the barycentric coordinates, and is then normalized to [0, 1] like the OpenGL depth range
+        zScale = self.zFar - self.zNear
+        planes[6: 9] = ((z[0] - z[2]) * planes[0: 3] + (z[1] - z[2]) * planes[3: 6]) / zScale
+        planes[8] += (z[2] - self.zNear) / zScale
+        
+        sizes, starts = np.unique(boxSize, return_index = True)
+        ends = np.r_[starts[1:], faces.size]
+        
+        # Pixels drawn by this call, whose colors are interpolated at the end
+        drawn = np.zeros(self.height * self.width, dtype = bool)
+        
+        fragments = []
+        for size, start, end in zip(sizes, starts, ends):
+            if size == np.iinfo(np.uint16).max:
+                break
+            groupWidth, groupHeight = divmod(int(size), self.maxBoxPixels + 1)
+            dy, dx = np.divmod(np.arange(groupWidth * groupHeight), groupWidth)
+            pixelInd = (dy * self.width + dx)[:, np.newaxis] + cornerInd[start: end]
+            fragments.append(self.rasterize(np.arange(start, end), planes[:, start: end], dx.astype(np.float32)[:, np.newaxis], dy.astype(np.float32)[:, np.newaxis], pixelInd))
+        
+        if fragments:
+            drawn[self.drawFragments(faces, *[np.concatenate(f) for f in zip(*fragments)])] = True
+        
+        # Rasterize the larger triangles in tiles such that each tile has at most maxCandidates bounding box pixels, unless a single triangle has more
+        large = np.flatnonzero(boxSize == np.iinfo(np.uint16).max)
+        cumCandidates = np.cumsum(numCandidates[large])
+        start = 0
+        while start < large.size:
+            offset = cumCandidates[start - 1] if start > 0 else 0
+            end = max(np.searchsorted(cumCandidates, offset + self.maxCandidates, side = 'right'), start + 1)
+            tile = large[start: end]
+            
+            # Enumerate the pixels in the bounding box of each triangle in the tile
+            candidateFaces = np.repeat(tile, numCandidates[tile])
+            local = np.arange(candidateFaces.size) - np.repeat(np.cumsum(numCandidates[tile]) - numCandidates[tile], numCandidates[tile])
+            dy, dx = np.divmod(local, boxWidth[candidateFaces])
+            pixelInd = cornerInd[candidateFaces] + dy * self.width + dx
+            
+            drawn[self.drawFragments(faces, *self.rasterize(candidateFaces, planes[:, candidateFaces], dx.astype(np.float32), dy.astype(np.float32), pixelInd))] = True
+            start = end
+        
+        # Interpolate the vertex colors only at the pixels that are finally drawn, gathering along the contiguous rows of the transposed arrays, which is much faster than gathering rows of 3 values
+        pixelInd = np.flatnonzero(drawn)
+        pixelVertices = np.take(self.faceVertices, self.faceIDBuffer[pixelInd].astype(np.int64) - 1, axis = 1)
+        barycentricCoords = self.barycentricBuffer[pixelInd].T
+        vertexColor = self.meshData[self.numVertices:, :].T
+        color = np.zeros((3, pixelInd.size), dtype = np.float32)
+        for k in range(3):
+            color += barycentricCoords[k] * np.take(vertexColor, pixelVertices[k], axis = 1)
+        self.colorBuffer.reshape(-1, 3)[pixelInd] = color.T
+    
+    def rasterize(self, candidateFaces, planes, dx, dy, pixelInd):
+        """Tests candidate pixels against their triangular faces. This is called by :meth:`render`.
+        
+        Args:
+            candidateFaces (ndarray): Indices of the triangular faces of the candidate pixels into the faces that are drawn, (numCandidates,), or one for each column of ``pixelInd``
+            planes (ndarray): Coefficients of the affine functions of the pixel offsets from the bottom left of the bounding box that give the first two barycentric coordinates and the normalized depth of the triangular faces, (9, ...) broadcastable against ``pixelInd``
+            dx (ndarray): Column offsets of the candidate pixels from the bottom left of the bounding box, broadcastable against ``pixelInd``
+            dy (ndarray): Row offsets of the candidate pixels from the bottom left of the bounding box, broadcastable against ``pixelInd``
+            pixelInd (ndarray): Indices of the candidate pixels into the flattened buffers
+        
+        Returns:
+            (tuple): The triangular faces, pixel indices, first two barycentric coordinates, and normalized depths of the candidate pixels inside of their triangular faces
+        """
+        # Evaluate the barycentric coordinates and depths at the pixel centers
+        b0 = planes[0] * dx + planes[1] * dy + planes[2]
+        b1 = planes[3] * dx + planes[4] * dy + planes[5]
+        depth = planes[6] * dx + planes[7] * dy + planes[8]
+        
+        inside = (b0 >= 0) & (b1 >= 0) & (b0 + b1 <= 1) & (depth >= 0) & (depth <= 1)
+        
+        # For a grid of pixel offsets, (numOffsets, numTileFaces), the triangular face of each candidate pixel is given by its column
+        columns = np.nonzero(inside)[-1]
+        
+        return candidateFaces[columns], pixelInd[inside], b0[inside], b1[inside], depth[inside]
+    
+    def drawFragments(self, faces, fragmentFaces, pixelInd, b0, b1, depth):
+        """Depth tests fragments and draws the barycentric coordinates and triangular face IDs of the ones that pass into the buffers. This is called by :meth:`render`, which then interpolates the colors of the drawn pixels.
+        
+        Args:
+            faces (ndarray): Indices of the triangular faces that are drawn
+            fragmentFaces (ndarray): Triangular face of each fragment as an index into ``faces``
+            pixelInd (ndarray): Pixel index of each fragment into the flattened buffers
+            b0 (ndarray): First barycentric coordinate of each fragment
+            b1 (ndarray): Second barycentric coordinate of each fragment
+            depth (ndarray): Normalized depth of each fragment
+        
+        Returns:
+            ndarray: Pixel indices of the fragments that passed the depth test
+        """
+        # Depth test: keep the nearest fragment at each pixel, both among these fragments and against what has already been drawn
+        np.minimum.at(self.depthBuffer, pixelInd, depth)
+        passed = np.flatnonzero(depth == self.depthBuffer[pixelInd])
+        pixelInd = pixelInd[passed]
+        
+        barycentricCoords = np.empty((passed.size, 3), dtype = np.float32)
+        barycentricCoords[:, 0] = b0[passed]
+        barycentricCoords[:, 1] = b1[passed]
+        barycentricCoords[:, 2] = 1 - barycentricCoords[:, 0] - barycentricCoords[:, 1]
+        
+        self.barycentricBuffer[pixelInd] = barycentricCoords
+        self.faceIDBuffer[pixelInd] = faces[fragmentFaces[passed]] + 1
+        
+        return pixelInd
+    
+    def grabRendering(self, return_info = False, attachments = None, halfFloat = None):
+        """Reads the rendered pixels from the buffers into an array.
+        
+        Args:
+            return_info (bool): Optional, can choose whether or not to return the barycentric coordinates and triangular face IDs for each pixel. If ``False``, it only returns the rendering. If ``True``, it returns a tuple containing the rendering, the pixel coordinates where the 3DMM is drawn, the triangular face IDs for each pixel where the 3DMM is drawn, and the barycentric coordinates of the triangular face underlying each pixel where the 3DMM is drawn.
+            attachments (tuple): Optional, names of the buffers to read, any of ``'rendering'``, ``'barycentric'``, and ``'faceID'``. The entries of the returned tuple for buffers that are not read are ``None``.
+            halfFloat (bool): Optional, whether or not to return the rendering and the barycentric coordinates as 16-bit floats
+        
+        Returns:
+            ndarray or tuple
+        """
+        if attachments is None:
+            attachments = ('rendering', 'barycentric', 'faceID')
+        floatType = np.float16 if halfFloat else np.float32
+        
+        rendering = self.colorBuffer.astype(floatType) if 'rendering' in attachments else None
+        
+        if not return_info:
+            return rendering
+        
+        pixelInd = np.flatnonzero(self.faceIDBuffer)
+        pixelCoord = np.c_[np.divmod(pixelInd, self.width)]
+        pixelCoord += (self.yOffset, self.xOffset)
+        pixelFaces = self.faceIDBuffer[pixelInd] - 1
+        pixelBarycentricCoords = self.barycentricBuffer[pixelInd].astype(floatType) if 'barycentric' in attachments else None
+        
+        return rendering, pixelCoord, pixelFaces, pixelBarycentricCoords
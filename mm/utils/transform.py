@@ -50,6 +50,50 @@ def rotMat2angle(R):
         
         return np.dot(Rz, np.dot(Ry, Rx))
 
+def rotMat2angleBatch(R):
+    """
+    Vectorized version of rotMat2angle for a stack of rotation matrices or Euler angles. If the input is (numMatrices, 3, 3), then the output will return a (numMatrices, 3) array containing psi, theta, and phi for each rotation matrix. If the input is (numMatrices, 3), then the output will return the (numMatrices, 3, 3) rotation matrices.
+    """
+    if R.shape[1:] == (3, 3):
+        angles = np.empty((R.shape[0], 3))
+        
+        # The general case, where the cosine of theta is not 0
+        regular = np.abs(R[:, 2, 0]) != 1
+        theta = -np.arcsin(np.clip(R[regular, 2, 0], -1, 1))
+        cosTheta = np.cos(theta)
+        angles[regular, 0] = np.arctan2(R[regular, 2, 1]/cosTheta, R[regular, 2, 2]/cosTheta)
+        angles[regular, 1] = theta
+        angles[regular, 2] = np.arctan2(R[regular, 1, 0]/cosTheta, R[regular, 0, 0]/cosTheta)
+        
+        # Gimbal lock, where phi is set to 0
+        down = R[:, 2, 0] == -1
+        angles[down, 0] = np.arctan2(R[down, 0, 1], R[down, 0, 2])
+        angles[down, 1] = np.pi/2
+        up = R[:, 2, 0] == 1
+        angles[up, 0] = np.arctan2(-R[up, 0, 1], -R[up, 0, 2])
+        angles[up, 1] = -np.pi/2
+        angles[~regular, 2] = 0
+        
+        return angles
+    
+    elif R.shape[1:] == (3,):
+        c = np.cos(R)
+        s = np.sin(R)
+        
+        # Rz(phi) * Ry(theta) * Rx(psi), written out for each element
+        rotMat = np.empty((R.shape[0], 3, 3))
+        rotMat[:, 0, 0] = c[:, 2]*c[:, 1]
+        rotMat[:, 0, 1] = c[:, 2]*s[:, 1]*s[:, 0] - s[:, 2]*c[:, 0]
+        rotMat[:, 0, 2] = c[:, 2]*s[:, 1]*c[:, 0] + s[:, 2]*s[:, 0]
+        rotMat[:, 1, 0] = s[:, 2]*c[:, 1]
+        rotMat[:, 1, 1] = s[:, 2]*s[:, 1]*s[:, 0] + c[:, 2]*c[:, 0]
+        rotMat[:, 1, 2] = s[:, 2]*s[:, 1]*c[:, 0] - c[:, 2]*s[:, 0]
+        rotMat[:, 2, 0] = -s[:, 1]
+        rotMat[:, 2, 1] = c[:, 1]*s[:, 0]
+        rotMat[:, 2, 2] = c[:, 1]*c[:, 0]
+        
+        return rotMat
+
 def perspectiveTransformKinect(d, inverse = False):
     """
     Transformation between pixel indices (u, v) of depth map to real-world coordinates in mm (x, y) for Kinect v1 depth camera (640x480 resolution). Depth values z are in mm. In the forward direction, go from (u, v, z) to (x, y, z). In the inverse direction, go from (x, y, z) to (u, v, z).